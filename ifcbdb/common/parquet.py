@@ -0,0 +1,53 @@
+"""
+Writes Parquet files a row group at a time, so that large tables can be sent in
+streaming responses without being built in memory first.
+"""
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+PARQUET_CONTENT_TYPE = 'application/vnd.apache.parquet'
+
+class _StreamSink(object):
+    # a write-only file that holds what has been written since it was last drained,
+    # keeping track of the total written so the Parquet writer's offsets are right
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+    def tell(self):
+        return self.position
+    def flush(self):
+        pass
+    def close(self):
+        self.closed = True
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def record_batch(schema, columns):
+    # columns is a dict of column name to list of values. dictionary-typed columns,
+    # which pandas reads as categoricals, are encoded from their values
+    arrays = []
+    for field in schema:
+        if pa.types.is_dictionary(field.type):
+            array = pa.array(columns[field.name], type=field.type.value_type).dictionary_encode()
+        else:
+            array = pa.array(columns[field.name], type=field.type)
+        arrays.append(array)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def stream_parquet(schema, batches):
+    # generates the bytes of a Parquet file, writing each batch (a dict of column
+    # name to list of values) as a row group
+    sink = _StreamSink()
+    with pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema, compression='zstd') as writer:
+        for columns in batches:
+            writer.write_batch(record_batch(schema, columns))
+            yield sink.drain()
+    yield sink.drain()
@@ -0,0 +1,315 @@
+"""
+Copies IFCB filesets from an instrument's SMB share using several connections at once.
+
+Each file is downloaded to a .part file next to its destination and renamed into place
+once it is complete, so nothing that reads the destination directory ever sees a
+partially written file. If a transfer is interrupted, the .part file is kept and the
+next transfer resumes from where it left off. A fileset's .adc file is renamed into
+place last, so a fileset appears to be complete only once all of its files are.
+
+This module does not depend on Django, so utilities/auto_transfer.py can use it. The
+Dockerfile copies it next to auto_transfer.py in the image.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from datetime import date, datetime, timedelta
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from smb.SMBConnection import SMBConnection
+
+import ifcb
+
+# .adc last, see above
+FILESET_EXTENSIONS = ['hdr', 'roi', 'adc']
+PART_SUFFIX = '.part'
+
+DEFAULT_CONNECTIONS = 4
+
+def do_nothing(*args, **kwargs):
+    pass
+
+def is_bin_lid(name):
+    try:
+        ifcb.Pid(name).timestamp
+        return True
+    except ValueError:
+        return False
+
+# names of directories organized by date, which incremental listing can skip
+DAY_DIR = re.compile(r'^D?(\d{4})(\d{2})(\d{2})$') # e.g., D20190101
+DAY_OF_YEAR_DIR = re.compile(r'^(?:IFCB\d+_)?(\d{4})_(\d{3})$') # e.g., IFCB1_2009_001
+YEAR_DIR = re.compile(r'^D?(\d{4})$') # e.g., D2019
+
+def directory_is_before(name, since):
+    # whether a directory's name says all its data is from before the date since
+    m = DAY_DIR.match(name)
+    if m:
+        try:
+            return date(*map(int, m.groups())) < since
+        except ValueError:
+            return False
+    m = DAY_OF_YEAR_DIR.match(name)
+    if m:
+        year, day = map(int, m.groups())
+        return date(year, 1, 1) + timedelta(days=day - 1) < since
+    m = YEAR_DIR.match(name)
+    if m:
+        return int(m.group(1)) < since.year
+    return False
+
+class TransferState(object):
+    """
+    A local SQLite store of remote files that have been copied and verified, keyed by
+    lid and extension and recording each file's remote size and mtime, so that later
+    transfers can skip filesets that have not changed without checking local files.
+    Only use it from the thread that created it.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('''create table if not exists copied (
+            lid text not null,
+            ext text not null,
+            size integer not null,
+            mtime real not null,
+            day text not null,
+            primary key (lid, ext))''')
+        self.db.execute('create index if not exists copied_day on copied (day)')
+        self.db.commit()
+    def close(self):
+        self.db.close()
+    def is_copied(self, lid, files):
+        rows = self.db.execute('select ext, size, mtime from copied where lid = ?', (lid,))
+        copied = dict((ext, (size, mtime)) for ext, size, mtime in rows)
+        return all(copied.get(ext) == (f.size, f.mtime) for ext, f in files.items())
+    def record(self, lid, files):
+        day = ifcb.Pid(lid).timestamp.strftime('%Y-%m-%d')
+        self.db.executemany('insert or replace into copied (lid, ext, size, mtime, day) values (?, ?, ?, ?, ?)',
+            [(lid, ext, f.size, f.mtime, day) for ext, f in files.items()])
+        self.db.commit()
+    def newest_day(self):
+        row = self.db.execute('select max(day) from copied').fetchone()
+        if row[0] is None:
+            return None
+        return datetime.strptime(row[0], '%Y-%m-%d').date()
+    def since(self, recent_days=2):
+        # earliest date whose directories an incremental listing must include: the last
+        # few days, or if the last transfer was longer ago than that, the day before it.
+        # None if nothing has been recorded
+        newest = self.newest_day()
+        if newest is None:
+            return None
+        return min(date.today() - timedelta(days=recent_days), newest - timedelta(days=1))
+
+class RemoteFile(object):
+    def __init__(self, path, size, mtime):
+        self.path = path # path relative to the share, with / separators
+        self.size = size
+        self.mtime = mtime
+
+class SmbTransfer(object):
+    """
+    Use as a context manager. Connections are opened as they are needed, one per worker
+    thread, and closed on exit.
+    """
+    def __init__(self, address, username, password, share='Data', directory='',
+            netbios_name=None, timeout=30, n_connections=DEFAULT_CONNECTIONS, port=445):
+        self.address = address
+        self.username = username
+        self.password = password
+        self.share = share
+        self.directory = directory.strip('/')
+        self.netbios_name = netbios_name or address
+        self.timeout = timeout
+        self.n_connections = n_connections
+        self.port = port
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._connections = []
+        self._local = threading.local()
+    def connection(self):
+        # the calling thread's connection
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = SMBConnection(self.username, self.password, 'ifcbdb', self.netbios_name,
+                use_ntlm_v2=True, is_direct_tcp=True)
+            if not conn.connect(self.address, self.port, timeout=self.timeout):
+                raise ConnectionError('unable to connect to {}'.format(self.address))
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+    def is_responding(self):
+        try:
+            self.connection()
+            return True
+        except Exception:
+            return False
+    def list_shares(self):
+        for share in self.connection().listShares(timeout=self.timeout):
+            yield share.name
+    def share_exists(self):
+        return self.share in self.list_shares()
+    def list_directory(self, path):
+        # (subdirectory paths, RemoteFiles) in a directory on the share
+        dirs, files = [], []
+        for f in self.connection().listPath(self.share, path or '/', timeout=self.timeout):
+            if f.filename in ['.', '..']:
+                continue
+            child = '/'.join([path, f.filename]) if path else f.filename
+            if f.isDirectory:
+                dirs.append(child)
+            else:
+                files.append(RemoteFile(child, f.file_size, f.last_write_time))
+        return dirs, files
+    def list_filesets(self, path=None, since=None):
+        # walks the share from path (default the transfer's directory), returning the
+        # RemoteFiles of each complete fileset keyed by lid and then by extension.
+        # if since is a date, skips directories whose names say they are older
+        filesets = {}
+        stack = [self.directory if path is None else path]
+        while stack:
+            dirs, files = self.list_directory(stack.pop())
+            if since is not None:
+                dirs = [d for d in dirs if not directory_is_before(d.split('/')[-1], since)]
+            stack.extend(sorted(dirs, reverse=True))
+            for f in files:
+                lid, ext = os.path.splitext(os.path.basename(f.path))
+                if ext[1:] in FILESET_EXTENSIONS and is_bin_lid(lid):
+                    filesets.setdefault(lid, {})[ext[1:]] = f
+        return dict((lid, files) for lid, files in filesets.items()
+            if len(files) == len(FILESET_EXTENSIONS))
+    def copy_file(self, remote, local_path):
+        # copies a RemoteFile to local_path via a .part file, resuming a previous partial copy.
+        # returns the number of bytes transferred
+        if os.path.exists(local_path) and os.path.getsize(local_path) == remote.size:
+            return 0
+        part_path = local_path + PART_SUFFIX
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > remote.size: # remote file has been replaced by a smaller one
+            offset = 0
+        with open(part_path, 'ab' if offset else 'wb') as fout:
+            if offset < remote.size:
+                self.connection().retrieveFileFromOffset(self.share, remote.path, fout,
+                    offset=offset, timeout=self.timeout)
+        size = os.path.getsize(part_path)
+        if size != remote.size:
+            raise IOError('copied {} bytes of {}, expected {}'.format(size, remote.path, remote.size))
+        os.replace(part_path, local_path)
+        return remote.size - offset
+    def drop_connection(self):
+        # close the calling thread's connection, e.g. after an error, so it reconnects
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+        with self._lock:
+            self._connections.remove(conn)
+        try:
+            conn.close()
+        except Exception:
+            pass
+    def copy_fileset(self, lid, files, destination_directory):
+        # returns the number of bytes transferred
+        os.makedirs(destination_directory, exist_ok=True)
+        n_bytes = 0
+        try:
+            for ext in FILESET_EXTENSIONS:
+                local_path = os.path.join(destination_directory, '{}.{}'.format(lid, ext))
+                n_bytes += self.copy_file(files[ext], local_path)
+        except Exception:
+            self.drop_connection()
+            raise
+        return n_bytes
+    def needs_copy(self, lid, files, destination_directory):
+        for ext in FILESET_EXTENSIONS:
+            local_path = os.path.join(destination_directory, '{}.{}'.format(lid, ext))
+            if not os.path.exists(local_path) or os.path.getsize(local_path) != files[ext].size:
+                return True
+        return False
+    def sync(self, destination, filesets=None, fileset_callback=do_nothing, progress_callback=do_nothing,
+            state=None, reconcile=False, recent_days=2):
+        """
+        Copies filesets that are missing locally or differ in size. destination is a
+        directory path or a function that takes a lid and returns one. filesets is
+        the result of list_filesets(), which is called if it is not given.
+        fileset_callback is called with each copied lid and progress_callback with a
+        progress dict after each fileset, both in the calling thread. Returns the
+        final progress dict. Filesets that fail to copy are reported in its errors.
+
+        If state is a TransferState, only recent directories are listed (see
+        TransferState.since), filesets it has recorded as copied are skipped, and
+        copied filesets are recorded in it. If reconcile is True, everything is
+        listed and checked against the local files, and the state is brought up to date.
+        """
+        if not callable(destination):
+            destination_directory = destination
+            destination = lambda lid: destination_directory
+        incremental = state is not None and not reconcile
+        if filesets is None:
+            filesets = self.list_filesets(since=state.since(recent_days) if incremental else None)
+        todo = []
+        for lid, files in sorted(filesets.items()):
+            if incremental and state.is_copied(lid, files):
+                continue
+            if self.needs_copy(lid, files, destination(lid)):
+                todo.append((lid, files))
+            elif state is not None: # copied some other way, or before there was a state store
+                state.record(lid, files)
+        progress = {
+            'listed': len(filesets),
+            'total': len(todo),
+            'copied': 0,
+            'bytes': 0,
+            'lid': None,
+            'errors': {},
+            'started': time.time(),
+        }
+        progress_callback(progress)
+        if not todo:
+            return progress
+        # only a few filesets are in flight at once, so if fileset_callback blocks,
+        # e.g. because whatever consumes copied filesets is behind, copying pauses too
+        todo = iter(todo)
+        with ThreadPoolExecutor(max_workers=self.n_connections) as executor:
+            futures = {}
+            def submit():
+                item = next(todo, None)
+                if item is not None:
+                    lid, files = item
+                    futures[executor.submit(self.copy_fileset, lid, files, destination(lid))] = lid
+            for _ in range(self.n_connections * 2):
+                submit()
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    lid = futures.pop(future)
+                    submit()
+                    try:
+                        progress['bytes'] += future.result()
+                    except Exception as e:
+                        progress['errors'][lid] = str(e)
+                        continue
+                    progress['copied'] += 1
+                    progress['lid'] = lid
+                    if state is not None:
+                        state.record(lid, filesets[lid])
+                    fileset_callback(lid)
+                    progress_callback(progress)
+        return progress
@@ -1,30 +1,43 @@
 import os
+import io
+import csv
 import json
 import time
 import re
 
-from collections import defaultdict
 from itertools import islice
 
 from django.db import IntegrityError, transaction
-from django.db.models import Count, Max
+from django.db.models import Count, Max, Func, FloatField, JSONField, Case, When, OuterRef, Subquery
+from django.db.models.functions import Cast
+from django.db.models.fields.json import KeyTextTransform
 from django.contrib.postgres.aggregates.general import StringAgg
+from django.contrib.postgres.expressions import ArraySubquery
+from django.contrib.gis.geos import Point
 
 import pandas as pd
-import numpy as np
+import pyarrow as pa
 
-from .models import Bin, DataDirectory, Instrument, Timeline, Dataset, normalize_tag_name
-from .qaqc import check_bad, check_no_rois
+from billiard import Pool
+
+from .models import Bin, DataDirectory, Instrument, Timeline, Dataset, Tag, TagEvent, Comment, \
+    normalize_tag_name, FILL_VALUE, SRID
+from .summary import summarize_bin, summarize_fileset
+from .manifest import Manifest
+from .timing import StageTimer
+from .rollups import update_rollups, rebuild_rollups, rebuild_summaries, week_ranges, ROLLUP_FIELDS
+
+from common.parquet import stream_parquet
 
 import ifcb
-from ifcb.data.files import time_filter
+from ifcb.data.files import time_filter, Fileset, FilesetBin
 from ifcb.data.adc import SCHEMA_VERSION_1
 from ifcb.data.stitching import InfilledImages
 
 
-def progress(bin_id, added, total, bad, errors={}):
+def progress(bin_id, added, total, bad, errors={}, timings=None):
     error_list = [{ 'bin': k, 'message': v} for k,v in errors.items()]
-    return {
+    p = {
         'bin_id': bin_id,
         'added': added,
         'total': total,
@@ -32,6 +45,9 @@ def progress(bin_id, added, total, bad, errors={}):
         'existing': total - added - bad,
         'errors': error_list,
     }
+    if timings is not None: # see StageTimer.report
+        p['timings'] = timings
+    return p
 def print_progress(progress):
         print(progress)
         return True
@@ -39,15 +55,63 @@ def print_progress(progress):
 def do_nothing(*args, **kwargs):
     pass
 
+def fileset_basepath(bin):
+    basepath, _ = os.path.splitext(bin.fileset.adc_path)
+    return basepath
+
+def apply_bin_summary(b, summary):
+    # set Bin fields from the BinSummary of a good bin (does not save)
+    headers = summary.headers
+    b.metadata_json = json.dumps(headers)
+    #
+    # lat/lon/depth
+    latitude = headers.get('latitude') or headers.get('gpsLatitude')
+    longitude = headers.get('longitude') or headers.get('gpsLongitude')
+
+    depth = headers.get('depth')
+    if latitude is not None and longitude is not None:
+        try:
+            latitude = float(latitude)
+            longitude = float(longitude)
+        except TypeError:
+            latitude = None
+            longitude = None
+        try:
+            depth = float(depth)
+        except TypeError:
+            depth = None
+        if latitude is not None and longitude is not None:
+            b.set_location(longitude, latitude, depth)
+    # metrics
+    b.temperature = summary.temperature
+    b.humidity = summary.humidity
+    b.size = summary.size
+    b.ml_analyzed = summary.ml_analyzed
+    b.look_time = summary.look_time
+    b.run_time = summary.run_time
+    b.n_triggers = summary.n_triggers
+    b.n_images = summary.n_images
+    b.concentration = summary.n_images / summary.ml_analyzed
+    return b
+
 class Accession(object):
     # wraps a dataset object to provide accession
-    def __init__(self, dataset, batch_size=100, lat=None, lon=None, depth=None, newest_only=False):
+    def __init__(self, dataset, batch_size=100, lat=None, lon=None, depth=None, newest_only=False, n_workers=1,
+            rescan=False, timing=False):
         self.dataset = dataset
         self.batch_size = batch_size
         self.lat = lat
         self.lon = lon
         self.depth = depth
         self.newest_only = newest_only
+        # number of processes extracting bin summaries; 1 means extract in this process
+        self.n_workers = n_workers
+        self.instruments = {} # keyed by instrument number
+        # if rescan is True, ignore the directory manifests and scan every fileset
+        self.rescan = rescan
+        self.manifests = []
+        # if timing is True, record time spent in each stage of accession, see timing.py
+        self.timer = StageTimer(enabled=timing)
     def start_time(self):
         if not self.newest_only or not self.dataset.bins:
             return None
@@ -56,54 +120,166 @@ class Accession(object):
             return b.sample_time
         return None
     def scan(self):
+        # yields new or changed filesets, see manifest.py
+        self.manifests = []
         for dd in self.dataset.directories.filter(kind=DataDirectory.RAW).order_by('priority'):
             if not os.path.exists(dd.path):
                 continue # skip and continue searching
-            directory = ifcb.DataDirectory(dd.path)
-            for b in directory:
-                yield b
-    def sync_one(self, pid):
-        bin = None
+            manifest = Manifest(dd, rescan=self.rescan)
+            self.manifests.append(manifest)
+            for basepath in manifest.scan():
+                yield FilesetBin(Fileset(basepath))
+    def commit_manifests(self):
+        # record what has been scanned once it has been accessioned
+        for manifest in self.manifests:
+            manifest.commit()
+    def exclude_from_manifests(self, basepaths):
+        # filesets that were scanned but not accessioned, which the next scan yields again
+        for manifest in self.manifests:
+            manifest.exclude(basepaths)
+    def find_bin(self, pid):
+        # find the raw data for a bin in this dataset's raw directories, in priority order
         for dd in self.dataset.directories.filter(kind=DataDirectory.RAW).order_by('priority'):
             if not os.path.exists(dd.path):
                 continue # skip and continue searching
             directory = ifcb.DataDirectory(dd.path)
             try:
-                bin = directory[pid]
+                return directory[pid]
             except KeyError:
                 continue
+        return None
+    def find_bins(self, pids):
+        # find the raw data for many bins with at most one walk of each raw directory,
+        # in priority order. returns ifcb bins keyed by pid, omitting pids that are not found
+        return dict((pid, FilesetBin(Fileset(basepath))) for pid, basepath in self.find_basepaths(pids).items())
+    def find_basepaths(self, pids):
+        # like find_bins, but returns fileset basepaths. as pyifcb does when finding a bin,
+        # only searches whitelisted directories and ones whose names are part of a bin id
+        # being looked for, such as year and day directories, not the whole tree
+        remaining = set(pids)
+        found = {}
+        for dd in self.dataset.directories.filter(kind=DataDirectory.RAW).order_by('priority'):
+            if not remaining:
+                break
+            if not os.path.exists(dd.path):
+                continue # skip and continue searching
+            whitelist = set(re.split(',', dd.whitelist))
+            skipped_names = dd.skipped_directory_names()
+            for dirpath, dirnames, filenames in os.walk(dd.path):
+                dirnames[:] = sorted(d for d in dirnames if d not in skipped_names
+                    and (d in whitelist or any(d in pid for pid in remaining)))
+                names = set(filenames)
+                for name in filenames:
+                    pid, ext = os.path.splitext(name)
+                    if ext != '.adc' or pid not in remaining:
+                        continue
+                    if pid + '.hdr' in names and pid + '.roi' in names:
+                        found[pid] = os.path.join(dirpath, pid)
+                        remaining.discard(pid)
+                if not remaining:
+                    break
+        return found
+    def sync_one(self, pid):
+        bin = self.find_bin(pid)
         if bin is None:
             return 'bin {} not found'.format(pid)
+        added, bad, errors = self.add_bins([bin])
+        return errors.get(bin.lid)
+    def sync_bins(self, pids, log_callback=do_nothing):
+        # accession a list of bins by pid, e.g. ones a transfer client has just copied.
+        # returns a status for each pid: 'exists', 'synced', 'not found', or 'bad', and
+        # error messages for the bad ones keyed by pid
+        existing = set(Bin.objects.filter(pid__in=pids).values_list('pid', flat=True))
+        status = dict((pid, 'exists') for pid in existing)
+        found = self.find_bins([pid for pid in pids if pid not in existing])
+        bins = list(found.values())
+        errors = {}
+        for i in range(0, len(bins), self.batch_size):
+            added, bad, batch_errors = self.add_bins(bins[i:i+self.batch_size], log_callback=log_callback)
+            errors.update(batch_errors)
+        for pid in pids:
+            if pid in status:
+                continue
+            if pid in errors:
+                status[pid] = 'bad'
+            elif pid in found:
+                status[pid] = 'synced'
+            else:
+                status[pid] = 'not found'
+        return status, errors
+    def get_instrument(self, bin):
         # create instrument if necessary
         i = bin.pid.instrument
-        version = bin.pid.schema_version
-        instrument, created = Instrument.objects.get_or_create(number=i, defaults={
-            'version': version
-        })
-        # create model object
-        timestamp = bin.pid.timestamp
-        b, created = Bin.objects.get_or_create(pid=pid, defaults={
-            'timestamp': timestamp,
-            'sample_time': timestamp,
-            'instrument': instrument,
-            'skip': True, # in case accession is interrupted
-        })
-        if not created and not dataset in b.datasets:
-            self.dataset.bins.add(b)
-            return 
-        b2s, error = self.add_bin(bin, b)
-        if error is not None:
-            # there was an error. if we created a bin, delete it
-            if created:
-                b.delete()
-                return error
-        with transaction.atomic():
-            if not b2s.qc_no_rois:
-                b2s.skip = False
-                b2s.save()
-                self.dataset.bins.add(b2s)
+        if i not in self.instruments:
+            version = bin.pid.schema_version
+            instrument, created = Instrument.objects.get_or_create(number=i, defaults={
+                'version': version
+            })
+            self.instruments[i] = instrument
+        return self.instruments[i]
+    def add_to_dataset(self, bin_ids):
+        # one insert into the dataset/bin table, skipping bins already in the dataset.
+        # returns the ids of the bins that were not already in it
+        DatasetBin = Bin.datasets.through
+        linked = set(DatasetBin.objects.filter(dataset_id=self.dataset.id, bin_id__in=bin_ids).values_list('bin_id', flat=True))
+        new_ids = [bin_id for bin_id in bin_ids if bin_id not in linked]
+        DatasetBin.objects.bulk_create([
+            DatasetBin(bin_id=bin_id, dataset_id=self.dataset.id) for bin_id in new_ids
+        ], ignore_conflicts=True)
+        return new_ids
+    def summaries(self, bins, pool=None):
+        # bin summaries in the same order as bins, computed in the pool's worker processes if given
+        if pool is None:
+            return map(summarize_bin, bins)
+        return pool.imap(summarize_fileset, [fileset_basepath(bin) for bin in bins])
+    def add_bins(self, bins, pool=None, log_callback=do_nothing):
+        # accession a batch of ifcb bins using one query to find existing bins and bulk inserts.
+        # returns number of bins added, number of bad bins, and error messages keyed by pid
+        pids = [bin.lid for bin in bins]
+        with self.timer.stage('db_read', len(pids)):
+            existing_ids = dict(Bin.objects.filter(pid__in=pids).values_list('pid', 'id'))
+        new_bins = [] # (ifcb bin, unsaved Bin instance) pairs
+        for bin in bins:
+            pid = bin.lid
+            if pid in existing_ids:
+                continue
+            timestamp = bin.timestamp
+            b = Bin(pid=pid, timestamp=timestamp, sample_time=timestamp,
+                instrument=self.get_instrument(bin))
+            new_bins.append((bin, b))
+        # extract metrics, possibly in parallel
+        bins2save = []
+        bad_bins = 0
+        errors = {}
+        summaries = self.summaries([bin for bin, b in new_bins], pool)
+        for (bin, b), summary in zip(new_bins, summaries):
+            for stage, seconds in summary.timings.items():
+                self.timer.add(stage, seconds)
+            self.timer.add_item(b.pid, sum(summary.timings.values()))
+            if summary.error is not None:
+                errors[b.pid] = summary.error
+                log_callback('{} not adding bad bin'.format(b.pid))
+                bad_bins += 1
             else:
-                b2s.save()
+                bins2save.append(apply_bin_summary(b, summary))
+        with transaction.atomic():
+            # another accession may have created some of these bins since we checked,
+            # so ignore conflicts and look up the ids of everything we tried to insert
+            with self.timer.stage('db_write', len(bins2save)):
+                Bin.objects.bulk_create(bins2save, ignore_conflicts=True)
+                saved_ids = dict(Bin.objects.filter(pid__in=[b.pid for b in bins2save]).values_list('pid', 'id'))
+            for pid in saved_ids:
+                log_callback('{} saved'.format(pid))
+            # bins with no rois are bad, so every saved bin goes in the dataset
+            added_ids = list(saved_ids.values())
+            link_ids = list(existing_ids.values()) + added_ids
+            with self.timer.stage('dataset_link', len(link_ids)):
+                linked_ids = self.add_to_dataset(link_ids)
+            # only new bins, and bins new to the dataset, change any rollups
+            changed_ids = set(linked_ids).union(saved_ids.values())
+            with self.timer.stage('rollups', len(changed_ids)):
+                update_rollups(changed_ids)
+        return len(added_ids), bad_bins, errors
     def sync(self, progress_callback=do_nothing, log_callback=do_nothing):
         progress_callback(print_progress(progress('',0,0,0,{})))
         bins_added = 0
@@ -114,143 +290,133 @@ class Accession(object):
         scanner = self.scan()
         start_time = self.start_time()
         errors = {}
-        while True:
-            bins = list(islice(scanner, self.batch_size))
-            if not bins:
-                break
-            total_bins += len(bins)
-            # create instrument(s)
-            instruments = {} # keyed by instrument number
-            for bin in bins:
-                i = bin.pid.instrument
-                if not i in instruments:
-                    version = bin.pid.schema_version
-                    instrument, created = Instrument.objects.get_or_create(number=i, defaults={
-                        'version': version
-                    })
-                    instruments[i] = instrument
-            # create bins
-            then = time.time()
-            bins2save = []
-            for bin in bins:
-                pid = bin.lid
-                most_recent_bin_id = pid
-                log_callback('{} found'.format(pid))
-                instrument = instruments[bin.pid.instrument]
-                timestamp = bin.timestamp
-                if start_time is not None and bin.timestamp <= start_time:
-                    continue
-                b, created = Bin.objects.get_or_create(pid=pid, defaults={
-                    'timestamp': timestamp,
-                    'sample_time': timestamp,
-                    'instrument': instrument,
-                    'skip': True, # in case accession is interrupted
-                })
-                if not created:
-                    self.dataset.bins.add(b)
-                    continue
-                b2s, error = self.add_bin(bin, b)
-                if error is not None:
-                    b2s = None
-                    errors[b.pid] = error
-                if b2s is not None:
-                    bins2save.append(b2s)
-                elif created: # created, but bad! delete
-                    log_callback('{} deleting bad bin'.format(b.pid))
-                    b.delete()
-                    bad_bins += 1
-                else:
-                    log_callback('{} not adding bin'.format(b.pid))
-            with transaction.atomic():
-                for b in bins2save:
-                    b.skip = False # unskip because we're ready to save
-                    b.save()
-                    log_callback('{} saved'.format(b.pid))
-                # add to dataset, unless the bin has no rois
-                for b in bins2save:
-                    if b.qc_no_rois:
-                        continue
-                    self.dataset.bins.add(b)
-                    bins_added += 1
-            # done with the batch
-            status = progress_callback(progress(most_recent_bin_id, bins_added, total_bins, bad_bins, errors))
-            if not status: # cancel
-                break
+        pool = Pool(self.n_workers) if self.n_workers > 1 else None
+        try:
+            while True:
+                batch_started = time.perf_counter()
+                with self.timer.stage('scan'):
+                    bins = list(islice(scanner, self.batch_size))
+                if not bins:
+                    with self.timer.stage('manifest'):
+                        self.commit_manifests()
+                    break
+                total_bins += len(bins)
+                for bin in bins:
+                    most_recent_bin_id = bin.lid
+                    log_callback('{} found'.format(bin.lid))
+                excluded = []
+                if start_time is not None:
+                    excluded = [bin for bin in bins if bin.timestamp <= start_time]
+                    bins = [bin for bin in bins if bin.timestamp > start_time]
+                # record the batch in the manifests in the same transaction as its bins,
+                # so an interrupted sync resumes exactly where it left off. filesets that
+                # were filtered out or bad are left out, so later syncs try them again
+                with transaction.atomic():
+                    added, bad, batch_errors = self.add_bins(bins, pool, log_callback)
+                    excluded.extend(bin for bin in bins if bin.lid in batch_errors)
+                    with self.timer.stage('manifest'):
+                        self.exclude_from_manifests([fileset_basepath(bin) for bin in excluded])
+                        self.commit_manifests()
+                bins_added += added
+                bad_bins += bad
+                errors.update(batch_errors)
+                # done with the batch
+                self.timer.add_batch(len(bins), time.perf_counter() - batch_started)
+                status = progress_callback(progress(most_recent_bin_id, bins_added, total_bins, bad_bins, errors,
+                    self.timer.report()))
+                if not status: # cancel
+                    break
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
         # done.
-        prog = progress(most_recent_bin_id, bins_added, total_bins, bad_bins, errors)
+        prog = progress(most_recent_bin_id, bins_added, total_bins, bad_bins, errors, self.timer.report())
         progress_callback(prog)
         return prog
 
-    def add_bin(self, bin, b): # IFCB bin, Bin instance
-        # qaqc checks
-        qc_bad = check_bad(bin)
-        if qc_bad:
-            b.qc_bad = True
-            return b, 'malformed raw data'
-        no_rois = check_no_rois(bin)
-        if no_rois:
-            b.qc_bad = True
-            return b, 'zero ROIs'
-        # more error checking for setting attributes
-        try:
-            ml_analyzed = bin.ml_analyzed
-            if ml_analyzed <= 0:
-                b.qc_bad = True
-                return b, 'ml_analyzed <= 0'
-        except Exception as e:
-            b.qc_bad = True
-            return b, 'ml_analyzed: {}'.format(str(e))
-        # metadata
-        try:
-            headers = bin.hdr_attributes
-        except Exception as e:
-            b.qc_bad = True
-            return b, 'header: {}'.format(str(e))
-        b.metadata_json = json.dumps(headers)
-        #
-        # lat/lon/depth
-        latitude = headers.get('latitude') or headers.get('gpsLatitude')
-        longitude = headers.get('longitude') or headers.get('gpsLongitude')
-
-        depth = headers.get('depth')
-        if latitude is not None and longitude is not None:
-            try:
-                latitude = float(latitude)
-                longitude = float(longitude)
-            except TypeError:
-                latitude = None
-                longitude = None
-            try:
-                depth = float(depth)
-            except TypeError:
-                depth = None
-            if latitude is not None and longitude is not None:
-                b.set_location(longitude, latitude, depth)
-        #
-        b.qc_no_rois = check_no_rois(bin)
-        # metrics
-        try:
-            b.temperature = bin.temperature
-        except KeyError: # older data
-            b.temperature = 0
+    def chunks(self, chunk_size):
+        # partition the scanned filesets into lists of at most chunk_size basepaths, each from
+        # a single directory, for syncing separately. yields (number of filesets scanned but
+        # excluded by newest_only, chunk, manifest entries for the chunk's filesets). the
+        # chunks' filesets are not recorded in the manifests, see sync_filesets, and the
+        # excluded ones are left out of them
+        start_time = self.start_time()
+        chunk, entries = [], []
+        skipped = 0
+        for bin in self.scan():
+            # the fileset the scan has just yielded
+            entry = self.manifests[-1].take_pending()
+            if start_time is not None and bin.timestamp <= start_time:
+                self.manifests[-1].exclude([fileset_basepath(bin)])
+                skipped += 1
+                continue
+            basepath = fileset_basepath(bin)
+            if chunk and (len(chunk) >= chunk_size or os.path.dirname(chunk[0]) != os.path.dirname(basepath)):
+                yield skipped, chunk, entries
+                chunk, entries, skipped = [], [], 0
+            chunk.append(basepath)
+            entries.extend(entry)
+        if chunk or skipped:
+            yield skipped, chunk, entries
+    def sync_filesets(self, basepaths, manifest_entries=(), progress_callback=do_nothing, log_callback=do_nothing):
+        # accession a list of filesets in batches, without consulting the manifests. if the
+        # filesets' manifest entries are given, those of each batch's good bins are recorded
+        # in the same transaction as its bins, so an interrupted sync does not accession
+        # them again
+        entries = dict((e['path'], e) for e in manifest_entries)
+        bins_added = 0
+        total_bins = 0
+        bad_bins = 0
+        most_recent_bin_id = ''
+        errors = {}
+        pool = Pool(self.n_workers) if self.n_workers > 1 else None
         try:
-            b.humidity = bin.humidity
-        except KeyError: # older data
-            b.humidity = 0
-        b.size = bin.fileset.getsize() # assumes FilesetBin
-        b.ml_analyzed = ml_analyzed
-        b.look_time = bin.look_time
-        b.run_time = bin.run_time
-        b.n_triggers = bin.n_triggers
-        if bin.pid.schema_version == SCHEMA_VERSION_1:
-            ii = InfilledImages(bin)
-            b.n_images = len(ii)
-        else:
-            b.n_images = len(bin.images)
-        b.concentration = b.n_images / ml_analyzed
-        if b.concentration < 0: # metadata is bogus!
-            return b, 'rois/ml is < 0'
-        return b, None # defer save
+            for i in range(0, len(basepaths), self.batch_size):
+                batch_started = time.perf_counter()
+                batch = basepaths[i:i+self.batch_size]
+                bins = [FilesetBin(Fileset(bp)) for bp in batch]
+                with transaction.atomic():
+                    added, bad, batch_errors = self.add_bins(bins, pool, log_callback)
+                    with self.timer.stage('manifest'):
+                        Manifest.record([entries[bp] for bp, bin in zip(batch, bins)
+                            if bp in entries and bin.lid not in batch_errors])
+                self.timer.add_batch(len(bins), time.perf_counter() - batch_started)
+                total_bins += len(bins)
+                bins_added += added
+                bad_bins += bad
+                errors.update(batch_errors)
+                most_recent_bin_id = bins[-1].lid
+                status = progress_callback(progress(most_recent_bin_id, bins_added, total_bins, bad_bins, errors,
+                    self.timer.report()))
+                if not status: # cancel
+                    break
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        return progress(most_recent_bin_id, bins_added, total_bins, bad_bins, errors, self.timer.report())
+
+def repair_half_created_bins(instrument_numbers=None, log_callback=do_nothing):
+    # delete bins left half-created by syncs that were interrupted before accession
+    # used bulk inserts, so that they are accessioned again. these are skipped, in no
+    # dataset and have no metrics. optionally only for the given instruments
+    half_created = Bin.objects.filter(skip=True, datasets__isnull=True, ml_analyzed=FILL_VALUE)
+    if instrument_numbers:
+        half_created = half_created.filter(instrument__number__in=instrument_numbers)
+    pids = list(half_created.values_list('pid', flat=True))
+    if not pids:
+        return 0
+    instrument_ids = set(half_created.values_list('instrument_id', flat=True))
+    ranges = week_ranges(half_created.values_list('sample_time', flat=True))
+    with transaction.atomic():
+        Bin.objects.filter(pid__in=pids).delete()
+        Manifest.forget(pids)
+        # they were counted as skipped bins of their instruments
+        rebuild_rollups(dataset_ids=[], instrument_ids=instrument_ids, ranges=ranges)
+        rebuild_summaries(dataset_ids=[], instrument_ids=instrument_ids)
+    log_callback('repaired {} half-created bins'.format(len(pids)))
+    return len(pids)
 
 def import_progress(bin_id, n_modded, errors, done=False):
     #print(bin_id, n_modded, errors, error_message, done) # FIXME debug
@@ -261,8 +427,45 @@ def import_progress(bin_id, n_modded, errors, done=False):
         'done': done,
     }
 
+# rows of metadata applied per transaction and progress report
+IMPORT_CHUNK_SIZE = 1000
+# rows of a metadata CSV file read into memory at a time
+IMPORT_CSV_CHUNK_SIZE = 20000
+
+COMMENT_MAX_LENGTH = 8192
+
+def import_metadata_csv(path, progress_callback=do_nothing, chunksize=IMPORT_CSV_CHUNK_SIZE):
+    # imports a metadata CSV file without reading all of it into memory
+    with pd.read_csv(path, chunksize=chunksize) as reader:
+        return import_metadata(reader, progress_callback=progress_callback)
+
 def import_metadata(metadata_dataframe, progress_callback=do_nothing):
-    df = metadata_dataframe.copy()
+    # metadata_dataframe is a DataFrame or an iterable of them, such as the chunks
+    # read_csv returns when given a chunksize, which are imported one at a time
+    if isinstance(metadata_dataframe, pd.DataFrame):
+        dataframes = [metadata_dataframe]
+    else:
+        dataframes = metadata_dataframe
+
+    n_modded = 0
+    errors = []
+    pid = ''
+
+    for df in dataframes:
+        n_modded, pid, cancelled = _import_metadata_dataframe(df, n_modded, errors, progress_callback)
+        if cancelled:
+            break
+
+    progress = import_progress(pid or '', n_modded, errors, True)
+
+    progress_callback(progress)
+
+    return progress
+
+def _import_metadata_dataframe(df, n_modded, errors, progress_callback):
+    # imports one DataFrame, appending to errors and adding to the running count of modified
+    # rows. returns that count, the last pid seen, and whether the import was cancelled
+    df = df.copy()
 
     BIN_ID_COLUMNS = ['id','pid','lid','bin','bin_id','sample','sample_id','filename']
     LAT_COLUMNS = ['latitude','lat','y','gpsLatitude']
@@ -287,16 +490,6 @@ def import_metadata(metadata_dataframe, progress_callback=do_nothing):
                 return possible
         return None
 
-    def get_cell(named_tup, key):
-        val = getattr(named_tup, key)
-        try:
-            if pd.isnull(val):
-                return None
-            else:
-                return val
-        except TypeError:
-            return val
-
     df.columns = [s.lower() for s in df.columns]
 
     pid_col = get_column(df, BIN_ID_COLUMNS)
@@ -331,238 +524,374 @@ def import_metadata(metadata_dataframe, progress_callback=do_nothing):
         if c.startswith('tag'):
             tag_cols.append(c)
 
-    n_modded = 0
-    progress_batch_size = 50
-
-    b = None
-    errors = []
+    # validate and normalize each column, without touching the database. for each
+    # column, values are None where there is nothing to set, and errors are None
+    # where the value is valid
+
+    def cells(col):
+        # column values with missing values as None
+        return df[col].astype(object).where(df[col].notnull(), None)
+
+    def normalize(col, fn):
+        # apply fn to each non-missing cell, returning the results and any error messages
+        values, messages = [], []
+        for v in cells(col).tolist():
+            value, message = None, None
+            if v is not None:
+                try:
+                    value = fn(v)
+                except Exception as e:
+                    message = str(e)
+            values.append(value)
+            messages.append(message)
+        return pd.Series(values, index=df.index, dtype=object), pd.Series(messages, index=df.index, dtype=object)
+
+    def to_float(name):
+        def fn(v):
+            try:
+                return float(v)
+            except (TypeError, ValueError):
+                raise ValueError("Field '{}' expected a number but got {!r}.".format(name, v))
+        return fn
 
-    should_continue = True
+    def parse_cast(cast):
+        try:
+            cast_number = int(cast)
+            return str(cast_number)
+        except ValueError:
+            return str(cast)
+
+    def parse_ml_analyzed(ml_analyzed):
+        ml_analyzed = float(ml_analyzed)
+        if ml_analyzed == 0: # concentration is n_images / ml_analyzed
+            raise ZeroDivisionError('float division by zero')
+        return ml_analyzed
+
+    def parse_tag(cell):
+        tag = str(cell).strip()
+        if tag == '':
+            return None
+        normalized = normalize_tag_name(tag)
+        if not tag or not normalized:
+            raise ValueError('blank tag name "{}"'.format(tag))
+        if re.match(r'^[0-9]+$',normalized):
+            raise ValueError('tag "{}" consists of digits'.format(tag))
+        return normalized
+
+    def parse_comment(body):
+        if len(str(body)) > COMMENT_MAX_LENGTH:
+            raise ValueError('comment is longer than {} characters'.format(COMMENT_MAX_LENGTH))
+        return str(body)
+
+    def parse_skip(skip):
+        if type(skip) is bool:
+            return skip
+        elif type(skip) is int and skip in [0,1]:
+            return bool(skip)
+        elif type(skip) is str:
+            if skip.lower() in SKIP_POSITIVE_VALUES:
+                return True
+            elif skip.lower() in SKIP_NEGATIVE_VALUES:
+                return False
+            return None
+        raise ValueError(
+            'skip value "{}" had unsupported type "{}"'.format(skip, type(skip).__name__))
 
-    for row in df.itertuples():
-        if not should_continue:
-            break
+    values = {} # normalized values keyed by Bin field
+    error_columns = [] # error messages, in the order the checks have always been made
 
-        try:
-            pid = get_cell(row, pid_col)
-            if pid is None:
-                raise ValueError('bin id must be specified')
+    pids, _ = normalize(pid_col, str)
 
+    if ts_col is not None:
+        ts_cells = cells(ts_col)
+        ts = pd.to_datetime(ts_cells, utc=True, errors='coerce', format='mixed')
+        ts_errors = pd.Series([None] * len(df), index=df.index, dtype=object)
+        for i in ts.index[ts.isnull() & ts_cells.notnull()]:
+            # parse failures one at a time to report why, ignoring values that parse to NaT
             try:
-                b = Bin.objects.get(pid=pid)
-            except Bin.DoesNotExist:
-                raise KeyError('Bin {} not found'.format(pid))
-
-            # spatiotemporal metadata
-
-            if ts_col is not None:
-                ts_str = get_cell(row, ts_col)
-                if ts_str is not None:
-                    ts = pd.to_datetime(ts_str, utc=True)
-                    if not pd.isnull(ts):
-                        b.sample_time = ts
-           
-            if lat_col is not None and lon_col is not None:
-                lat = get_cell(row, lat_col)
-                lon = get_cell(row, lon_col)
-                if lat is not None and lon is not None:
-                    b.set_location(lon, lat)
-
-            if depth_col is not None:
-                depth = get_cell(row, depth_col)
-                if depth is not None:
-                    b.depth = depth
-
-            # sample type
-
-            if sample_type_col is not None:
-                sample_type = get_cell(row, sample_type_col)
-                if sample_type is not None:
-                    b.sample_type = sample_type
-
-            # cruise / cast / niskin
-
-            if cruise_col is not None:
-                cruise = get_cell(row, cruise_col)
-                if cruise is not None:
-                    b.cruise = str(cruise)
-
-            if cast_col is not None:
-                cast = get_cell(row, cast_col)
-                if cast is not None:
-                    try:
-                        cast_number = int(cast)
-                        b.cast = str(cast_number)
-                    except ValueError:
-                        b.cast = str(cast)
-
-            if niskin_col is not None:
-                niskin = get_cell(row, niskin_col)
-                if niskin is not None:
-                    b.niskin = int(niskin)
-
-            # ml_analyzed
-
-            if ma_col is not None:
-                ml_analyzed = get_cell(row, ma_col)
-                if ml_analyzed is not None:
-                    b.set_ml_analyzed(ml_analyzed)
-
-            # tags and comments
-
-            if tag_cols:
-                for c in tag_cols:
-                    cell = get_cell(row, c)
-                    if cell is None:
-                        continue
+                pd.to_datetime(ts_cells[i], utc=True)
+            except Exception as e:
+                ts_errors[i] = str(e)
+        values['sample_time'] = ts.astype(object).where(ts.notnull(), None)
+        error_columns.append(ts_errors)
+
+    if lat_col is not None and lon_col is not None:
+        lats, lat_errors = normalize(lat_col, to_float('latitude'))
+        lons, lon_errors = normalize(lon_col, to_float('longitude'))
+        values['location'] = pd.Series([Point(lon, lat, srid=SRID) if lat is not None and lon is not None else None
+            for lat, lon in zip(lats, lons)], index=df.index, dtype=object)
+        error_columns += [lat_errors, lon_errors]
+
+    if depth_col is not None:
+        values['depth'], depth_errors = normalize(depth_col, to_float('depth'))
+        error_columns.append(depth_errors)
+
+    if sample_type_col is not None:
+        values['sample_type'] = cells(sample_type_col)
+
+    if cruise_col is not None:
+        values['cruise'], _ = normalize(cruise_col, str)
+
+    if cast_col is not None:
+        values['cast'], cast_errors = normalize(cast_col, parse_cast)
+        error_columns.append(cast_errors)
+
+    if niskin_col is not None:
+        values['niskin'], niskin_errors = normalize(niskin_col, int)
+        error_columns.append(niskin_errors)
+
+    if ma_col is not None:
+        values['ml_analyzed'], ma_errors = normalize(ma_col, parse_ml_analyzed)
+        error_columns.append(ma_errors)
+
+    tags = [] # normalized tag names, one series per tag column
+    for c in tag_cols:
+        tag_values, tag_errors = normalize(c, parse_tag)
+        tags.append(tag_values)
+        error_columns.append(tag_errors)
+
+    if comments_col is not None:
+        comments, comment_errors = normalize(comments_col, parse_comment)
+        error_columns.append(comment_errors)
+    else:
+        comments = pd.Series([None] * len(df), index=df.index, dtype=object)
 
-                    tag = str(get_cell(row, c)).strip()
-                    if tag == '':
-                        continue
+    if skip_col is not None:
+        values['skip'], skip_errors = normalize(skip_col, parse_skip)
+        error_columns.append(skip_errors)
 
-                    normalized = normalize_tag_name(tag)
-                    if not tag or not normalized:
-                        raise ValueError('blank tag name "{}"'.format(tag))
-                    if re.match(r'^[0-9]+$',normalized):
-                        raise ValueError('tag "{}" consists of digits'.format(tag))
-                    b.add_tag(normalized)
-
-            if comments_col is not None:
-                body = get_cell(row, comments_col)
-                if body is not None:
-                    b.add_comment(body, skip_duplicates=True)
-
-            # skip flag
-
-            if skip_col is not None:
-                skip = get_cell(row, skip_col)
-                if skip is None:
-                    pass
-                elif type(skip) is bool:
-                    b.skip = skip
-                elif type(skip) is int and skip in [0,1]:
-                    b.skip = bool(skip)
-                elif type(skip) is str:
-                    if skip.lower() in SKIP_POSITIVE_VALUES:
-                        b.skip = True
-                    elif skip.lower() in SKIP_NEGATIVE_VALUES:
-                        b.skip = False
-                else:
-                    raise ValueError(
-                        'skip value "{}" had unsupported type "{}"'.format(skip, type(skip).__name__))
+    # the first error in each row
+    row_errors = pd.Series([None] * len(df), index=df.index, dtype=object)
+    for messages in error_columns:
+        for i, message in messages.items():
+            if message is not None and row_errors[i] is None:
+                row_errors[i] = message
 
-            n_modded += 1
-            b.save()
-            
-            if n_modded % progress_batch_size == 0:
-                should_continue = progress_callback(import_progress(b.pid, n_modded, errors))
-
-        except Exception as e:
-            errors.append({
-                'row': row.Index + 2, # why 2 and not 1?
-                'message': str(e),
-                })
-
-    if b is not None:
-        progress = import_progress(b.pid, n_modded, errors, True)
-    else:
-        progress = import_progress('', n_modded, errors, True)
+    update_fields = list(values.keys())
+    if 'ml_analyzed' in update_fields:
+        update_fields.append('concentration')
 
-    progress_callback(progress)
+    # now apply the rows a chunk at a time, with a few queries per chunk
 
-    return progress
+    pid = ''
 
-def export_metadata(ds, bins):
-    # Maximum number of bins this export can return. The limit is relatively arbitrary, and in place to prevent runaway
-    #   queries returning lots of data when no search parameters are defined
-    max_results = 500_000
+    for chunk_start in range(0, len(df), IMPORT_CHUNK_SIZE):
+        chunk = df.index[chunk_start:chunk_start + IMPORT_CHUNK_SIZE]
+        chunk_pids = set(p for p in pids[chunk] if p is not None)
+        bins = Bin.objects.filter(pid__in=chunk_pids).in_bulk(field_name='pid')
+
+        modified = {} # Bins to update, keyed by pid
+        old_sample_times = [] # of modified bins, whose rollups need recomputing
+        new_tags = [] # (Bin, tag name)
+        new_comments = [] # (Bin, comment)
+
+        for i in chunk:
+            pid = pids[i]
+            if pid is None:
+                message = 'bin id must be specified'
+            elif pid not in bins:
+                message = 'Bin {} not found'.format(pid)
+            else:
+                message = row_errors[i]
+            if message is not None:
+                errors.append({
+                    'row': i + 2, # why 2 and not 1?
+                    'message': message,
+                    })
+                continue
+            b = bins[pid]
+            if pid not in modified:
+                old_sample_times.append(b.sample_time)
+            for field, column in values.items():
+                value = column[i]
+                if value is None:
+                    continue
+                if field == 'ml_analyzed':
+                    b.set_ml_analyzed(value)
+                else:
+                    setattr(b, field, value)
+            for tag_values in tags:
+                if tag_values[i] is not None:
+                    new_tags.append((b, tag_values[i]))
+            if comments[i] is not None:
+                new_comments.append((b, comments[i]))
+            modified[pid] = b
+            n_modded += 1
 
+        with transaction.atomic():
+            if update_fields and modified:
+                Bin.objects.bulk_update(modified.values(), update_fields)
+                if ROLLUP_FIELDS.intersection(update_fields):
+                    update_rollups([b.id for b in modified.values()], old_sample_times)
+            add_tags(new_tags)
+            add_comments(new_comments)
+
+        should_continue = progress_callback(import_progress(pid, n_modded, errors))
+        if should_continue is False: # cancel
+            return n_modded, pid, True
+
+    return n_modded, pid, False
+
+def add_tags(bin_tags):
+    # bulk version of Bin.add_tag for (Bin, normalized tag name) pairs, skipping tags bins already have
+    if not bin_tags:
+        return
+    names = set(name for _, name in bin_tags)
+    tag_ids = {}
+    for tag_id, name in Tag.objects.filter(name__in=names).order_by('id').values_list('id', 'name'):
+        tag_ids.setdefault(name, tag_id)
+    missing = names - set(tag_ids)
+    if missing:
+        # another import or Bin.add_tag may create the same tags at the same time
+        Tag.objects.bulk_create([Tag(name=name) for name in missing], ignore_conflicts=True)
+        for tag_id, name in Tag.objects.filter(name__in=missing).order_by('id').values_list('id', 'name'):
+            tag_ids.setdefault(name, tag_id)
+    bin_ids = set(b.id for b, _ in bin_tags)
+    existing = set(TagEvent.objects.filter(bin_id__in=bin_ids, tag_id__in=tag_ids.values()).values_list('bin_id', 'tag_id'))
+    events = []
+    for b, name in bin_tags:
+        key = (b.id, tag_ids[name])
+        if key not in existing:
+            existing.add(key)
+            events.append(TagEvent(bin_id=b.id, tag_id=tag_ids[name]))
+    TagEvent.objects.bulk_create(events)
+
+def add_comments(bin_comments):
+    # bulk version of Bin.add_comment(skip_duplicates=True) for (Bin, content) pairs, with no user
+    if not bin_comments:
+        return
+    bin_ids = set(b.id for b, _ in bin_comments)
+    contents = set(content for _, content in bin_comments)
+    existing = set(Comment.objects.filter(bin_id__in=bin_ids, content__in=contents, user__isnull=True).values_list('bin_id', 'content'))
+    comments = []
+    for b, content in bin_comments:
+        if (b.id, content) not in existing:
+            existing.add((b.id, content))
+            comments.append(Comment(bin_id=b.id, content=content))
+    Comment.objects.bulk_create(comments)
+
+# bins fetched from the database at a time when exporting metadata
+EXPORT_CHUNK_SIZE = 2000
+
+TRIGGER_SELECTION_KEY = 'PMTtriggerSelection_DAQ_MCConly'
+
+# column types of Parquet metadata exports. Parquet only keeps dictionary encoding
+# for strings, so instrument numbers are plain integers
+METADATA_PARQUET_TYPES = {
+    'dataset': pa.dictionary(pa.int32(), pa.string()),
+    'pid': pa.string(),
+    'sample_time': pa.timestamp('us', tz='UTC'),
+    'ifcb': pa.int32(),
+    'ml_analyzed': pa.float64(),
+    'latitude': pa.float64(),
+    'longitude': pa.float64(),
+    'depth': pa.float64(),
+    'cruise': pa.string(),
+    'cast': pa.string(),
+    'niskin': pa.int64(),
+    'sample_type': pa.dictionary(pa.int32(), pa.string()),
+    'n_images': pa.int64(),
+    'tags': pa.list_(pa.string()),
+    'comment_summary': pa.string(),
+    'trigger_selection': pa.string(),
+    'skip': pa.bool_(),
+}
+
+def export_metadata_rows(ds, bins, chunk_size=EXPORT_CHUNK_SIZE, tag_columns=True):
+    # returns the columns of a metadata export and a generator of its rows, one per bin
+    # in pid order. tags and comments are aggregated in the database, and the rows are read
+    # through a server-side cursor, so exports of any size can be written as they are read.
+    # tags are in columns tag1, tag2, etc., or if tag_columns is False, a list in one tags column
     name = ds.name if ds else ''
     dataset_location = ds.location if ds else None
     dataset_depth = ds.depth if ds else None
-    bqs = bins
-
-    qs = bqs.values('id','pid','sample_time','location','ml_analyzed',
-        'cruise','cast','niskin','depth', 'instrument__number', 'skip',
-        'sample_type', 'n_images', 'tags__name').order_by('pid','tags__name')
-
-    # fetch all tags and compute number of tag columns
-    tags_by_id = defaultdict(list)
-    n_tag_cols = 0
-    for item in qs:
-        tag_name = item['tags__name']
-        if tag_name:
-            id = item['id']
-            tags = tags_by_id[id]
-            tags.append(tag_name)
-            if len(tags) > n_tag_cols:
-                n_tag_cols = len(tags)
-    # fetch all comment summaries
-    comment_summary_by_id = \
-        dict(bqs.filter(comments__isnull=False).values_list('id') \
-             .annotate(comment_summary=StringAgg('comments__content', delimiter='; ', ordering='comments__timestamp')))
-    # fetch selected metadata fields
-    # PMTtriggerSelection_DAQ_MCConly
-    trigger_selection_key = 'PMTtriggerSelection_DAQ_MCConly'
-    id2md = bqs.filter(metadata_json__contains=trigger_selection_key).values_list('id', 'metadata_json')
-    trigger_selection_by_id = dict([(id, json.loads(md).get(trigger_selection_key)) for id, md in id2md])
-    # now construct the dataframe
-    r = defaultdict(list)
-
-    # Only add the name column if dataset criteria was provided
-    if name:
-        r.update({'dataset': name})
-
-    # fast way to remove duplicates
-    prev_pid = None
 
-    # The "all()" is required to make sure there's a LIMIT statement added the query, rather than pulling back all
-    #   records and then taking part of the list
-    qs = qs.all()[:max_results]
+    tag_events = TagEvent.objects.filter(bin=OuterRef('pk')).order_by()
+    if tag_columns:
+        # the number of tag columns is the most tags any bin has. this counts the tag
+        # events of the exported bins, which are few, rather than visiting every bin
+        n_tags = TagEvent.objects.filter(bin__in=bins.order_by().values('pk')).order_by() \
+            .values('bin').annotate(n=Count('*'))
+        n_tag_cols = n_tags.aggregate(Max('n'))['n__max'] or 0
+
+    comment_summary = Comment.objects.filter(bin=OuterRef('pk')).order_by().values('bin') \
+        .annotate(summary=StringAgg('content', delimiter='; ', ordering='timestamp')).values('summary')
+    trigger_selection = Case(When(metadata_json__contains=TRIGGER_SELECTION_KEY,
+        then=KeyTextTransform(TRIGGER_SELECTION_KEY, Cast('metadata_json', JSONField()))))
+
+    qs = bins.annotate(
+        location_x=Func('location', function='ST_X', output_field=FloatField()),
+        location_y=Func('location', function='ST_Y', output_field=FloatField()),
+        tag_names=ArraySubquery(tag_events.order_by('tag__name').values('tag__name')),
+        comment_summary=Subquery(comment_summary),
+        trigger_selection=trigger_selection,
+    ).order_by('pid').values_list('pid', 'sample_time', 'instrument__number', 'ml_analyzed',
+        'location_y', 'location_x', 'depth', 'cruise', 'cast', 'niskin', 'sample_type', 'n_images',
+        'tag_names', 'comment_summary', 'trigger_selection', 'skip')
+
+    columns = ['pid', 'sample_time', 'ifcb', 'ml_analyzed', 'latitude', 'longitude', 'depth',
+        'cruise', 'cast', 'niskin', 'sample_type', 'n_images']
+    if tag_columns:
+        columns += ['tag{}'.format(i+1) for i in range(n_tag_cols)]
+    else:
+        columns.append('tags')
+    columns += ['comment_summary', 'trigger_selection', 'skip']
+    # only add the name column if dataset criteria was provided
+    if name:
+        columns.insert(0, 'dataset')
+
+    def rows():
+        for pid, sample_time, ifcb, ml_analyzed, latitude, longitude, depth, cruise, cast, niskin, \
+                sample_type, n_images, tag_names, comment_summary, trigger_selection, skip \
+                in qs.iterator(chunk_size=chunk_size):
+            if latitude is None and dataset_location is not None:
+                latitude, longitude = dataset_location.y, dataset_location.x
+            if depth is None:
+                depth = dataset_depth
+            row = [name] if name else []
+            row += [pid, sample_time, ifcb, ml_analyzed, latitude, longitude, depth,
+                cruise, cast, niskin, sample_type, n_images]
+            if tag_columns:
+                row += tag_names + [''] * (n_tag_cols - len(tag_names))
+            else:
+                row.append(tag_names)
+            row += [comment_summary or '', trigger_selection or '', 1 if skip else 0]
+            yield row
 
-    for item in qs:
-        if item['pid'] == prev_pid:
-            continue
-        prev_pid = item['pid']
+    return columns, rows()
 
-        def add(field, rename=None):
-            if rename is not None:
-                r[rename].append(item[field])
-            else:
-                r[field].append(item[field])
-
-        add('pid')
-        add('sample_time')
-        add('instrument__number', rename='ifcb')
-        add('ml_analyzed')
-        if item['location'] is not None:
-            r['latitude'].append(item['location'].y)
-            r['longitude'].append(item['location'].x)
-        elif dataset_location is not None:
-            r['latitude'].append(dataset_location.y)
-            r['longitude'].append(dataset_location.x)
-        else:
-            r['latitude'].append(np.nan)
-            r['longitude'].append(np.nan)
-        if item['depth'] is not None:
-            add('depth')
-        elif dataset_depth is not None:
-            r['depth'].append(dataset_depth)
-        else:
-            r['depth'].append(np.nan)
-        add('cruise')
-        add('cast')
-        add('niskin')
-        add('sample_type')
-        add('n_images')
-        tag_names = tags_by_id[item['id']]
-        for i in range(n_tag_cols):
-            v = tag_names[i] if i < len(tag_names) else ''
-            r[f'tag{i+1}'].append(v)
-        r['comment_summary'].append(comment_summary_by_id.get(item['id'], ''))
-        r['trigger_selection'].append(trigger_selection_by_id.get(item['id'], ''))
-        r['skip'].append(1 if item['skip'] else 0)
-
-    df = pd.DataFrame(r)
-
-    return df
\ No newline at end of file
+def export_metadata(ds, bins):
+    columns, rows = export_metadata_rows(ds, bins)
+
+    return pd.DataFrame(list(rows), columns=columns)
+
+def export_metadata_csv(ds, bins, chunk_size=EXPORT_CHUNK_SIZE):
+    # generates a metadata export as CSV text, a chunk of rows at a time
+    columns, rows = export_metadata_rows(ds, bins, chunk_size)
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    writer.writerow(columns)
+    yield buf.getvalue() # so the response starts right away
+    buf.seek(0)
+    buf.truncate()
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % chunk_size == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def export_metadata_parquet(ds, bins, chunk_size=EXPORT_CHUNK_SIZE):
+    # generates a metadata export as a Parquet file, a row group per chunk of rows
+    columns, rows = export_metadata_rows(ds, bins, chunk_size, tag_columns=False)
+    schema = pa.schema([(c, METADATA_PARQUET_TYPES[c]) for c in columns])
+    def batches():
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return
+            batch = dict(zip(columns, map(list, zip(*chunk))))
+            batch['skip'] = [skip == 1 for skip in batch['skip']]
+            yield batch
+    return stream_parquet(schema, batches())
@@ -0,0 +1,296 @@
+import os
+import time
+
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+from ifcb.data.adc import SCHEMA, SCHEMA_VERSION_1, SCHEMA_VERSION_2, schema_names
+from ifcb.data.files import Fileset, FilesetBin
+from ifcb.data.transfer.deposit import fileset_destination_dir
+
+from django.db import connection
+
+from .models import Bin, Dataset, DataDirectory, Instrument, Tag, Timeline, bin_query
+from .accession import Accession, import_metadata, apply_bin_summary
+from .summary import summarize_bin
+from .qaqc import check_bad
+from .rollups import rebuild_rollups, rebuild_summaries
+
+# synthetic bins use instruments and dates that should not collide with real data
+BENCHMARK_INSTRUMENTS = {
+    SCHEMA_VERSION_1: 9,
+    SCHEMA_VERSION_2: 999,
+}
+BENCHMARK_START = datetime(2000, 1, 1)
+BENCHMARK_TAG = 'benchmark'
+
+# kinds of deliberately bad bins, and the accession error each should produce
+BAD_KINDS = {
+    'malformed_adc': 'malformed raw data',
+    'empty_roi': 'zero ROIs',
+    'zero_run_time': 'ml_analyzed <= 0',
+}
+
+def bin_lid(schema_version, timestamp):
+    instrument = BENCHMARK_INSTRUMENTS[schema_version]
+    if schema_version == SCHEMA_VERSION_1:
+        return 'IFCB{}_{}'.format(instrument, timestamp.strftime('%Y_%j_%H%M%S'))
+    return 'D{}_IFCB{:03d}'.format(timestamp.strftime('%Y%m%dT%H%M%S'), instrument)
+
+def write_fileset(basepath, schema_version, n_rois, roi_size=(48, 64), bad=None, rng=None):
+    """
+    Writes a synthetic .hdr/.adc/.roi fileset. ROIs are random grayscale images whose
+    height and width vary around roi_size, and about one trigger in ten has no ROI.
+    bad is None or one of the keys of BAD_KINDS.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    schema = SCHEMA[schema_version]
+    n_columns = len(schema_names(schema))
+    rows = []
+    rois = []
+    start_byte = 0
+    run_time = 1200.0
+    inhibit_time = 0.0
+    trigger = 0
+    while len(rois) < n_rois:
+        trigger += 1
+        row = rng.uniform(0, 1, n_columns).round(6).tolist()
+        row[schema.TRIGGER] = trigger
+        if rng.uniform() < 0.1: # trigger without a ROI
+            h, w = 0, 0
+        else:
+            h = max(1, int(rng.normal(roi_size[0], roi_size[0] / 4)))
+            w = max(1, int(rng.normal(roi_size[1], roi_size[1] / 4)))
+            rois.append(rng.integers(0, 256, h * w, dtype=np.uint8).tobytes())
+        row[schema.ROI_X] = int(rng.integers(0, 1000))
+        row[schema.ROI_Y] = int(rng.integers(0, 1000))
+        row[schema.ROI_HEIGHT] = h
+        row[schema.ROI_WIDTH] = w
+        row[schema.START_BYTE] = start_byte
+        start_byte += h * w
+        inhibit_time += 0.01
+        rows.append(row)
+    if bad == 'zero_run_time':
+        run_time, inhibit_time = 0.0, 0.0
+    with open(basepath + '.hdr', 'w') as fout:
+        fout.write('softwareVersion: Imaging FlowCytobot Acquire 3.0\n')
+        fout.write('temperature: {:.3f}\n'.format(rng.uniform(10, 25)))
+        fout.write('humidity: {:.3f}\n'.format(rng.uniform(20, 60)))
+        fout.write('runTime: {:.3f}\n'.format(run_time))
+        fout.write('inhibitTime: {:.3f}\n'.format(inhibit_time))
+    with open(basepath + '.adc', 'w') as fout:
+        for row in rows:
+            fout.write(','.join(str(v) for v in row) + '\n')
+        if bad == 'malformed_adc':
+            fout.write('this is not, ADC data\n')
+    with open(basepath + '.roi', 'wb') as fout:
+        if bad != 'empty_roi':
+            for roi in rois:
+                fout.write(roi)
+
+def generate_filesets(root, n_bins, schema_versions=(SCHEMA_VERSION_1, SCHEMA_VERSION_2),
+        n_rois=500, roi_size=(48, 64), bad_fraction=0.02, seed=0):
+    """
+    Writes n_bins synthetic filesets under root, in the year/day directories bins are
+    deposited in, alternating between schema versions and spaced 20 minutes apart.
+    Returns the list of fileset basepaths and a dict of the bad ones' expected errors.
+    """
+    rng = np.random.default_rng(seed)
+    basepaths = []
+    expected_errors = {}
+    bad_kinds = sorted(BAD_KINDS)
+    for i in range(n_bins):
+        schema_version = schema_versions[i % len(schema_versions)]
+        lid = bin_lid(schema_version, BENCHMARK_START + timedelta(minutes=20 * i))
+        dirpath = os.path.join(root, fileset_destination_dir(lid))
+        os.makedirs(dirpath, exist_ok=True)
+        bad = None
+        if rng.uniform() < bad_fraction:
+            bad = bad_kinds[len(expected_errors) % len(bad_kinds)]
+            expected_errors[lid] = BAD_KINDS[bad]
+        rois = max(1, int(rng.normal(n_rois, n_rois / 4)))
+        basepath = os.path.join(dirpath, lid)
+        write_fileset(basepath, schema_version, rois, roi_size, bad, rng)
+        basepaths.append(basepath)
+    return basepaths, expected_errors
+
+def metadata_dataframe(pids, seed=0):
+    # metadata of the kind users upload, for timing import_metadata
+    rng = np.random.default_rng(seed)
+    n = len(pids)
+    return pd.DataFrame({
+        'pid': pids,
+        'latitude': rng.uniform(40, 42, n).round(5),
+        'longitude': rng.uniform(-71, -69, n).round(5),
+        'depth': rng.uniform(0, 10, n).round(1),
+        'cruise': ['BENCH{:02d}'.format(i // 100) for i in range(n)],
+        'sample_type': 'underway',
+        'tag1': BENCHMARK_TAG,
+        'comment': 'benchmark',
+    })
+
+def add_bin(bin, b):
+    # the per-bin work of accession outside of the database, as single-bin accession
+    # used to do it. returns the error message of a bad bin, or None
+    summary = summarize_bin(bin)
+    if summary.error is None:
+        apply_bin_summary(b, summary)
+    return summary.error
+
+def per_second(n, seconds):
+    return n / seconds if seconds > 0 else None
+
+def run_benchmark(root, dataset_name, n_workers=1, batch_size=100, log_callback=print):
+    """
+    Accessions the filesets under root into a new dataset and times each stage.
+    Returns the results as a JSON-serializable dict. Deletes everything it creates.
+    """
+    if Dataset.objects.filter(name=dataset_name).exists():
+        raise ValueError('dataset {} already exists'.format(dataset_name))
+    instrument_numbers = list(BENCHMARK_INSTRUMENTS.values())
+    existing_instruments = _check_benchmark_instruments(instrument_numbers)
+    ds = Dataset.objects.create(name=dataset_name, title='accession benchmark')
+    DataDirectory.objects.create(dataset=ds, path=root, kind=DataDirectory.RAW)
+    results = {}
+    try:
+        # bin summaries and qc checks, outside of the database
+        basepaths = list(_list_basepaths(root))
+        then = time.time()
+        summaries = [summarize_bin(FilesetBin(Fileset(bp))) for bp in basepaths]
+        elapsed = time.time() - then
+        results['summarize_bin'] = { 'bins': len(basepaths), 'seconds': elapsed,
+            'bins_per_second': per_second(len(basepaths), elapsed) }
+        then = time.time()
+        for s in summaries:
+            check_bad(s)
+        elapsed = time.time() - then
+        results['check_bad'] = { 'bins': len(summaries), 'seconds': elapsed,
+            'bins_per_second': per_second(len(summaries), elapsed) }
+        then = time.time()
+        for bp in basepaths:
+            add_bin(FilesetBin(Fileset(bp)), Bin())
+        elapsed = time.time() - then
+        results['add_bin'] = { 'bins': len(basepaths), 'seconds': elapsed,
+            'bins_per_second': per_second(len(basepaths), elapsed) }
+        # end-to-end sync
+        acc = Accession(ds, batch_size=batch_size, n_workers=n_workers, timing=True)
+        log_callback('syncing {} filesets'.format(len(basepaths)))
+        then = time.time()
+        prog = acc.sync(progress_callback=lambda p: True) # a falsy result would cancel the sync
+        elapsed = time.time() - then
+        results['sync'] = { 'bins': prog['total'], 'added': prog['added'], 'bad': prog['bad'],
+            'seconds': elapsed, 'bins_per_second': per_second(prog['total'], elapsed),
+            'timings': prog['timings'] }
+        # resync, which should find nothing new
+        then = time.time()
+        prog = Accession(ds, batch_size=batch_size, n_workers=n_workers).sync(progress_callback=lambda p: True)
+        elapsed = time.time() - then
+        results['resync'] = { 'bins': prog['total'], 'seconds': elapsed }
+        # metadata import
+        pids = list(ds.bins.values_list('pid', flat=True))
+        df = metadata_dataframe(pids)
+        log_callback('importing metadata for {} bins'.format(len(pids)))
+        then = time.time()
+        prog = import_metadata(df)
+        elapsed = time.time() - then
+        results['import_metadata'] = { 'rows': len(df), 'modified': prog['n_modded'],
+            'errors': len(prog['errors']), 'seconds': elapsed,
+            'rows_per_second': per_second(len(df), elapsed) }
+    finally:
+        _clean_up([ds], instrument_numbers, existing_instruments)
+    return results
+
+def _check_benchmark_instruments(instrument_numbers):
+    # returns the numbers of benchmark instruments that already exist
+    if Bin.objects.filter(instrument__number__in=instrument_numbers).exists():
+        raise ValueError('bins from benchmark instruments {} already exist'.format(instrument_numbers))
+    return set(Instrument.objects.filter(number__in=instrument_numbers).values_list('number', flat=True))
+
+def _clean_up(datasets, instrument_numbers, existing_instruments):
+    # deletes the benchmark's bins, datasets, and instruments it created
+    Bin.objects.filter(instrument__number__in=instrument_numbers).delete()
+    for ds in datasets:
+        ds.delete()
+    Instrument.objects.filter(number__in=instrument_numbers).exclude(number__in=existing_instruments).delete()
+    # rollups and summaries of instruments that existed before still count the deleted bins
+    instrument_ids = list(Instrument.objects.filter(number__in=existing_instruments).values_list('id', flat=True))
+    rebuild_rollups(dataset_ids=[], instrument_ids=instrument_ids)
+    rebuild_summaries(dataset_ids=[], instrument_ids=instrument_ids)
+    Tag.objects.filter(name=BENCHMARK_TAG, tagevent__isnull=True).delete()
+
+def latency_stats(seconds):
+    seconds = np.array(seconds)
+    return { 'n': len(seconds), 'median_ms': float(np.median(seconds) * 1000),
+        'p95_ms': float(np.percentile(seconds, 95) * 1000), 'max_ms': float(seconds.max() * 1000) }
+
+def run_navigation_benchmark(dataset_name, sizes, dataset_fraction=0.5, n_samples=200,
+        insert_batch_size=10000, seed=0, log_callback=print):
+    """
+    Times Timeline.adjacent_bins, which finds the previous and next bins, as the bin
+    table grows through each of the given sizes. Bins are inserted directly, 20 minutes
+    apart, and a fraction of them are put in a new dataset. At each size, random bins
+    are navigated from over all bins, over the dataset's bins (the datasets__name join
+    that bin_query makes for the dashboard's bin pages), and over the dataset's bins
+    from one instrument. Flat latencies across sizes mean the (sample_time, pid) index
+    is doing its job. Returns the results as a JSON-serializable dict. Deletes
+    everything it creates.
+    """
+    if Dataset.objects.filter(name=dataset_name).exists():
+        raise ValueError('dataset {} already exists'.format(dataset_name))
+    instrument_numbers = [BENCHMARK_INSTRUMENTS[SCHEMA_VERSION_2]]
+    existing_instruments = _check_benchmark_instruments(instrument_numbers)
+    ds = Dataset.objects.create(name=dataset_name, title='navigation benchmark')
+    instrument, _ = Instrument.objects.get_or_create(number=instrument_numbers[0],
+        defaults={ 'version': SCHEMA_VERSION_2 })
+    DatasetBin = Bin.datasets.through
+    rng = np.random.default_rng(seed)
+    start = BENCHMARK_START.replace(tzinfo=timezone.utc)
+    results = []
+    n = 0
+    try:
+        for size in sorted(sizes):
+            log_callback('inserting bins up to {}'.format(size))
+            then = time.time()
+            while n < size:
+                times = [start + timedelta(minutes=20 * i) for i in range(n, min(size, n + insert_batch_size))]
+                bins = Bin.objects.bulk_create([Bin(pid=bin_lid(SCHEMA_VERSION_2, t), timestamp=t, sample_time=t,
+                    instrument=instrument) for t in times])
+                DatasetBin.objects.bulk_create([DatasetBin(bin_id=b.id, dataset_id=ds.id)
+                    for b in bins if rng.uniform() < dataset_fraction])
+                n += len(times)
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE dashboard_bin')
+                cursor.execute('ANALYZE dashboard_bin_datasets')
+            insert_time = time.time() - then
+            cases = {
+                'all_bins': Bin.objects.filter(instrument=instrument),
+                'dataset': bin_query(dataset_name=ds.name),
+                'dataset_instrument': bin_query(dataset_name=ds.name, instrument_number=instrument.number),
+            }
+            result = { 'bins': n, 'dataset_bins': ds.bins.count(), 'insert_seconds': insert_time }
+            for case, bin_qs in cases.items():
+                timeline = Timeline(bin_qs)
+                ids = list(bin_qs.values_list('id', flat=True))
+                samples = rng.choice(ids, n_samples).tolist()
+                seconds = []
+                for b in Bin.objects.filter(id__in=samples):
+                    then = time.perf_counter()
+                    timeline.adjacent_bins(b)
+                    seconds.append(time.perf_counter() - then)
+                result[case] = latency_stats(seconds)
+            log_callback('{} bins: {}'.format(n, ', '.join('{} median {:.2f}ms'.format(case, result[case]['median_ms'])
+                for case in cases)))
+            results.append(result)
+    finally:
+        _clean_up([ds], instrument_numbers, existing_instruments)
+    return { 'dataset_fraction': dataset_fraction, 'samples': n_samples, 'sizes': results }
+
+def _list_basepaths(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.endswith('.adc'):
+                yield os.path.join(dirpath, name[:-4])
@@ -0,0 +1,85 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ifcb.data.adc import SCHEMA_VERSION_1, SCHEMA_VERSION_2
+
+from dashboard.benchmark import generate_filesets, run_benchmark
+
+SCHEMA_VERSIONS = {
+    'v1': SCHEMA_VERSION_1,
+    'v2': SCHEMA_VERSION_2,
+}
+
+class Command(BaseCommand):
+    help = 'time accession of synthetic filesets and report throughput as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--n_bins', type=int, default=200, help='number of synthetic bins')
+        parser.add_argument('-r', '--rois', type=int, default=500, help='mean number of ROIs per bin')
+        parser.add_argument('--roi_size', type=int, nargs=2, default=[48, 64], metavar=('HEIGHT', 'WIDTH'), help='mean ROI size in pixels')
+        parser.add_argument('-s', '--schema', type=str, nargs='+', default=['v1', 'v2'], choices=sorted(SCHEMA_VERSIONS), help='schema versions to generate')
+        parser.add_argument('--bad', type=float, default=0.02, help='fraction of bins that are deliberately bad')
+        parser.add_argument('--seed', type=int, default=0, help='random seed')
+        parser.add_argument('-w', '--workers', type=int, default=1, help='number of accession worker processes')
+        parser.add_argument('-b', '--batch_size', type=int, default=100, help='accession batch size')
+        parser.add_argument('-d', '--directory', type=str, help='where to write filesets (default a temporary directory, which is removed)')
+        parser.add_argument('-o', '--output', type=str, help='write JSON results to this file instead of stdout')
+        parser.add_argument('--dataset', type=str, default='accession_benchmark', help='name of the temporary dataset')
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if directory is None:
+            root = tempfile.mkdtemp(prefix='ifcbdb_bench_')
+        else:
+            if os.path.exists(directory) and os.listdir(directory):
+                raise CommandError('{} is not empty'.format(directory))
+            os.makedirs(directory, exist_ok=True)
+            root = directory
+        log = lambda msg: self.stderr.write(msg)
+        schema_versions = [SCHEMA_VERSIONS[s] for s in options['schema']]
+        try:
+            log('generating {} filesets in {}'.format(options['n_bins'], root))
+            then = time.time()
+            basepaths, expected_errors = generate_filesets(root, options['n_bins'],
+                schema_versions=schema_versions, n_rois=options['rois'],
+                roi_size=tuple(options['roi_size']), bad_fraction=options['bad'], seed=options['seed'])
+            generate_time = time.time() - then
+            n_bytes = sum(os.path.getsize('{}.{}'.format(bp, ext)) for bp in basepaths for ext in ['adc', 'hdr', 'roi'])
+            try:
+                stages = run_benchmark(root, options['dataset'], n_workers=options['workers'],
+                    batch_size=options['batch_size'], log_callback=log)
+            except ValueError as e:
+                raise CommandError(str(e))
+        finally:
+            if directory is None:
+                shutil.rmtree(root)
+        results = {
+            'config': {
+                'n_bins': options['n_bins'],
+                'rois': options['rois'],
+                'roi_size': options['roi_size'],
+                'schema': options['schema'],
+                'bad_fraction': options['bad'],
+                'seed': options['seed'],
+                'workers': options['workers'],
+                'batch_size': options['batch_size'],
+            },
+            'generate': {
+                'bins': len(basepaths),
+                'bytes': n_bytes,
+                'seconds': generate_time,
+            },
+            'expected_bad': len(expected_errors),
+            'stages': stages,
+        }
+        out = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fout:
+                fout.write(out + '\n')
+        else:
+            self.stdout.write(out)
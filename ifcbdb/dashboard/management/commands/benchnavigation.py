@@ -0,0 +1,31 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.benchmark import run_navigation_benchmark
+
+class Command(BaseCommand):
+    help = 'time finding the previous and next bin as the bin table grows, and report latencies as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[10000, 100000, 1000000, 3000000], help='numbers of bins to time at')
+        parser.add_argument('-f', '--dataset_fraction', type=float, default=0.5, help='fraction of bins in the benchmark dataset')
+        parser.add_argument('-s', '--samples', type=int, default=200, help='number of bins to navigate from at each size')
+        parser.add_argument('--seed', type=int, default=0, help='random seed')
+        parser.add_argument('-o', '--output', type=str, help='write JSON results to this file instead of stdout')
+        parser.add_argument('--dataset', type=str, default='navigation_benchmark', help='name of the temporary dataset')
+
+    def handle(self, *args, **options):
+        log = lambda msg: self.stderr.write(msg)
+        try:
+            results = run_navigation_benchmark(options['dataset'], options['sizes'],
+                dataset_fraction=options['dataset_fraction'], n_samples=options['samples'],
+                seed=options['seed'], log_callback=log)
+        except ValueError as e:
+            raise CommandError(str(e))
+        out = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fout:
+                fout.write(out + '\n')
+        else:
+            self.stdout.write(out)
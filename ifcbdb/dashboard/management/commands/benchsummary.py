@@ -0,0 +1,78 @@
+import os
+import time
+
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+import ifcb
+from ifcb.data.adc import SCHEMA_VERSION_1
+from ifcb.data.files import Fileset, FilesetBin
+from ifcb.data.stitching import InfilledImages
+
+from dashboard.qaqc import MIN_SIZE
+from dashboard.summary import summarize_bin
+
+def multi_pass_summary(bin):
+    # the file reads accession made before summarize_bin, for comparison
+    if bin.fileset.getsize() < MIN_SIZE: # check_bad
+        return
+    try:
+        len(bin)
+        len(bin.images)
+    except:
+        return
+    sizes = bin.fileset.getsizes() # check_no_rois
+    if sizes['roi'] <= 1 or sizes['hdr'] == 0 or sizes['adc'] == 0:
+        return
+    try:
+        bin.ml_analyzed
+        bin.hdr_attributes
+    except:
+        return
+    bin.fileset.getsizes() # check_no_rois again
+    try:
+        bin.temperature
+        bin.humidity
+    except KeyError:
+        pass
+    bin.fileset.getsize()
+    bin.look_time
+    bin.run_time
+    bin.n_triggers
+    if bin.pid.schema_version == SCHEMA_VERSION_1:
+        len(InfilledImages(bin))
+    else:
+        len(bin.images)
+
+class Command(BaseCommand):
+    help = 'compare per-bin time of single-pass and multi-pass bin summaries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', type=str, nargs='+', help='raw data directories')
+        parser.add_argument('-n', '--n_bins', type=int, default=50, help='maximum number of bins per schema version')
+
+    def handle(self, *args, **options):
+        n_bins = options['n_bins']
+        basepaths = defaultdict(list) # keyed by schema version
+        for path in options['path']:
+            if not os.path.exists(path):
+                raise CommandError('{} does not exist'.format(path))
+            for bin in ifcb.DataDirectory(path):
+                version = bin.pid.schema_version
+                if len(basepaths[version]) < n_bins:
+                    basepaths[version].append(os.path.splitext(bin.fileset.adc_path)[0])
+        for version, paths in sorted(basepaths.items()):
+            for basepath in paths: # warm the OS file cache so neither method is penalized
+                summarize_bin(FilesetBin(Fileset(basepath)))
+            elapsed = {}
+            for name, fn in [('multi-pass', multi_pass_summary), ('single-pass', summarize_bin)]:
+                then = time.time()
+                for basepath in paths:
+                    # a new bin each time so nothing is cached between runs
+                    fn(FilesetBin(Fileset(basepath)))
+                elapsed[name] = time.time() - then
+            multi = 1000 * elapsed['multi-pass'] / len(paths)
+            single = 1000 * elapsed['single-pass'] / len(paths)
+            self.stdout.write('schema version {}: {} bins, multi-pass {:.1f}ms/bin, single-pass {:.1f}ms/bin ({:.0f}% less)'.format(
+                version, len(paths), multi, single, 100 * (multi - single) / multi))
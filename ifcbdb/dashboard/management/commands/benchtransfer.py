@@ -0,0 +1,88 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from common.smbtransfer import SmbTransfer, PART_SUFFIX
+
+from dashboard.benchmark import generate_filesets
+
+class Command(BaseCommand):
+    help = '''time fileset transfer from an SMB share with different numbers of connections.
+    to benchmark against a local Samba stand-in, share a directory, e.g.
+    docker run -p 445:445 -v /tmp/smbdata:/share dperson/samba -u "ifcb;ifcb" -s "Data;/share;no;no;no;ifcb"
+    and use --generate /tmp/smbdata to fill it with synthetic filesets'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('address', type=str, help='address of the SMB server')
+        parser.add_argument('-u', '--username', type=str, default='ifcb')
+        parser.add_argument('-p', '--password', type=str, default='ifcb')
+        parser.add_argument('-s', '--share', type=str, default='Data')
+        parser.add_argument('--port', type=int, default=445)
+        parser.add_argument('-d', '--directory', type=str, default='', help='directory within the share')
+        parser.add_argument('-c', '--connections', type=int, nargs='+', default=[1, 2, 4, 8], help='numbers of connections to try')
+        parser.add_argument('--generate', type=str, help='first write synthetic filesets to this local directory, which the server shares')
+        parser.add_argument('-n', '--n_bins', type=int, default=100, help='number of synthetic filesets to generate')
+        parser.add_argument('-o', '--output', type=str, help='write JSON results to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        if options['generate']:
+            self.stderr.write('generating {} filesets in {}'.format(options['n_bins'], options['generate']))
+            generate_filesets(options['generate'], options['n_bins'], bad_fraction=0)
+        def connect(n_connections):
+            return SmbTransfer(options['address'], options['username'], options['password'],
+                share=options['share'], directory=options['directory'], port=options['port'],
+                n_connections=n_connections)
+        with connect(1) as transfer:
+            if not transfer.is_responding():
+                raise CommandError('unable to connect to {}'.format(options['address']))
+            then = time.time()
+            filesets = transfer.list_filesets()
+            list_time = time.time() - then
+        if not filesets:
+            raise CommandError('no filesets found')
+        results = {
+            'filesets': len(filesets),
+            'bytes': sum(f.size for files in filesets.values() for f in files.values()),
+            'list_seconds': list_time,
+            'runs': [],
+        }
+        for n_connections in options['connections']:
+            destination = tempfile.mkdtemp(prefix='ifcbdb_transfer_')
+            try:
+                with connect(n_connections) as transfer:
+                    then = time.time()
+                    p = transfer.sync(destination, filesets=filesets)
+                    elapsed = time.time() - then
+                    run = {
+                        'connections': n_connections,
+                        'copied': p['copied'],
+                        'errors': len(p['errors']),
+                        'seconds': elapsed,
+                        'bytes_per_second': p['bytes'] / elapsed,
+                        'filesets_per_second': p['copied'] / elapsed,
+                    }
+                    # simulate an interrupted copy of each .roi file and time the resume
+                    for lid in filesets:
+                        path = os.path.join(destination, lid + '.roi')
+                        size = os.path.getsize(path)
+                        os.rename(path, path + PART_SUFFIX)
+                        with open(path + PART_SUFFIX, 'r+b') as fout:
+                            fout.truncate(size // 2)
+                    then = time.time()
+                    p = transfer.sync(destination, filesets=filesets)
+                    run['resume_seconds'] = time.time() - then
+                    run['resume_bytes'] = p['bytes']
+                results['runs'].append(run)
+                self.stderr.write('{} connection(s): {:.0f} bytes/s'.format(n_connections, run['bytes_per_second']))
+            finally:
+                shutil.rmtree(destination)
+        out = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fout:
+                fout.write(out + '\n')
+        else:
+            self.stdout.write(out)
@@ -1,6 +1,8 @@
 from django.core.management.base import BaseCommand, CommandError
 
-from dashboard.models import Bin, Dataset
+from dashboard.models import Bin, Dataset, DataDirectory
+from dashboard.manifest import Manifest
+from dashboard.rollups import rebuild_rollups, rebuild_summaries, delete_bins
 
 class Command(BaseCommand):
     """for testing only!!"""
@@ -14,6 +16,12 @@ class Command(BaseCommand):
         ds_name = options.get('dataset')
         if ds_name is not None:
             ds = Dataset.objects.get(name=ds_name)
-            ds.bins.all().delete()
+            # the bins are deleted from every dataset they are in, so all of those
+            # datasets' directories need scanning again
+            dataset_ids = delete_bins(ds.bins.all())
+            Manifest.clear(DataDirectory.objects.filter(dataset_id__in=dataset_ids | {ds.id}))
         else:
             Bin.objects.all().delete()
+            Manifest.clear(DataDirectory.objects.all())
+            rebuild_rollups()
+            rebuild_summaries()
@@ -7,7 +7,7 @@ import numpy as np
 
 from dashboard.models import Bin
 
-from dashboard.accession import import_metadata
+from dashboard.accession import import_metadata_csv
 
 class Command(BaseCommand):
     help = 'import bin metadata'
@@ -20,6 +20,5 @@ class Command(BaseCommand):
         path = options['file']
 
         assert os.path.exists(path)
-        df = pd.read_csv(path)
 
-        import_metadata(df, progress_callback=print)
\ No newline at end of file
+        import_metadata_csv(path, progress_callback=print)
\ No newline at end of file
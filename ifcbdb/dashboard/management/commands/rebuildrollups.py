@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.models import Dataset
+from dashboard.rollups import rebuild_rollups, rebuild_summaries
+
+class Command(BaseCommand):
+    help = 'recompute the time series rollups and dataset summaries from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-d', '--dataset', type=str, help='name of dataset to rebuild rollups for (default: all)')
+
+    def handle(self, *args, **options):
+        # handle arguments
+        dataset_name = options.get('dataset')
+        if dataset_name:
+            try:
+                ds = Dataset.objects.get(name=dataset_name)
+            except Dataset.DoesNotExist:
+                raise CommandError('No such dataset "{}"'.format(dataset_name))
+            rebuild_rollups(dataset_ids=[ds.id], instrument_ids=[])
+            rebuild_summaries(dataset_ids=[ds.id], instrument_ids=[])
+        else:
+            rebuild_rollups()
+            rebuild_summaries()
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.models import Dataset
+from dashboard.recompute import recompute_bins, METRICS, RECOMPUTE_BATCH_SIZE
+
+class Command(BaseCommand):
+    help = 'recompute per-bin metrics from raw data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('metrics', type=str, nargs='+', choices=sorted(METRICS), help='metrics to recompute')
+        parser.add_argument('-d', '--dataset', type=str, help='name of dataset to process (default: all datasets)')
+        parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes to use for reading raw data')
+        parser.add_argument('-b', '--batch-size', type=int, default=RECOMPUTE_BATCH_SIZE, help='number of bins to update at a time')
+
+    def handle(self, *args, **options):
+        # handle arguments
+        metrics = options['metrics']
+        dataset_name = options.get('dataset')
+        if dataset_name:
+            try:
+                datasets = [Dataset.objects.get(name=dataset_name)]
+            except Dataset.DoesNotExist:
+                raise CommandError('No such dataset "{}"'.format(dataset_name))
+        else:
+            datasets = Dataset.objects.order_by('name')
+        def progress_callback(p):
+            self.stdout.write('{} bins, {} updated, {} not found, {} errors'.format(
+                p['total'], p['updated'], p['not_found'], len(p['errors'])))
+        result = recompute_bins(datasets, metrics, n_workers=options['workers'],
+            batch_size=options['batch_size'], progress_callback=progress_callback, log_callback=self.stdout.write)
+        for pid, message in result['errors'].items():
+            self.stderr.write('{}: {}'.format(pid, message))
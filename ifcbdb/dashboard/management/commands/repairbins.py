@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from dashboard.accession import repair_half_created_bins
+
+class Command(BaseCommand):
+    help = 'delete bins left half-created by interrupted syncs of older versions, so that they are accessioned again'
+
+    def add_arguments(self, parser):
+        parser.add_argument('instruments', type=int, nargs='*', help='numbers of instruments to repair (default: all)')
+
+    def handle(self, *args, **options):
+        n = repair_half_created_bins(options['instruments'], log_callback=self.stdout.write)
+        if not n:
+            self.stdout.write('no half-created bins found')
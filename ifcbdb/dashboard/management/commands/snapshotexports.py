@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.models import Dataset
+from dashboard.snapshots import write_snapshot
+
+class Command(BaseCommand):
+    help = 'write snapshots of datasets\' metadata exports that have changed, e.g. nightly from cron'
+
+    def add_arguments(self, parser):
+        parser.add_argument('datasets', type=str, nargs='*', help='names of datasets to snapshot (default: all active datasets)')
+        parser.add_argument('-f', '--force', help='write snapshots even if nothing has changed', action='store_true')
+
+    def handle(self, *args, **options):
+        # handle arguments
+        dataset_names = options['datasets']
+        force = options.get('force', False)
+        if dataset_names:
+            datasets = []
+            for name in dataset_names:
+                try:
+                    datasets.append(Dataset.objects.get(name=name))
+                except Dataset.DoesNotExist:
+                    raise CommandError('No such dataset "{}"'.format(name))
+        else:
+            datasets = Dataset.objects.filter(is_active=True).order_by('name')
+        for ds in datasets:
+            try:
+                write_snapshot(ds, force=force, log_callback=self.stdout.write)
+            except Exception as e:
+                self.stderr.write('{}: snapshot failed: {}'.format(ds.name, e))
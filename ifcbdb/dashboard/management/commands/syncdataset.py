@@ -14,6 +14,9 @@ class Command(BaseCommand):
         parser.add_argument('-lon','--longitude', type=float, help='longitude to set all bins to')
         parser.add_argument('-d', '--depth', type=float, help='depth to set all bins to')
         parser.add_argument('-n', '--newest', help='only sync newest bins', action='store_true')
+        parser.add_argument('-r', '--rescan', help='scan all filesets, not just ones that are new or changed', action='store_true')
+        parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes to use for reading raw data')
+        parser.add_argument('-t', '--timing', help='report time spent in each stage of accession', action='store_true')
 
     def handle(self, *args, **options):
         # handle arguments
@@ -22,6 +25,9 @@ class Command(BaseCommand):
         lon = options.get('longitude')
         depth = options.get('depth')
         newest_only = options.get('newest',False)
+        n_workers = options.get('workers') or 1
+        rescan = options.get('rescan', False)
+        timing = options.get('timing', False)
         if (lat is None and lon is not None) or (lat is not None and lon is None):
             raise ValueError('must set both lat and lon')
         try:
@@ -29,5 +35,26 @@ class Command(BaseCommand):
         except Dataset.DoesNotExist:
             self.stderr.write('No such dataset "{}"'.format(dataset_name))
             return
-        acc = Accession(d, lat=lat, lon=lon, depth=depth, newest_only=newest_only)
-        acc.sync(progress_callback=lambda _: True, log_callback=print)
+        acc = Accession(d, lat=lat, lon=lon, depth=depth, newest_only=newest_only, n_workers=n_workers,
+            rescan=rescan, timing=timing)
+        def progress_callback(p):
+            timings = p.get('timings')
+            if timings and timings['batches']:
+                batch = timings['batches'][-1]
+                self.stdout.write('batch of {} bins in {}s ({} bins/s), {} total'.format(
+                    batch['items'], batch['seconds'], batch['per_second'], p['total']))
+            return True
+        result = acc.sync(progress_callback=progress_callback, log_callback=print)
+        if timing:
+            self.write_timings(result)
+
+    def write_timings(self, result):
+        timings = result['timings']
+        elapsed = timings['elapsed']
+        self.stdout.write('{} bins in {}s ({} added, {} bad)'.format(result['total'], elapsed, result['added'], result['bad']))
+        for name, stage in sorted(timings['stages'].items(), key=lambda s: s[1]['seconds'], reverse=True):
+            self.stdout.write('{:>14}: {:10.3f}s {:8d} items'.format(name, stage['seconds'], stage['count']))
+        if timings['slowest']:
+            self.stdout.write('slowest bins:')
+            for item in timings['slowest']:
+                self.stdout.write('  {} {}s'.format(item['item'], item['seconds']))
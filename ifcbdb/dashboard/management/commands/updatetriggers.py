@@ -1,99 +1,67 @@
-from collections import deque
 import csv
 import os
-import re
 
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
-from tqdm import tqdm
-from tqdm._utils import _term_move_up
 
-from dashboard.models import Bin, bin_query
+from dashboard.models import Bin, Dataset
+from dashboard.recompute import recompute_bins, RECOMPUTE_BATCH_SIZE
+from dashboard.rollups import update_rollups
 
 class Command(BaseCommand):
 
     help = 'update triggers'
 
-    border = "="*50
-    clear_border = _term_move_up() + "\r" + " "*len(border) + "\r"
-
     def add_arguments(self, parser):
         parser.add_argument('-i','--input', type=str, help='Path to csv of mapping of of bin ID and trigger count')
         parser.add_argument('-d', '--dataset', type=str, help='Name of dataset to process(Optional)')
-
-    def last_line(self, filename):
-        d = deque(open(filename), 1)
-        try:
-            return d.pop()
-        except IndexError:
-            return None
-
-
-    def n_triggers(self, line):
-        if line is None:
-            return 0
-        return re.match(r'^(\d+)', line).group(0)
-
-    def bulk_update(self, chunk, pbar):
-        objs = []
-        for bin in chunk:
-            if not os.path.exists(bin.adc_path()):
-                pbar.write(self.clear_border + ("Error: Bins, " + str(objs) + " not updated! Continuing ..."))
-                pbar.write(self.border)
-                continue
-            bin.n_triggers = self.n_triggers(self.last_line(bin.adc_path()))
-            objs.append(bin)
-        res = Bin.objects.bulk_update(objs, ['n_triggers'])
-        pbar.update(res)
-        if res == 0:
-            pbar.write(self.clear_border + ("Error: Bins, " + str(objs) + " not updated! Continuing ..."))
-            pbar.write(self.border)
-
-
-    def get_all_bins(self, dataset=None):
-        count = bin_query(dataset_name=dataset).count()
-        pbar = tqdm(total=count)
-
-        # Bulk update 1000 bins at a time
-        offset = 0
-        limit = 1000
-        partition = 1000
-
-        while True:
-            chunk = bin_query(dataset_name=dataset).order_by('pid')[offset:limit]
-            chunk_length = len(chunk)
-            if chunk_length < 1:
-                break
-            self.bulk_update(chunk, pbar)
-            offset = limit
-            limit = limit + partition
-
+        parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes to use for reading raw data')
+
+    def recompute(self, dataset_name=None, n_workers=1):
+        # n_triggers is one of the metrics the recompute command handles
+        if dataset_name:
+            try:
+                datasets = [Dataset.objects.get(name=dataset_name)]
+            except Dataset.DoesNotExist:
+                raise CommandError('No such dataset "{}"'.format(dataset_name))
+        else:
+            datasets = Dataset.objects.order_by('name')
+        def progress_callback(p):
+            self.stdout.write('{} bins, {} updated, {} not found, {} errors'.format(
+                p['total'], p['updated'], p['not_found'], len(p['errors'])))
+        result = recompute_bins(datasets, ['n_triggers'], n_workers=n_workers,
+            progress_callback=progress_callback, log_callback=self.stdout.write)
+        for pid, message in result['errors'].items():
+            self.stderr.write('Error: Bin {} not updated: {}'.format(pid, message))
 
     def parse_input_csv(self, input_csv):
         if not os.path.exists(input_csv):
             raise CommandError('specified file does not exist')
         with open(input_csv,'r') as csvin:
             reader = csv.reader(csvin)
-            row = next(reader)
-            with transaction.atomic():
-                for row in reader:
-                    res = 0
-                    res = Bin.objects.filter(pid=row[0]).update(n_triggers=row[1])
-                    if res == 0:
-                        print("Error: Bin, " + bin.pid + " not updated! Continuing ...")
+            next(reader) # header
+            n_triggers = dict((row[0], int(row[1])) for row in reader)
+        pids = list(n_triggers)
+        with transaction.atomic():
+            for i in range(0, len(pids), RECOMPUTE_BATCH_SIZE):
+                chunk = pids[i:i+RECOMPUTE_BATCH_SIZE]
+                bins = list(Bin.objects.filter(pid__in=chunk).only('id', 'pid'))
+                for b in bins:
+                    b.n_triggers = n_triggers[b.pid]
+                Bin.objects.bulk_update(bins, ['n_triggers'])
+                update_rollups([b.id for b in bins])
+                for pid in set(chunk) - set(b.pid for b in bins):
+                    self.stderr.write("Error: Bin, " + pid + " not updated! Continuing ...")
 
     def handle(self, *args, **options):
 
         # handle arguments
         input_csv = options['input']
         dataset_name = options.get('dataset')
-        
+
         # validate arguments
         if not input_csv:
-            self.get_all_bins(dataset=dataset_name)
+            self.recompute(dataset_name=dataset_name, n_workers=options['workers'])
         else:
             self.parse_input_csv(input_csv)
         print("Done.")
-        
-
-    
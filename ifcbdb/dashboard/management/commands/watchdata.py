@@ -0,0 +1,174 @@
+import os
+import errno
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from inotify_simple import INotify, flags
+
+from ifcb.data.files import Fileset, FilesetBin
+
+from dashboard.models import Dataset, DataDirectory
+from dashboard.accession import Accession
+from dashboard.manifest import FILESET_EXTENSIONS, is_bin_lid
+
+WATCH_FLAGS = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+
+# give up on filesets that are still incomplete after this many seconds
+STALE_TIME = 3600
+
+MAX_USER_WATCHES_PATH = '/proc/sys/fs/inotify/max_user_watches'
+
+def max_user_watches():
+    try:
+        with open(MAX_USER_WATCHES_PATH) as fin:
+            return int(fin.read())
+    except (OSError, ValueError):
+        return None
+
+class Command(BaseCommand):
+    help = 'watch raw data directories and accession filesets as they arrive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', type=str, nargs='*', help='names of datasets to watch (default all active datasets)')
+        parser.add_argument('-s', '--settle', type=float, default=2, help='seconds a fileset must be unchanged before it is accessioned')
+        parser.add_argument('-b', '--batch_size', type=int, default=100, help='maximum number of filesets to accession at once')
+        parser.add_argument('-p', '--poll', type=float, default=300, help='seconds between syncs of datasets that have too many directories to watch')
+
+    def handle(self, *args, **options):
+        dataset_names = options['dataset']
+        self.settle = options['settle']
+        self.batch_size = options['batch_size']
+        self.poll = options['poll']
+        if dataset_names:
+            datasets = list(Dataset.objects.filter(name__in=dataset_names))
+            missing = set(dataset_names) - set(ds.name for ds in datasets)
+            if missing:
+                raise CommandError('No such dataset(s) {}'.format(', '.join(missing)))
+        else:
+            datasets = list(Dataset.objects.filter(is_active=True))
+        self.inotify = INotify()
+        self.directories = {} # watch descriptor -> directory path
+        self.targets = {} # directory path -> (Accession, skipped directory names) for each dataset it belongs to
+        self.pending = {} # fileset basepath -> (Accessions, time of most recent event, extensions written)
+        self.polled = [] # Accessions of datasets synced every poll seconds, see watch_limit_reached
+        for ds in datasets:
+            acc = Accession(ds)
+            for dd in ds.directories.filter(kind=DataDirectory.RAW):
+                if not os.path.exists(dd.path):
+                    self.stderr.write('{} does not exist, not watching'.format(dd.path))
+                    continue
+                self.watch_tree(dd.path, acc, dd.skipped_directory_names())
+        self.stdout.write('watching {} directories'.format(len(self.directories)))
+        last_poll = time.time()
+        while True:
+            for event in self.inotify.read(timeout=int(self.settle * 1000)):
+                self.handle_event(event)
+            self.accession_ready()
+            if self.polled and time.time() - last_poll > self.poll:
+                self.sync_polled()
+                last_poll = time.time()
+
+    def watch_tree(self, path, acc, skipped_names, catch_up=False):
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = [d for d in dirnames if d not in skipped_names]
+            try:
+                wd = self.inotify.add_watch(dirpath, WATCH_FLAGS)
+            except OSError as e:
+                if e.errno != errno.ENOSPC:
+                    raise
+                self.watch_limit_reached(acc)
+                return
+            self.directories[wd] = dirpath
+            targets = self.targets.setdefault(dirpath, [])
+            if acc not in [a for a, _ in targets]:
+                targets.append((acc, skipped_names))
+            if catch_up: # files may have arrived in a new directory before the watch was added
+                for name in filenames:
+                    self.touch(os.path.join(dirpath, name))
+
+    def handle_event(self, event):
+        if event.mask & flags.IGNORED: # directory removed
+            dirpath = self.directories.pop(event.wd, None)
+            self.targets.pop(dirpath, None)
+            return
+        dirpath = self.directories.get(event.wd)
+        if dirpath is None or not event.name:
+            return
+        path = os.path.join(dirpath, event.name)
+        if event.mask & flags.ISDIR:
+            for acc, skipped_names in self.targets.get(dirpath, []):
+                if event.name not in skipped_names:
+                    self.watch_tree(path, acc, skipped_names, catch_up=True)
+        elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO): # file is complete
+            self.touch(path)
+
+    def watch_limit_reached(self, acc):
+        # there are more directories than inotify will watch, so directories that are not
+        # watched would never be accessioned. sync the dataset periodically instead, which
+        # its manifests make cheap when little has changed
+        if acc in self.polled:
+            return
+        self.polled.append(acc)
+        self.stderr.write('reached the inotify watch limit (fs.inotify.max_user_watches is {}) after watching {} '
+            'directories. syncing dataset {} every {} seconds instead. raise the limit with sysctl to '
+            'watch all of its directories'.format(max_user_watches(), len(self.directories),
+            acc.dataset.name, self.poll))
+
+    def sync_polled(self):
+        close_old_connections()
+        for acc in self.polled:
+            try:
+                p = acc.sync(progress_callback=lambda p: True) # a falsy result would cancel the sync
+            except Exception as e:
+                self.stderr.write('{}: sync failed: {}'.format(acc.dataset.name, e))
+                close_old_connections()
+                continue
+            if p['added'] or p['bad']:
+                self.stdout.write('{}: {} added, {} bad'.format(acc.dataset.name, p['added'], p['bad']))
+
+    def touch(self, path):
+        basepath, ext = os.path.splitext(path)
+        if ext[1:] not in FILESET_EXTENSIONS:
+            return
+        if not is_bin_lid(os.path.basename(basepath)):
+            return
+        accs = [acc for acc, _ in self.targets.get(os.path.dirname(path), [])]
+        _, _, written = self.pending.get(basepath, (None, None, set()))
+        written.add(ext[1:])
+        self.pending[basepath] = (accs, time.time(), written)
+
+    def accession_ready(self):
+        now = time.time()
+        ready = {} # Accession -> basepaths
+        for basepath, (accs, last_event, written) in list(self.pending.items()):
+            if now - last_event < self.settle:
+                continue
+            if written.issuperset(FILESET_EXTENSIONS):
+                for acc in accs:
+                    ready.setdefault(acc, []).append(basepath)
+            elif now - last_event > STALE_TIME:
+                self.stderr.write('{} is incomplete, giving up'.format(basepath))
+            else:
+                continue
+            del self.pending[basepath]
+        if not ready:
+            return
+        close_old_connections()
+        for acc, basepaths in ready.items():
+            for i in range(0, len(basepaths), self.batch_size):
+                batch = basepaths[i:i+self.batch_size]
+                try:
+                    bins = [FilesetBin(Fileset(bp)) for bp in batch]
+                    added, bad, errors = acc.add_bins(bins, log_callback=self.stdout.write)
+                except Exception as e:
+                    # drop the batch rather than stop watching. the next sync of the
+                    # dataset will accession these filesets
+                    self.stderr.write('{}: failed to accession {} filesets, dropping them: {}'.format(
+                        acc.dataset.name, len(batch), e))
+                    close_old_connections()
+                    continue
+                for pid, error in errors.items():
+                    self.stderr.write('{} {}'.format(pid, error))
+                self.stdout.write('{}: {} added, {} bad'.format(acc.dataset.name, added, bad))
@@ -0,0 +1,247 @@
+import os
+import time
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+import ifcb
+
+from .models import DataDirectory, ManifestDirectory, ManifestFileset
+
+FILESET_EXTENSIONS = ['adc', 'hdr', 'roi']
+
+# filesets modified more recently than this many seconds ago may still be being written.
+# appending to a file does not change its directory's mtime, so directories containing
+# such filesets are recorded as unsettled and listed again on the next scan
+SETTLE_TIME = 300
+UNSETTLED = -1
+
+def fileset_stat(basepath):
+    # total size and most recent mtime of a fileset's files
+    size = 0
+    mtime = 0
+    for ext in FILESET_EXTENSIONS:
+        st = os.stat('{}.{}'.format(basepath, ext))
+        size += st.st_size
+        mtime = max(mtime, st.st_mtime)
+    return size, mtime
+
+def is_bin_lid(name):
+    try:
+        ifcb.Pid(name).timestamp
+        return True
+    except ValueError:
+        return False
+
+class Manifest(object):
+    """
+    Records which directories and filesets in a raw DataDirectory have been scanned, so
+    that rescans only list directories whose mtime has changed and only yield filesets
+    that are new or whose size or mtime has changed.
+
+    Nothing is recorded until commit() is called, so filesets yielded by scan() are
+    not marked as seen until the caller has accessioned them. Filesets the caller did
+    not accession are passed to exclude(), which leaves them out and has the next scan
+    list their directories again. Committing before the scan has finished saves a
+    checkpoint on the DataDirectory, and the next scan resumes after it.
+    """
+    def __init__(self, data_directory, rescan=False):
+        self.data_directory = data_directory
+        # if rescan is True, ignore what has been recorded and list everything
+        self.rescan = rescan
+        self.skipped_names = data_directory.skipped_directory_names()
+        self.pending = [] # ManifestFileset instances yielded but not yet recorded
+        self.directories = {} # mtimes of all directories seen by the current scan
+        self.revisit = set() # directories containing excluded filesets
+        self.cursor = None # the last fileset yielded
+        self.started = None
+        self.checkpoint_started = None # epoch time the checkpointed scan started
+        self.finished = False
+
+    def _known_directories(self):
+        if self.rescan:
+            return {}
+        return dict(self.data_directory.manifest_directories.values_list('path', 'mtime'))
+
+    def _known_filesets(self, dirpath):
+        if self.rescan:
+            return {}
+        qs = self.data_directory.manifest_filesets.filter(directory=dirpath)
+        return dict((path, (size, mtime)) for path, size, mtime in qs.values_list('path', 'size', 'mtime'))
+
+    def _list_filesets(self, dirpath, filenames):
+        # basenames of complete filesets, in order
+        for name in sorted(filenames):
+            basename, ext = os.path.splitext(name)
+            if ext != '.adc':
+                continue
+            if basename + '.hdr' not in filenames or basename + '.roi' not in filenames:
+                continue
+            if not is_bin_lid(basename):
+                continue
+            yield basename
+
+    def _position(self, parts, cursor_parts):
+        # where a directory is in scan order relative to the directory containing the checkpoint cursor
+        if cursor_parts is None:
+            return 'after'
+        if parts == cursor_parts:
+            return 'at'
+        if parts == cursor_parts[:len(parts)]:
+            return 'above' # its own filesets were scanned before the cursor's directory
+        if parts < cursor_parts:
+            return 'before'
+        return 'after'
+
+    def scan(self):
+        # yields the basepath of each new or changed fileset, in path order.
+        # if a previous scan was interrupted, resumes after the last fileset it recorded
+        self.started = timezone.now()
+        self.directories = {}
+        self.revisit = set()
+        self.cursor = None
+        self.finished = False
+        checkpoint = self.data_directory.sync_checkpoint
+        if checkpoint and not self.rescan:
+            cursor_dir, cursor_name = os.path.split(checkpoint['cursor'])
+            cursor_parts = cursor_dir.split(os.sep)
+            # the interrupted scan may have missed changes to directories after it listed them
+            self.checkpoint_started = checkpoint['started']
+            # and it may have excluded filesets before the cursor
+            self.revisit = set(checkpoint.get('revisit', []))
+        else:
+            cursor_name, cursor_parts = None, None
+            self.checkpoint_started = time.time()
+        known_directories = self._known_directories()
+        subdirectories = {} # recorded subdirectories of each recorded directory
+        for path in known_directories:
+            subdirectories.setdefault(os.path.dirname(path), []).append(path)
+        stack = [os.path.normpath(self.data_directory.path)]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                mtime = os.stat(dirpath).st_mtime
+            except FileNotFoundError:
+                continue # removed since it was recorded
+            self.directories[dirpath] = mtime
+            if known_directories.get(dirpath) == mtime:
+                # nothing has been added, removed, or renamed in this directory,
+                # but its subdirectories may have changed
+                stack.extend(sorted((path for path in subdirectories.get(dirpath, [])
+                    if os.path.basename(path) not in self.skipped_names), reverse=True))
+                continue
+            position = self._position(dirpath.split(os.sep), cursor_parts)
+            if position != 'after' and mtime > self.checkpoint_started:
+                self.directories[dirpath] = UNSETTLED
+            dirnames, filenames = [], set()
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if entry.name not in self.skipped_names:
+                            dirnames.append(entry.path)
+                    else:
+                        filenames.add(entry.name)
+            stack.extend(sorted(dirnames, reverse=True))
+            if position in ['before', 'above']:
+                continue # filesets were all recorded before the scan was interrupted
+            known_filesets = self._known_filesets(dirpath)
+            settled_time = time.time() - SETTLE_TIME
+            for basename in self._list_filesets(dirpath, filenames):
+                if position == 'at' and basename <= cursor_name:
+                    continue
+                basepath = os.path.join(dirpath, basename)
+                try:
+                    size, fs_mtime = fileset_stat(basepath)
+                except FileNotFoundError:
+                    continue # removed while scanning
+                if fs_mtime > settled_time:
+                    self.directories[dirpath] = UNSETTLED
+                if known_filesets.get(basepath) == (size, fs_mtime):
+                    continue
+                self.pending.append(ManifestFileset(data_directory=self.data_directory,
+                    directory=dirpath, path=basepath, size=size, mtime=fs_mtime))
+                self.cursor = basepath
+                yield basepath
+        self.finished = True
+
+    def exclude(self, basepaths):
+        # leave yielded filesets out of the manifest, e.g. ones that were filtered out or
+        # could not be accessioned, so that the next scan yields them again. this works
+        # after take_pending too, as long as it is before the commit that ends the scan
+        basepaths = set(basepaths)
+        self.pending = [mf for mf in self.pending if mf.path not in basepaths]
+        for basepath in basepaths:
+            dirpath = os.path.dirname(basepath)
+            if dirpath in self.directories:
+                self.revisit.add(dirpath)
+
+    def commit(self):
+        # record the filesets yielded so far, and if the scan has finished, the directories.
+        # otherwise save a checkpoint so an interrupted scan can resume after the last fileset
+        dd = self.data_directory
+        with transaction.atomic():
+            if self.pending:
+                ManifestFileset.objects.bulk_create(self.pending, update_conflicts=True,
+                    unique_fields=['data_directory', 'path'], update_fields=['size', 'mtime'])
+                self.pending = []
+            if not self.finished:
+                if self.cursor is not None:
+                    dd.sync_checkpoint = {
+                        'cursor': self.cursor,
+                        'started': self.checkpoint_started,
+                        'revisit': sorted(self.revisit),
+                    }
+                    dd.save()
+                return
+            for dirpath in self.revisit:
+                self.directories[dirpath] = UNSETTLED
+            dd.manifest_directories.all().delete()
+            ManifestDirectory.objects.bulk_create([
+                ManifestDirectory(data_directory=dd, path=path, mtime=mtime)
+                for path, mtime in self.directories.items()
+            ])
+            dd.last_synced = self.started
+            dd.sync_checkpoint = None
+            dd.save()
+            self.finished = False
+
+    def take_pending(self):
+        # the filesets yielded but not yet recorded, as dicts that can be passed to
+        # record() by another process, e.g. a distributed sync chunk. they are no
+        # longer recorded by commit()
+        entries = [{
+            'data_directory_id': mf.data_directory.id,
+            'directory': mf.directory,
+            'path': mf.path,
+            'size': mf.size,
+            'mtime': mf.mtime,
+        } for mf in self.pending]
+        self.pending = []
+        return entries
+
+    @staticmethod
+    def record(entries):
+        # record filesets taken with take_pending as scanned
+        ManifestFileset.objects.bulk_create([ManifestFileset(**e) for e in entries], update_conflicts=True,
+            unique_fields=['data_directory', 'path'], update_fields=['size', 'mtime'])
+
+    @staticmethod
+    def forget(pids):
+        # make the next scan of any directory yield these bins' filesets again
+        if not pids:
+            return
+        q = Q()
+        for pid in pids:
+            q |= Q(path__endswith=os.sep + pid)
+        records = ManifestFileset.objects.filter(q)
+        for dd_id, dirpath in set(records.values_list('data_directory_id', 'directory')):
+            ManifestDirectory.objects.filter(data_directory_id=dd_id, path=dirpath).update(mtime=UNSETTLED)
+        records.delete()
+
+    @staticmethod
+    def clear(data_directories):
+        # forget what has been scanned so the next sync lists everything
+        ManifestDirectory.objects.filter(data_directory__in=data_directories).delete()
+        ManifestFileset.objects.filter(data_directory__in=data_directories).delete()
+        DataDirectory.objects.filter(id__in=[dd.id for dd in data_directories]).update(sync_checkpoint=None)
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.15 on 2026-10-18 14:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0035_auto_20191114_2039'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ManifestDirectory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=512)),
+                ('mtime', models.FloatField()),
+                ('data_directory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='manifest_directories', to='dashboard.datadirectory')),
+            ],
+            options={
+                'unique_together': {('data_directory', 'path')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ManifestFileset',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('directory', models.CharField(max_length=512)),
+                ('path', models.CharField(max_length=512)),
+                ('size', models.BigIntegerField()),
+                ('mtime', models.FloatField()),
+                ('data_directory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='manifest_filesets', to='dashboard.datadirectory')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['data_directory', 'directory'], name='manifest_fileset_dir_idx')],
+                'unique_together': {('data_directory', 'path')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-18 15:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0036_manifestdirectory_manifestfileset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datadirectory',
+            name='sync_checkpoint',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 4.2.15 on 2026-10-18 17:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+METRICS = ['size', 'temperature', 'humidity', 'run_time', 'look_time', 'ml_analyzed',
+    'concentration', 'n_triggers', 'n_images']
+
+def populate_sql():
+    # totals existing bins, as dashboard.rollups.rebuild_rollups does
+    columns = ', '.join('{0}_sum, {0}_min, {0}_max'.format(m) for m in METRICS)
+    totals = ', '.join('sum(b.{0}), min(b.{0}), max(b.{0})'.format(m) for m in METRICS)
+    statements = []
+    for resolution in ['hour', 'day', 'week']:
+        statements.append("""INSERT INTO dashboard_binrollup (resolution, dt, dataset_id, instrument_id, n_bins, {columns})
+            SELECT '{resolution}', date_trunc('{resolution}', b.sample_time), bd.dataset_id, b.instrument_id, count(*), {totals}
+            FROM dashboard_bin b JOIN dashboard_bin_datasets bd ON bd.bin_id = b.id
+            WHERE NOT b.skip GROUP BY 2, 3, 4""".format(columns=columns, totals=totals, resolution=resolution))
+        statements.append("""INSERT INTO dashboard_binrollup (resolution, dt, dataset_id, instrument_id, n_bins, {columns})
+            SELECT '{resolution}', date_trunc('{resolution}', b.sample_time), NULL, b.instrument_id, count(*), {totals}
+            FROM dashboard_bin b
+            WHERE NOT b.skip GROUP BY 2, 4""".format(columns=columns, totals=totals, resolution=resolution))
+    return statements
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0037_datadirectory_sync_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BinRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(max_length=8)),
+                ('dt', models.DateTimeField()),
+                ('n_bins', models.IntegerField()),
+                ('size_sum', models.FloatField()),
+                ('size_min', models.FloatField()),
+                ('size_max', models.FloatField()),
+                ('temperature_sum', models.FloatField()),
+                ('temperature_min', models.FloatField()),
+                ('temperature_max', models.FloatField()),
+                ('humidity_sum', models.FloatField()),
+                ('humidity_min', models.FloatField()),
+                ('humidity_max', models.FloatField()),
+                ('run_time_sum', models.FloatField()),
+                ('run_time_min', models.FloatField()),
+                ('run_time_max', models.FloatField()),
+                ('look_time_sum', models.FloatField()),
+                ('look_time_min', models.FloatField()),
+                ('look_time_max', models.FloatField()),
+                ('ml_analyzed_sum', models.FloatField()),
+                ('ml_analyzed_min', models.FloatField()),
+                ('ml_analyzed_max', models.FloatField()),
+                ('concentration_sum', models.FloatField()),
+                ('concentration_min', models.FloatField()),
+                ('concentration_max', models.FloatField()),
+                ('n_triggers_sum', models.FloatField()),
+                ('n_triggers_min', models.FloatField()),
+                ('n_triggers_max', models.FloatField()),
+                ('n_images_sum', models.FloatField()),
+                ('n_images_min', models.FloatField()),
+                ('n_images_max', models.FloatField()),
+                ('dataset', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='dashboard.dataset')),
+                ('instrument', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='dashboard.instrument')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['resolution', 'dataset', 'instrument', 'dt'], name='dashboard_rollup_lookup_idx')],
+            },
+        ),
+        migrations.RunSQL(populate_sql(), reverse_sql=migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.15 on 2026-10-18 18:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0038_binrollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bin',
+            index=models.Index(fields=['sample_time', 'pid'], name='dashboard_bin_time_pid_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.15 on 2026-10-18 19:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# totals existing bins, as dashboard.rollups.rebuild_summaries does
+TOTALS = """count(*) FILTER (WHERE NOT b.skip), count(*) FILTER (WHERE b.skip),
+    coalesce(sum(b.size) FILTER (WHERE NOT b.skip), 0), coalesce(sum(b.n_images) FILTER (WHERE NOT b.skip), 0),
+    min(b.sample_time) FILTER (WHERE NOT b.skip), max(b.sample_time) FILTER (WHERE NOT b.skip)"""
+
+POPULATE_SQL = [
+    """INSERT INTO dashboard_binsummary (dataset_id, instrument_id, n_bins, n_skipped, size, n_images,
+        first_sample_time, last_sample_time)
+    SELECT bd.dataset_id, b.instrument_id, {}
+    FROM dashboard_bin b JOIN dashboard_bin_datasets bd ON bd.bin_id = b.id
+    GROUP BY 1, 2""".format(TOTALS),
+    """INSERT INTO dashboard_binsummary (dataset_id, instrument_id, n_bins, n_skipped, size, n_images,
+        first_sample_time, last_sample_time)
+    SELECT NULL, b.instrument_id, {}
+    FROM dashboard_bin b
+    GROUP BY 2""".format(TOTALS),
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0039_bin_time_pid_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BinSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('n_bins', models.IntegerField(default=0)),
+                ('n_skipped', models.IntegerField(default=0)),
+                ('size', models.BigIntegerField(default=0)),
+                ('n_images', models.BigIntegerField(default=0)),
+                ('first_sample_time', models.DateTimeField(null=True)),
+                ('last_sample_time', models.DateTimeField(null=True)),
+                ('dataset', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='dashboard.dataset')),
+                ('instrument', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='dashboard.instrument')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['dataset', 'instrument'], name='dashboard_summary_scope_idx')],
+            },
+        ),
+        migrations.RunSQL(POPULATE_SQL, reverse_sql=migrations.RunSQL.noop),
+    ]
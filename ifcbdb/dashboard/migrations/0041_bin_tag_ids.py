@@ -0,0 +1,70 @@
+# Generated by Django 4.2.15 on 2026-10-18 20:13
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+# keeps dashboard_bin.tag_ids equal to the ids of each bin's tag events, however they
+# are added or deleted, including bulk inserts and cascading deletes. each statement
+# recomputes the arrays of the bins it touched, from the transition tables
+SYNC_TAG_IDS_SQL = """
+CREATE FUNCTION dashboard_bin_sync_tag_ids() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE dashboard_bin b SET tag_ids = ARRAY(SELECT DISTINCT e.tag_id FROM dashboard_tagevent e
+            WHERE e.bin_id = b.id ORDER BY e.tag_id) WHERE b.id IN (SELECT bin_id FROM new_events);
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE dashboard_bin b SET tag_ids = ARRAY(SELECT DISTINCT e.tag_id FROM dashboard_tagevent e
+            WHERE e.bin_id = b.id ORDER BY e.tag_id) WHERE b.id IN (SELECT bin_id FROM old_events);
+    ELSE
+        UPDATE dashboard_bin b SET tag_ids = ARRAY(SELECT DISTINCT e.tag_id FROM dashboard_tagevent e
+            WHERE e.bin_id = b.id ORDER BY e.tag_id)
+            WHERE b.id IN (SELECT bin_id FROM new_events UNION SELECT bin_id FROM old_events);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER dashboard_tagevent_insert_tag_ids AFTER INSERT ON dashboard_tagevent
+    REFERENCING NEW TABLE AS new_events
+    FOR EACH STATEMENT EXECUTE FUNCTION dashboard_bin_sync_tag_ids();
+CREATE TRIGGER dashboard_tagevent_delete_tag_ids AFTER DELETE ON dashboard_tagevent
+    REFERENCING OLD TABLE AS old_events
+    FOR EACH STATEMENT EXECUTE FUNCTION dashboard_bin_sync_tag_ids();
+CREATE TRIGGER dashboard_tagevent_update_tag_ids AFTER UPDATE ON dashboard_tagevent
+    REFERENCING OLD TABLE AS old_events NEW TABLE AS new_events
+    FOR EACH STATEMENT EXECUTE FUNCTION dashboard_bin_sync_tag_ids();
+
+UPDATE dashboard_bin b SET tag_ids = t.tag_ids
+    FROM (SELECT bin_id, array_agg(DISTINCT tag_id ORDER BY tag_id) AS tag_ids
+        FROM dashboard_tagevent GROUP BY bin_id) t
+    WHERE t.bin_id = b.id;
+"""
+
+DROP_SYNC_TAG_IDS_SQL = """
+DROP TRIGGER dashboard_tagevent_insert_tag_ids ON dashboard_tagevent;
+DROP TRIGGER dashboard_tagevent_delete_tag_ids ON dashboard_tagevent;
+DROP TRIGGER dashboard_tagevent_update_tag_ids ON dashboard_tagevent;
+DROP FUNCTION dashboard_bin_sync_tag_ids();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0040_binsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bin',
+            name='tag_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None),
+        ),
+        migrations.AddIndex(
+            model_name='bin',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['tag_ids'], name='dashboard_bin_tag_ids_idx'),
+        ),
+        migrations.RunSQL(SYNC_TAG_IDS_SQL, reverse_sql=DROP_SYNC_TAG_IDS_SQL),
+    ]
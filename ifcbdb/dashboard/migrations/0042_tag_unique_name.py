@@ -0,0 +1,34 @@
+# Generated by Django 4.2.15 on 2026-10-18 21:05
+
+from django.db import migrations, models
+
+
+# merge tags with the same name into the one with the lowest id, so the name can be unique
+CANONICAL = "SELECT name, min(id) AS id FROM dashboard_tag GROUP BY name HAVING count(*) > 1"
+
+MERGE_DUPLICATE_TAGS_SQL = [
+    # events that the bin already has for the canonical tag
+    """DELETE FROM dashboard_tagevent e USING dashboard_tag t, ({}) c
+        WHERE e.tag_id = t.id AND t.name = c.name AND t.id <> c.id
+        AND EXISTS (SELECT 1 FROM dashboard_tagevent e2 WHERE e2.bin_id = e.bin_id AND e2.tag_id = c.id)""".format(CANONICAL),
+    """UPDATE dashboard_tagevent e SET tag_id = c.id FROM dashboard_tag t, ({}) c
+        WHERE e.tag_id = t.id AND t.name = c.name AND t.id <> c.id""".format(CANONICAL),
+    """DELETE FROM dashboard_tag t USING ({}) c
+        WHERE t.name = c.name AND t.id <> c.id""".format(CANONICAL),
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0041_bin_tag_ids'),
+    ]
+
+    operations = [
+        migrations.RunSQL(MERGE_DUPLICATE_TAGS_SQL, reverse_sql=migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='tag',
+            name='name',
+            field=models.CharField(max_length=128, unique=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.15 on 2026-10-18 21:48
+
+from django.db import migrations, models
+import django.db.models.functions.comparison
+
+
+# concurrent rebuilds could insert the same rows twice. each copy was a complete total,
+# so keep the one with the lowest id
+DELETE_DUPLICATES_SQL = [
+    """DELETE FROM dashboard_binrollup a USING dashboard_binrollup b
+        WHERE a.id > b.id AND a.resolution = b.resolution AND a.dt = b.dt
+        AND a.dataset_id IS NOT DISTINCT FROM b.dataset_id
+        AND a.instrument_id IS NOT DISTINCT FROM b.instrument_id""",
+    """DELETE FROM dashboard_binsummary a USING dashboard_binsummary b
+        WHERE a.id > b.id
+        AND a.dataset_id IS NOT DISTINCT FROM b.dataset_id
+        AND a.instrument_id IS NOT DISTINCT FROM b.instrument_id""",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0042_tag_unique_name'),
+    ]
+
+    operations = [
+        migrations.RunSQL(DELETE_DUPLICATES_SQL, reverse_sql=migrations.RunSQL.noop),
+        migrations.AddConstraint(
+            model_name='binrollup',
+            constraint=models.UniqueConstraint(models.F('resolution'), django.db.models.functions.comparison.Coalesce('dataset', models.Value(0)), django.db.models.functions.comparison.Coalesce('instrument', models.Value(0)), models.F('dt'), name='dashboard_rollup_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='binsummary',
+            constraint=models.UniqueConstraint(django.db.models.functions.comparison.Coalesce('dataset', models.Value(0)), django.db.models.functions.comparison.Coalesce('instrument', models.Value(0)), name='dashboard_summary_unique'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 4.2.15 on 2026-10-18 22:20
+
+from django.db import migrations, models
+
+
+METRICS = ['size', 'temperature', 'humidity', 'run_time', 'look_time', 'ml_analyzed',
+    'concentration', 'n_triggers', 'n_images']
+
+LIVE = 'FILTER (WHERE NOT b.skip)'
+
+def populate_sql():
+    # rollups now count skipped bins, and summaries are totalled from them, so both are
+    # recomputed, as dashboard.rollups.rebuild_rollups and rebuild_summaries do
+    columns = ', '.join('{0}_sum, {0}_min, {0}_max'.format(m) for m in METRICS)
+    totals = ', '.join('coalesce(sum(b.{0}) {1}, 0), coalesce(min(b.{0}) {1}, 0), coalesce(max(b.{0}) {1}, 0)'.format(m, LIVE)
+        for m in METRICS)
+    counts = 'count(*) {0}, count(*) FILTER (WHERE b.skip), min(b.sample_time) {0}, max(b.sample_time) {0}'.format(LIVE)
+    statements = ['DELETE FROM dashboard_binsummary', 'DELETE FROM dashboard_binrollup']
+    for resolution in ['hour', 'day', 'week']:
+        statements.append("""INSERT INTO dashboard_binrollup (resolution, dt, dataset_id, instrument_id,
+                n_bins, n_skipped, first_sample_time, last_sample_time, {columns})
+            SELECT '{resolution}', date_trunc('{resolution}', b.sample_time), bd.dataset_id, b.instrument_id, {counts}, {totals}
+            FROM dashboard_bin b JOIN dashboard_bin_datasets bd ON bd.bin_id = b.id
+            GROUP BY 2, 3, 4""".format(columns=columns, counts=counts, totals=totals, resolution=resolution))
+        statements.append("""INSERT INTO dashboard_binrollup (resolution, dt, dataset_id, instrument_id,
+                n_bins, n_skipped, first_sample_time, last_sample_time, {columns})
+            SELECT '{resolution}', date_trunc('{resolution}', b.sample_time), NULL, b.instrument_id, {counts}, {totals}
+            FROM dashboard_bin b
+            GROUP BY 2, 4""".format(columns=columns, counts=counts, totals=totals, resolution=resolution))
+    statements.append("""INSERT INTO dashboard_binsummary (dataset_id, instrument_id, n_bins, n_skipped, size, n_images,
+            first_sample_time, last_sample_time)
+        SELECT dataset_id, instrument_id, sum(n_bins), sum(n_skipped), round(sum(size_sum)), round(sum(n_images_sum)),
+            min(first_sample_time), max(last_sample_time)
+        FROM dashboard_binrollup WHERE resolution = 'week'
+        GROUP BY 1, 2""")
+    return statements
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0043_rollup_summary_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='binrollup',
+            name='n_skipped',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='binrollup',
+            name='first_sample_time',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='binrollup',
+            name='last_sample_time',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunSQL(populate_sql(), reverse_sql=migrations.RunSQL.noop),
+    ]
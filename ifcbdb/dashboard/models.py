@@ -3,18 +3,22 @@ import json
 import logging
 import os
 
-from functools import lru_cache
+from functools import lru_cache, reduce
+from operator import or_
 
 from django.db import models
 
 from django.conf import settings
 
-from django.db.models import F, Count, Sum, Avg, Min, Max, Q
-from django.db.models.functions import Trunc
+from django.db.models import F, Count, Sum, Avg, Min, Max, Q, ExpressionWrapper, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Trunc, Coalesce
 from django.contrib.auth.models import User
 from django.contrib.gis.db.models import PointField
 from django.contrib.gis.geos import Point, Polygon
 from django.contrib.gis.db.models.functions import Distance
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 
 from django.db.models.signals import pre_save
 from django.dispatch import receiver
@@ -36,6 +40,8 @@ from ifcb.data.zip import bin2zip_stream
 from ifcb.data.transfer import RemoteIfcb
 from ifcb.data.files import Fileset, FilesetBin
 
+from common.smbtransfer import SmbTransfer, DEFAULT_CONNECTIONS
+
 from .tasks import mosaic_coordinates_task
 from .mosaic import Mosaic
 
@@ -61,8 +67,12 @@ class Timeline(object):
         'n_images': 'Count',
     }
 
-    def __init__(self, bin_qs, filter_skip=True):
+    def __init__(self, bin_qs, filter_skip=True, rollup_scope=None):
+        # rollup_scope is the (dataset, instrument) pair, either of which can be None, whose
+        # bins bin_qs selects, if it selects them on nothing else. metrics can then be
+        # read from BinRollups, and totals and time ranges from BinSummaries
         self.bins = bin_qs
+        self.rollup_scope = rollup_scope if filter_skip else None
         if filter_skip:
             self.bins = self.bins.filter(skip=False)
 
@@ -104,29 +114,24 @@ class Timeline(object):
         else:
             return previous_bin
 
+    def adjacent_bins(self, bin):
+        # the bins before and after this one in (sample_time, pid) order, in one query.
+        # each side is a row-value comparison that the (sample_time, pid) index answers
+        # by reading one entry, however many bins there are
+        table = Bin._meta.db_table
+        def after(op):
+            sql = '({0}.sample_time, {0}.pid) {1} (%s, %s)'.format(table, op)
+            return RawSQL(sql, (bin.sample_time, bin.pid), output_field=models.BooleanField())
+        prev_qs = self.bins.filter(after('<')).annotate(side=Value(-1)).order_by('-sample_time','-pid')[:1]
+        next_qs = self.bins.filter(after('>')).annotate(side=Value(1)).order_by('sample_time','pid')[:1]
+        adjacent = { b.side: b for b in prev_qs.union(next_qs, all=True) }
+        return adjacent.get(-1), adjacent.get(1)
+
     def previous_bin(self, bin):
-        same_time = self.bins.filter(sample_time=bin.sample_time)
-        prev_time = self.bins.filter(sample_time__lt=bin.sample_time).order_by('-sample_time','-pid')
-        if same_time.count() == 1: # only bin with this sample time
-            return prev_time.first()
-        else:
-            prev = same_time.filter(pid__lt=bin.pid).order_by('-pid').first()
-            if prev is None:
-                return prev_time.first()
-            else:
-                return prev
+        return self.adjacent_bins(bin)[0]
 
     def next_bin(self, bin):
-        same_time = self.bins.filter(sample_time=bin.sample_time)
-        next_time = self.bins.filter(sample_time__gt=bin.sample_time).order_by('sample_time','pid')
-        if same_time.count() == 1:
-            return next_time.first()
-        else:
-            _next = same_time.filter(pid__gt=bin.pid).order_by('pid').first()
-            if _next is None:
-                return next_time.first()
-            else:
-                return _next
+        return self.adjacent_bins(bin)[1]
 
     def nearest_bin(self, longitude, latitude):
         location = Point(longitude, latitude, srid=SRID)
@@ -134,7 +139,9 @@ class Timeline(object):
             distance=Distance('location', location)
         ).order_by('distance').first()
 
-    def metrics(self, metric, start_time=None, end_time=None, resolution='day', apply_offset=True):
+    def metrics(self, metric, start_time=None, end_time=None, resolution='day', apply_offset=True, max_points=None):
+        # at bin resolution, if max_points is given, the series is reduced to at most that
+        # many points with m4_downsample
         if resolution not in ['month', 'week', 'day', 'hour', 'bin', 'auto']:
             raise ValueError('unsupported time resolution {}'.format(resolution))
 
@@ -143,8 +150,12 @@ class Timeline(object):
 
         if resolution == 'auto':
             if start_time is None or end_time is None:
-                mm = self.bins.aggregate(min=Min('sample_time'),max=Max('sample_time'))
-                min_sample_time, max_sample_time = mm['min'], mm['max']
+                if self.rollup_scope is not None:
+                    summary = BinSummary.totals(*self.rollup_scope)
+                    min_sample_time, max_sample_time = summary['first_sample_time'], summary['last_sample_time']
+                else:
+                    mm = self.bins.aggregate(min=Min('sample_time'),max=Max('sample_time'))
+                    min_sample_time, max_sample_time = mm['min'], mm['max']
             if start_time is None:
                 start_time = min_sample_time
             else:
@@ -179,6 +190,20 @@ class Timeline(object):
 
         if resolution == 'bin':
             result = qs.annotate(dt=F('sample_time'),metric=F(metric)).values('dt','metric').order_by('dt')
+
+            if max_points is not None:
+                if start_time is None or end_time is None:
+                    mm = qs.aggregate(min=Min('sample_time'),max=Max('sample_time'))
+                    start_time = mm['min'] if start_time is None else start_time
+                    end_time = mm['max'] if end_time is None else end_time
+                result = m4_downsample(result.iterator(), start_time, end_time, max_points // 4)
+        elif self.rollup_scope is not None:
+            dataset, instrument = self.rollup_scope
+            result = BinRollup.time_series(metric, resolution, dataset, instrument, start_time, end_time)
+
+            if apply_offset:
+                for record in result:
+                    record['dt'] += offset
         else:
             result = qs.annotate(dt=Trunc('sample_time', resolution)). \
                     values('dt').annotate(metric=aggregate_fn(metric)).order_by('dt')
@@ -194,15 +219,61 @@ class Timeline(object):
         return cls.TIMELINE_METRICS.get(metric,'')
 
     def __len__(self):
+        if self.rollup_scope is not None:
+            return BinSummary.totals(*self.rollup_scope)['n_bins']
         return self.bins.count()
 
     def n_images(self):
+        if self.rollup_scope is not None:
+            return BinSummary.totals(*self.rollup_scope)['n_images']
         return self.bins.aggregate(Sum('n_images'))['n_images__sum']
 
     def total_data_volume(self):
         # total data size in bytes for everything in this Timeline
+        if self.rollup_scope is not None:
+            return BinSummary.totals(*self.rollup_scope)['size']
         return self.bins.aggregate(Sum('size'))['size__sum']       
 
+def truncate_time(time, resolution):
+    # the start of the hour, day, week or month containing a time, in UTC, as
+    # the database truncates times
+    ts = pd.to_datetime(time, utc=True)
+    if resolution == 'month':
+        return ts.floor('D').replace(day=1).to_pydatetime()
+    if resolution == 'week':
+        return (ts.floor('D') - pd.Timedelta(days=ts.weekday())).to_pydatetime()
+    return ts.floor({ 'hour': 'h', 'day': 'D' }[resolution]).to_pydatetime()
+
+def m4_downsample(records, start_time, end_time, n_buckets):
+    # reduces a time-ordered series of {'dt','metric'} records to the first, last, smallest
+    # and largest records in each of n_buckets equal intervals between start_time and
+    # end_time, so a line drawn through them at that many pixels looks like one drawn
+    # through every record. reads the records once, keeping four per bucket at most
+    n_buckets = max(n_buckets, 1)
+    if start_time is None or end_time is None:
+        return []
+    start = pd.to_datetime(start_time, utc=True).timestamp()
+    width = (pd.to_datetime(end_time, utc=True).timestamp() - start) / n_buckets
+    buckets = {}
+    for i, record in enumerate(records):
+        if width > 0:
+            b = min(max(int((record['dt'].timestamp() - start) / width), 0), n_buckets - 1)
+        else:
+            b = 0
+        kept = buckets.get(b)
+        if kept is None:
+            buckets[b] = [(i, record)] * 4 # first, last, min, max
+            continue
+        kept[1] = (i, record)
+        if record['metric'] < kept[2][1]['metric']:
+            kept[2] = (i, record)
+        if record['metric'] > kept[3][1]['metric']:
+            kept[3] = (i, record)
+    result = []
+    for b in sorted(buckets.keys()):
+        result.extend(record for i, record in sorted(dict(buckets[b]).items()))
+    return result
+
 def normalize_tag_name(tag_name):
     normalized = re.sub(r'[^_a-zA-Z0-9]','_',tag_name.lower().strip())
     return normalized
@@ -216,9 +287,21 @@ def bin_query(dataset_name=None, start=None, end=None, tags=[],
         qs = Timeline(qs).time_range(start, end)
     if dataset_name:
         qs = qs.filter(datasets__name=dataset_name)
-    if tags is not None:
-        for tag in tags:
-            qs = qs.filter(tags__name__iexact=tag)
+    if tags:
+        # match tag names case-insensitively, then require the bin's tag_ids to contain
+        # one id per tag, which the GIN index on tag_ids answers in one step
+        names = set(tag.lower() for tag in tags)
+        ids = {}
+        for tag_id, name in Tag.objects.filter(reduce(or_, [Q(name__iexact=n) for n in names])).values_list('id', 'name'):
+            ids.setdefault(name.lower(), []).append(tag_id)
+        if len(ids) < len(names): # no such tag
+            return qs.none()
+        required = [i[0] for i in ids.values() if len(i) == 1]
+        if required:
+            qs = qs.filter(tag_ids__contains=required)
+        for i in ids.values():
+            if len(i) > 1: # tags whose names differ only in case
+                qs = qs.filter(tag_ids__overlap=i)
     if instrument_number is not None and instrument_number != 0:
         qs = qs.filter(instrument__number=instrument_number)
     if cruise is not None:
@@ -243,12 +326,13 @@ class Dataset(models.Model):
     funding = models.CharField(max_length=512, blank=True)
 
     def __len__(self):
-        # number of bins
-        return self.bins.count()
+        # number of bins, including skipped ones
+        summary = BinSummary.totals(dataset=self)
+        return summary['n_bins'] + summary['n_skipped']
 
     def data_volume(self):
-        # total data volume in bytes
-        return Timeline(self.bins).total_data_volume()
+        # total data volume in bytes, not including skipped bins
+        return BinSummary.totals(dataset=self)['size']
 
     def tag_cloud(self, instrument=None):
         return Tag.cloud(dataset=self, instrument=instrument)
@@ -343,6 +427,9 @@ class Dataset(models.Model):
     def __str__(self):
         return self.name
 
+# directory names ifcb.DataDirectory skips when it is not given a blacklist
+IFCB_DEFAULT_BLACKLIST = ['skip', 'beads']
+
 class DataDirectory(models.Model):
     # directory types
     RAW = 'raw'
@@ -357,12 +444,23 @@ class DataDirectory(models.Model):
     kind = models.CharField(max_length=32, default=RAW)
     priority = models.IntegerField(default=1) # order in which directories are searched (lower ealier)
     last_synced = models.DateTimeField('time of last db sync', blank=True, null=True)
+    # where an interrupted sync left off, see manifest.py
+    sync_checkpoint = models.JSONField(blank=True, null=True)
     # parameters controlling searching (simple comma separated fields because we don't have to query on these)
     whitelist = models.CharField(max_length=512, default='data') # comma separated list of directory names to search
     blacklist = models.CharField(max_length=512, default='skip,bad') # comma separated list of directory names to skip
     # for product directories, the product version
     version = models.IntegerField(null=True, blank=True)
 
+    def skipped_directory_names(self):
+        # names of subdirectories that scans of this raw directory do not descend into:
+        # the blacklist, as in get_raw_directory, and the directories ifcb.DataDirectory
+        # skips by default, which syncs skipped before they used manifests. whitelisted
+        # names are always searched
+        whitelist = set(re.split(',', self.whitelist))
+        blacklist = set(re.split(',', self.blacklist)).union(IFCB_DEFAULT_BLACKLIST)
+        return blacklist - whitelist
+
     def get_raw_directory(self):
         if self.kind != self.RAW:
             raise ValueError('not a raw directory')
@@ -393,6 +491,35 @@ class DataDirectory(models.Model):
     def __str__(self):
         return '{} ({})'.format(self.path, self.kind)
 
+# manifest of what has been scanned in raw data directories, see manifest.py
+
+class ManifestDirectory(models.Model):
+    data_directory = models.ForeignKey(DataDirectory, on_delete=models.CASCADE, related_name='manifest_directories')
+    path = models.CharField(max_length=512) # absolute path
+    mtime = models.FloatField()
+
+    class Meta:
+        unique_together = ('data_directory', 'path')
+
+    def __str__(self):
+        return self.path
+
+class ManifestFileset(models.Model):
+    data_directory = models.ForeignKey(DataDirectory, on_delete=models.CASCADE, related_name='manifest_filesets')
+    directory = models.CharField(max_length=512) # absolute path of the directory containing the fileset
+    path = models.CharField(max_length=512) # absolute path of the fileset, without extension
+    size = models.BigIntegerField() # total size of the .adc, .hdr, and .roi files
+    mtime = models.FloatField() # most recent modification time of the .adc, .hdr, and .roi files
+
+    class Meta:
+        unique_together = ('data_directory', 'path')
+        indexes = [
+            models.Index(fields=['data_directory', 'directory'], name='manifest_fileset_dir_idx'),
+        ]
+
+    def __str__(self):
+        return self.path
+
 class Bin(models.Model):
     # bin's permanent identifier (e.g., D20190102T1234_IFCB927)
     pid = models.CharField(max_length=64, unique=True)
@@ -436,12 +563,29 @@ class Bin(models.Model):
 
     # tags
     tags = models.ManyToManyField('Tag', through='TagEvent')
+    # ids of this bin's tags, for filtering on several tags at once. a database trigger
+    # on TagEvent keeps this up to date, so it is never written from here
+    tag_ids = ArrayField(models.IntegerField(), default=list)
+
+    class Meta:
+        indexes = [
+            # for paging through bins in time order, see Timeline.adjacent_bins
+            models.Index(fields=['sample_time', 'pid'], name='dashboard_bin_time_pid_idx'),
+            GinIndex(fields=['tag_ids'], name='dashboard_bin_tag_ids_idx'),
+        ]
 
     MOSAIC_SCALE_FACTORS = [25, 33, 66, 100]
     MOSAIC_VIEW_SIZES = ["640x480", "800x600", "800x1280", "1080x1920"]
     MOSAIC_DEFAULT_SCALE_FACTOR = 33
     MOSAIC_DEFAULT_VIEW_SIZE = "800x600"
 
+    def save(self, *args, **kwargs):
+        # leave out tag_ids, which may have changed in the database since this bin was read
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name != 'tag_ids']
+        super().save(*args, **kwargs)
+
     def primary_dataset(self):
         if self.datasets.count() > 0:
             return self.datasets.first()
@@ -834,18 +978,25 @@ class Instrument(models.Model):
         with self._get_remote() as ifcb:
             return ifcb.share_exists()
 
-    def sync(self, data_directory, progress_callback=do_nothing):
+    def _get_transfer(self, n_connections=DEFAULT_CONNECTIONS):
+        return SmbTransfer(self.address, self.username, self.password,
+            share=self.share_name, timeout=self.timeout, n_connections=n_connections)
+
+    def sync(self, data_directory, progress_callback=do_nothing, fileset_callback=do_nothing,
+            n_connections=DEFAULT_CONNECTIONS):
+        # copies new filesets over several connections, see common/smbtransfer.py
         if not data_directory.kind == DataDirectory.RAW:
             raise TypeError('cannot sync raw data to product directory {}'.format(data_directory))
         def destination_directory(lid):
             return data_directory.raw_destination(lid)
-        with self._get_remote() as ifcb:
-            ifcb.sync(destination_directory, progress_callback=progress_callback)
+        with self._get_transfer(n_connections) as transfer:
+            return transfer.sync(destination_directory, progress_callback=progress_callback,
+                fileset_callback=fileset_callback)
 
 # tags
 
 class Tag(models.Model):
-    name = models.CharField(max_length=128)
+    name = models.CharField(max_length=128, unique=True)
 
     @staticmethod
     def autocomplete(search_string):
@@ -900,3 +1051,119 @@ class Comment(models.Model):
         else:
             return self.content
 
+# time series rollups
+
+class BinRollup(models.Model):
+    # totals of each timeline metric over the bins in an hour, day or week, so that
+    # time series at those resolutions don't have to aggregate the bins themselves.
+    # rows with a dataset total that dataset's bins from one instrument, and rows
+    # without one total all bins from one instrument. skipped bins are only counted,
+    # in n_skipped, so rows can have an n_bins of 0. kept up to date by dashboard.rollups
+    RESOLUTIONS = ['hour', 'day', 'week']
+
+    resolution = models.CharField(max_length=8)
+    dt = models.DateTimeField()
+    dataset = models.ForeignKey(Dataset, null=True, related_name='rollups', on_delete=models.CASCADE)
+    instrument = models.ForeignKey(Instrument, null=True, related_name='rollups', on_delete=models.CASCADE)
+    n_bins = models.IntegerField()
+    n_skipped = models.IntegerField(default=0)
+    first_sample_time = models.DateTimeField(null=True)
+    last_sample_time = models.DateTimeField(null=True)
+    size_sum = models.FloatField()
+    size_min = models.FloatField()
+    size_max = models.FloatField()
+    temperature_sum = models.FloatField()
+    temperature_min = models.FloatField()
+    temperature_max = models.FloatField()
+    humidity_sum = models.FloatField()
+    humidity_min = models.FloatField()
+    humidity_max = models.FloatField()
+    run_time_sum = models.FloatField()
+    run_time_min = models.FloatField()
+    run_time_max = models.FloatField()
+    look_time_sum = models.FloatField()
+    look_time_min = models.FloatField()
+    look_time_max = models.FloatField()
+    ml_analyzed_sum = models.FloatField()
+    ml_analyzed_min = models.FloatField()
+    ml_analyzed_max = models.FloatField()
+    concentration_sum = models.FloatField()
+    concentration_min = models.FloatField()
+    concentration_max = models.FloatField()
+    n_triggers_sum = models.FloatField()
+    n_triggers_min = models.FloatField()
+    n_triggers_max = models.FloatField()
+    n_images_sum = models.FloatField()
+    n_images_min = models.FloatField()
+    n_images_max = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['resolution', 'dataset', 'instrument', 'dt'], name='dashboard_rollup_lookup_idx'),
+        ]
+        constraints = [
+            # dataset and instrument can be null, which a plain unique constraint would let repeat
+            models.UniqueConstraint('resolution', Coalesce('dataset', Value(0)), Coalesce('instrument', Value(0)), 'dt',
+                name='dashboard_rollup_unique'),
+        ]
+
+    @staticmethod
+    def time_series(metric, resolution, dataset=None, instrument=None, start_time=None, end_time=None):
+        # the mean of a metric at each time, as Timeline.metrics computes it from bins.
+        # months are totalled from days
+        qs = BinRollup.objects.filter(resolution='day' if resolution == 'month' else resolution, n_bins__gt=0)
+        if dataset is not None:
+            qs = qs.filter(dataset=dataset)
+        else:
+            qs = qs.filter(dataset__isnull=True)
+        if instrument is not None:
+            qs = qs.filter(instrument=instrument)
+        if start_time is not None: # include the partial period at the start
+            qs = qs.filter(dt__gte=truncate_time(start_time, resolution))
+        if end_time is not None:
+            qs = qs.filter(dt__lte=pd.to_datetime(end_time, utc=True))
+        mean = ExpressionWrapper(Sum('{}_sum'.format(metric)) / Sum('n_bins'), output_field=models.FloatField())
+        if resolution == 'month':
+            qs = qs.annotate(month=Trunc('dt', 'month')).values('month').annotate(metric=mean).order_by('month')
+            return [{ 'dt': r['month'], 'metric': r['metric'] } for r in qs]
+        return list(qs.values('dt').annotate(metric=mean).order_by('dt'))
+
+class BinSummary(models.Model):
+    # totals over all the bins with the same scope as a BinRollup: one dataset's bins
+    # from one instrument, or, without a dataset, all bins from one instrument. n_bins,
+    # size, n_images and the sample times leave out skipped bins, which are counted in
+    # n_skipped. totalled from the weekly BinRollups by dashboard.rollups
+    dataset = models.ForeignKey(Dataset, null=True, related_name='summaries', on_delete=models.CASCADE)
+    instrument = models.ForeignKey(Instrument, null=True, related_name='summaries', on_delete=models.CASCADE)
+    n_bins = models.IntegerField(default=0)
+    n_skipped = models.IntegerField(default=0)
+    size = models.BigIntegerField(default=0)
+    n_images = models.BigIntegerField(default=0)
+    first_sample_time = models.DateTimeField(null=True)
+    last_sample_time = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['dataset', 'instrument'], name='dashboard_summary_scope_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(Coalesce('dataset', Value(0)), Coalesce('instrument', Value(0)),
+                name='dashboard_summary_unique'),
+        ]
+
+    @staticmethod
+    def totals(dataset=None, instrument=None):
+        # the totals for a dataset and/or instrument, or for all bins if neither is given
+        qs = BinSummary.objects.all()
+        if dataset is not None:
+            qs = qs.filter(dataset=dataset)
+        else:
+            qs = qs.filter(dataset__isnull=True)
+        if instrument is not None:
+            qs = qs.filter(instrument=instrument)
+        totals = qs.aggregate(n_bins=Sum('n_bins'), n_skipped=Sum('n_skipped'), size=Sum('size'),
+            n_images=Sum('n_images'), first_sample_time=Min('first_sample_time'),
+            last_sample_time=Max('last_sample_time'))
+        for field in ['n_bins', 'n_skipped', 'size', 'n_images']:
+            totals[field] = totals[field] or 0
+        return totals
@@ -1,22 +1,20 @@
 MIN_SIZE = 32
 
-def check_bad(bin):
-    """returns True if bin is malformed and impossible to use"""
-    if bin.fileset.getsize() < MIN_SIZE:
+def check_bad(summary):
+    """returns True if bin is malformed and impossible to use.
+    takes a BinSummary (see summary.py)"""
+    if summary.size < MIN_SIZE:
         return True
-    try:
-        len(bin)
-    except: # bad ADC data
+    if summary.n_targets is None: # bad ADC data
         return True
-    try:
-        len(bin.images)
-    except:
+    if summary.n_images is None:
         return True
     return False
 
-def check_no_rois(bin):
-    """returns True if any file is zero length, etc"""
-    sizes = bin.fileset.getsizes()
+def check_no_rois(summary):
+    """returns True if any file is zero length, etc.
+    takes a BinSummary (see summary.py)"""
+    sizes = summary.sizes
     roi_size = sizes['roi']
     if roi_size <= 1: # old style empty ROI files are 1 byte long
         return True
@@ -0,0 +1,149 @@
+"""
+Recomputes per-bin metrics from raw data for bins that have already been
+accessioned, e.g. after a change to how a metric is computed.
+
+Each metric in METRICS is computed from a fileset's basepath by a function
+that returns the values of the Bin fields it sets. Functions run in worker
+processes, so they must be module-level. To recompute another metric, add
+an entry to METRICS.
+"""
+import os
+import re
+import time
+
+from billiard import Pool
+
+from django.db import transaction
+
+from ifcb.data.files import Fileset, FilesetBin
+
+from .models import Bin
+from .accession import Accession
+from .rollups import update_rollups
+
+RECOMPUTE_BATCH_SIZE = 1000
+
+def do_nothing(*args, **kwargs):
+    pass
+
+def last_line(path, block_size=4096):
+    # the last non-blank line of a file, read by seeking back from its end a block
+    # at a time. None if the file has no lines
+    with open(path, 'rb') as fin:
+        position = fin.seek(0, os.SEEK_END)
+        data = b''
+        while position > 0:
+            step = min(block_size, position)
+            position -= step
+            fin.seek(position)
+            data = fin.read(step) + data
+            stripped = data.rstrip()
+            if b'\n' in stripped:
+                return stripped.rsplit(b'\n', 1)[1].decode('ascii', errors='replace').strip()
+        return data.strip().decode('ascii', errors='replace') or None
+
+def n_triggers(basepath):
+    # the trigger number of the last row of the ADC file
+    line = last_line(basepath + '.adc')
+    if line is None:
+        return { 'n_triggers': 0 }
+    m = re.match(r'^(\d+)', line)
+    if m is None:
+        raise ValueError('malformed ADC row "{}"'.format(line))
+    return { 'n_triggers': int(m.group(1)) }
+
+def size(basepath):
+    return { 'size': sum(Fileset(basepath).getsizes().values()) }
+
+def n_images(basepath):
+    return { 'n_images': len(FilesetBin(Fileset(basepath)).images) }
+
+def ml_analyzed(basepath):
+    return { 'ml_analyzed': FilesetBin(Fileset(basepath)).ml_analyzed }
+
+METRICS = {
+    'n_triggers': n_triggers,
+    'size': size,
+    'n_images': n_images,
+    'ml_analyzed': ml_analyzed,
+}
+
+def recompute_fileset(args):
+    # runs in worker processes. returns the new field values, or an error message
+    basepath, metrics = args
+    values = {}
+    try:
+        for metric in metrics:
+            values.update(METRICS[metric](basepath))
+    except Exception as e:
+        return str(e)
+    return values
+
+def recompute_bins(datasets, metrics, n_workers=1, batch_size=RECOMPUTE_BATCH_SIZE,
+        progress_callback=do_nothing, log_callback=do_nothing):
+    """
+    Recomputes the given metrics for every bin in the given datasets. The raw data
+    for each dataset's bins is found with one walk of its raw data directories,
+    files are read in n_workers processes, and each batch of bins is written with
+    one bulk update. Bins in more than one of the datasets are recomputed once.
+    Returns the final progress dict.
+    """
+    for metric in metrics:
+        if metric not in METRICS:
+            raise KeyError('unknown metric {}'.format(metric))
+    progress = {
+        'total': 0,
+        'updated': 0,
+        'not_found': 0,
+        'errors': {},
+        'started': time.time(),
+    }
+    done = set() # ids of bins already recomputed
+    pool = Pool(n_workers) if n_workers > 1 else None
+    try:
+        for ds in datasets:
+            # concentration is recomputed from n_images and ml_analyzed, so load all three
+            bins = Bin.objects.filter(datasets=ds).order_by('id').only('id', 'pid', 'n_images', 'ml_analyzed', 'concentration')
+            log_callback('{}: finding raw data'.format(ds.name))
+            basepaths = Accession(ds).find_basepaths(bins.values_list('pid', flat=True).iterator())
+            log_callback('{}: found raw data for {} bins'.format(ds.name, len(basepaths)))
+            last_id = 0
+            while True:
+                # paginate by id, which does not skip or repeat bins the way offsets can
+                batch = list(bins.filter(id__gt=last_id)[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+                batch = [b for b in batch if b.id not in done]
+                done.update(b.id for b in batch)
+                progress['total'] += len(batch)
+                found = [b for b in batch if b.pid in basepaths]
+                progress['not_found'] += len(batch) - len(found)
+                args = [(basepaths[b.pid], metrics) for b in found]
+                results = pool.map(recompute_fileset, args) if pool is not None else map(recompute_fileset, args)
+                updated = []
+                update_fields = set()
+                for b, values in zip(found, results):
+                    if isinstance(values, str):
+                        progress['errors'][b.pid] = values
+                        log_callback('{}: {}'.format(b.pid, values))
+                        continue
+                    for field, value in values.items():
+                        setattr(b, field, value)
+                    update_fields.update(values.keys())
+                    if ('n_images' in values or 'ml_analyzed' in values) and b.ml_analyzed > 0:
+                        b.concentration = b.n_images / b.ml_analyzed
+                        update_fields.add('concentration')
+                    updated.append(b)
+                if updated:
+                    with transaction.atomic():
+                        Bin.objects.bulk_update(updated, sorted(update_fields))
+                        update_rollups([b.id for b in updated])
+                progress['updated'] += len(updated)
+                if progress_callback(progress) is False: # cancel
+                    return progress
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return progress
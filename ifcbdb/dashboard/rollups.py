@@ -0,0 +1,202 @@
+"""
+Maintains BinRollups, the hourly, daily and weekly totals of each timeline
+metric that Timeline.metrics reads instead of aggregating bins, and
+BinSummaries, the overall totals for each dataset and instrument.
+
+Rollups are recomputed from the bins a week at a time, since every hour and day
+falls within one week, and summaries are totalled from the weekly rollups.
+Whatever adds, edits, skips or unskips bins calls update_rollups with their
+ids, which recomputes the weeks those bins fall in for their datasets and
+instruments, and then the summaries of those datasets and instruments.
+Bins are deleted with delete_bins, which does the same for the bins' weeks
+once they are gone. Bins changed any other way, e.g. from the Django shell
+or in SQL, are counted wrongly until the rebuildrollups command, which
+recomputes everything, is run.
+"""
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.db import transaction, connection
+from django.db.models import Count, Sum, Min, Max, Q, Value, FloatField
+from django.db.models.functions import Trunc, Coalesce
+
+from .models import Bin, BinRollup, BinSummary, Timeline, truncate_time
+
+ROLLUP_METRICS = list(Timeline.TIMELINE_METRICS)
+
+# Bin fields whose changes mean rollups need recomputing
+ROLLUP_FIELDS = set(ROLLUP_METRICS + ['sample_time', 'skip'])
+
+ROLLUP_INSERT_BATCH_SIZE = 5000
+
+# advisory lock classes for the two kinds of scope. object id 0 of each stands for all
+# scopes of that kind, which a full rebuild locks exclusively and others share
+DATASET_SCOPE_LOCK = 0x726f6c31
+INSTRUMENT_SCOPE_LOCK = 0x726f6c32
+NO_INSTRUMENT_LOCK_ID = -1
+
+def week_ranges(times):
+    # the weeks containing the given times, merged into as few (start, end) ranges as possible
+    starts = sorted(set(truncate_time(t, 'week') for t in times if t is not None))
+    ranges = []
+    for start in starts:
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], start + timedelta(days=7))
+        else:
+            ranges.append((start, start + timedelta(days=7)))
+    return ranges
+
+def _bin_scopes(bins):
+    # the sample times of a queryset of bins, and the ids of their datasets and instruments
+    times = set()
+    dataset_ids = set()
+    instrument_ids = set()
+    rows = Bin.objects.filter(id__in=bins.order_by().values('id')) \
+        .values_list('sample_time', 'instrument_id', 'datasets__id').order_by()
+    for sample_time, instrument_id, dataset_id in rows.iterator():
+        times.add(sample_time)
+        instrument_ids.add(instrument_id)
+        if dataset_id is not None:
+            dataset_ids.add(dataset_id)
+    return times, dataset_ids, instrument_ids
+
+def update_rollups(bin_ids, old_sample_times=()):
+    # recomputes the rollups the given bins are part of, after they have been added or
+    # changed. if their sample times were changed, old_sample_times must include the old
+    # ones, so that the rollups the bins used to be part of are recomputed too
+    times, dataset_ids, instrument_ids = _bin_scopes(Bin.objects.filter(id__in=bin_ids))
+    ranges = week_ranges(times.union(old_sample_times))
+    if ranges:
+        with transaction.atomic(): # holds the scope locks until both are done
+            rebuild_rollups(dataset_ids, instrument_ids, ranges)
+            rebuild_summaries(dataset_ids, instrument_ids)
+
+def delete_bins(bins):
+    # deletes a queryset of bins and recomputes the rollups they were part of, in every
+    # dataset they were in, not only the one they may have been selected from. returns
+    # the ids of those datasets
+    times, dataset_ids, instrument_ids = _bin_scopes(bins)
+    with transaction.atomic():
+        Bin.objects.filter(id__in=bins.order_by().values('id')).delete()
+        ranges = week_ranges(times)
+        if ranges:
+            rebuild_rollups(dataset_ids, instrument_ids, ranges)
+            rebuild_summaries(dataset_ids, instrument_ids)
+    return dataset_ids
+
+def rebuild_rollups(dataset_ids=None, instrument_ids=None, ranges=None):
+    # recomputes rollups from the bins for the given datasets and instruments over
+    # the given week-aligned time ranges. None means all datasets, instruments or times.
+    # an instrument id of None means bins with no instrument
+    if ranges is not None:
+        time_filter = reduce(or_, [Q(dt__gte=start, dt__lt=end) for start, end in ranges])
+        bin_time_filter = reduce(or_, [Q(sample_time__gte=start, sample_time__lt=end) for start, end in ranges])
+    else:
+        time_filter, bin_time_filter = Q(), Q()
+    bins = Bin.objects.filter(bin_time_filter).order_by()
+    with transaction.atomic():
+        # holds locks on the scopes so that concurrent rebuilds of them do not both insert
+        _lock_scopes(DATASET_SCOPE_LOCK, dataset_ids)
+        _lock_scopes(INSTRUMENT_SCOPE_LOCK, instrument_ids)
+        existing = BinRollup.objects.filter(time_filter)
+        # each dataset's bins, by instrument
+        if dataset_ids is None or dataset_ids:
+            rows = existing.filter(dataset__isnull=False)
+            dataset_bins = bins.filter(datasets__isnull=False)
+            if dataset_ids is not None:
+                rows = rows.filter(dataset_id__in=dataset_ids)
+                dataset_bins = bins.filter(datasets__id__in=dataset_ids)
+            rows.delete()
+            _insert_rollups(dataset_bins, ['datasets__id', 'instrument_id'])
+        # all bins, by instrument
+        if instrument_ids is None or instrument_ids:
+            rows = existing.filter(dataset__isnull=True)
+            instrument_bins = bins
+            if instrument_ids is not None:
+                rows = rows.filter(_instrument_filter(instrument_ids))
+                instrument_bins = bins.filter(_instrument_filter(instrument_ids))
+            rows.delete()
+            _insert_rollups(instrument_bins, ['instrument_id'])
+
+def rebuild_summaries(dataset_ids=None, instrument_ids=None):
+    # recomputes the BinSummaries for the given datasets and instruments by totalling
+    # their weekly rollups, which must be up to date. costs one row per week, however
+    # many bins there are
+    scopes = []
+    if dataset_ids is None or dataset_ids:
+        scope = Q(dataset__isnull=False)
+        if dataset_ids is not None:
+            scope &= Q(dataset_id__in=dataset_ids)
+        scopes.append(scope)
+    if instrument_ids is None or instrument_ids:
+        scope = Q(dataset__isnull=True)
+        if instrument_ids is not None:
+            scope &= _instrument_filter(instrument_ids)
+        scopes.append(scope)
+    if not scopes:
+        return
+    scope = reduce(or_, scopes)
+    with transaction.atomic():
+        _lock_scopes(DATASET_SCOPE_LOCK, dataset_ids)
+        _lock_scopes(INSTRUMENT_SCOPE_LOCK, instrument_ids)
+        BinSummary.objects.filter(scope).delete()
+        totals = BinRollup.objects.filter(scope, resolution='week') \
+            .values('dataset_id', 'instrument_id').annotate(
+                n_bins=Sum('n_bins'),
+                n_skipped=Sum('n_skipped'),
+                size=Sum('size_sum'),
+                n_images=Sum('n_images_sum'),
+                first_sample_time=Min('first_sample_time'),
+                last_sample_time=Max('last_sample_time'),
+            ).order_by()
+        summaries = []
+        for row in totals.iterator():
+            row['size'] = int(round(row['size']))
+            row['n_images'] = int(round(row['n_images']))
+            summaries.append(BinSummary(**row))
+        BinSummary.objects.bulk_create(summaries, batch_size=ROLLUP_INSERT_BATCH_SIZE)
+
+def _instrument_filter(instrument_ids):
+    instrument_filter = Q(instrument_id__in=[i for i in instrument_ids if i is not None])
+    if None in instrument_ids:
+        instrument_filter |= Q(instrument__isnull=True)
+    return instrument_filter
+
+def _lock_scopes(lock_class, ids):
+    # takes transaction-level advisory locks on the given scopes, in order, or on all of them
+    if ids is not None and not ids:
+        return
+    with connection.cursor() as cursor:
+        if ids is None:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, 0)', [lock_class])
+            return
+        cursor.execute('SELECT pg_advisory_xact_lock_shared(%s, 0)', [lock_class])
+        for i in sorted(NO_INSTRUMENT_LOCK_ID if i is None else i for i in ids):
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [lock_class, i])
+
+def _insert_rollups(bins, group_by):
+    # skipped bins are only counted, so a period can have rows with n_bins of 0
+    live = Q(skip=False)
+    aggregates = {
+        'n_bins': Count('id', filter=live),
+        'n_skipped': Count('id', filter=Q(skip=True)),
+        'first_sample_time': Min('sample_time', filter=live),
+        'last_sample_time': Max('sample_time', filter=live),
+    }
+    for metric in ROLLUP_METRICS:
+        for total, fn in [('sum', Sum), ('min', Min), ('max', Max)]:
+            aggregates['{}_{}'.format(metric, total)] = Coalesce(fn(metric, filter=live), Value(0),
+                output_field=FloatField())
+    rollups = []
+    for resolution in BinRollup.RESOLUTIONS:
+        totals = bins.annotate(period=Trunc('sample_time', resolution)) \
+            .values('period', *group_by).annotate(**aggregates).order_by()
+        for row in totals.iterator():
+            rollup = BinRollup(resolution=resolution, dt=row.pop('period'),
+                dataset_id=row.pop('datasets__id', None), instrument_id=row.pop('instrument_id'), **row)
+            rollups.append(rollup)
+            if len(rollups) >= ROLLUP_INSERT_BATCH_SIZE:
+                BinRollup.objects.bulk_create(rollups)
+                rollups = []
+    BinRollup.objects.bulk_create(rollups)
@@ -0,0 +1,120 @@
+"""
+Per-dataset snapshots of the unfiltered metadata export, so that the many
+requests for a whole dataset's metadata can be served from files instead of
+each running the export query.
+
+Each snapshot is written to a new versioned pair of files (CSV and Parquet)
+in the dataset's directory under EXPORT_SNAPSHOT_DIR. A snapshot.json file
+there records the current version and a fingerprint of the data it was made
+from, and is replaced last so readers never see a partial snapshot. A new
+snapshot is only made when the fingerprint changes.
+"""
+import os
+import json
+import hashlib
+
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db.models import Count, Sum, Max, Func, BigIntegerField
+from django.db.models.expressions import RawSQL
+
+from .models import Bin, TagEvent, Comment, bin_query
+from .accession import export_metadata_csv, export_metadata_parquet
+
+SNAPSHOT_FORMATS = ['csv', 'parquet']
+SNAPSHOT_MANIFEST = 'snapshot.json'
+
+# versions kept besides the current one, so downloads of the previous one can finish
+SNAPSHOT_VERSIONS_KEPT = 1
+
+def do_nothing(*args, **kwargs):
+    pass
+
+def snapshot_directory(ds):
+    return os.path.join(settings.EXPORT_SNAPSHOT_DIR, ds.name)
+
+def read_manifest(ds):
+    try:
+        with open(os.path.join(snapshot_directory(ds), SNAPSHOT_MANIFEST)) as fin:
+            return json.load(fin)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def snapshot_path(ds, export_format):
+    # path of the current snapshot in the given format, or None if there is none
+    manifest = read_manifest(ds)
+    if manifest is None or export_format not in manifest['files']:
+        return None
+    path = os.path.join(snapshot_directory(ds), manifest['files'][export_format])
+    if not os.path.exists(path):
+        return None
+    return path
+
+def export_fingerprint(ds):
+    # a digest of everything in the dataset's metadata export. each aggregate is a
+    # single pass over the dataset's bins, tags or comments, which is far cheaper than
+    # the export itself, and changes when bins are added, edited, tagged or commented on
+    bins = Bin.objects.filter(datasets=ds).order_by()
+    row_hash = RawSQL("""hashtext(concat_ws('|', dashboard_bin.pid, dashboard_bin.sample_time,
+        dashboard_bin.ml_analyzed, ST_AsText(dashboard_bin.location), dashboard_bin.depth,
+        dashboard_bin.cruise, dashboard_bin.cast, dashboard_bin.niskin, dashboard_bin.sample_type,
+        dashboard_bin.n_images, dashboard_bin.skip, dashboard_bin.metadata))""", (), output_field=BigIntegerField())
+    parts = {
+        'dataset': [ds.name, ds.location.wkt if ds.location else None, ds.depth],
+        'bins': bins.aggregate(n=Count('id'), added=Max('added'), hash=Sum(row_hash)),
+        'tags': TagEvent.objects.filter(bin__datasets=ds).order_by() \
+            .aggregate(n=Count('id'), ids=Sum('id'), latest=Max('timestamp')),
+        'comments': Comment.objects.filter(bin__datasets=ds).order_by() \
+            .aggregate(n=Count('id'), ids=Sum('id'), latest=Max('timestamp'),
+                hash=Sum(Func('content', function='hashtext', output_field=BigIntegerField()))),
+    }
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+def write_snapshot(ds, force=False, log_callback=do_nothing):
+    # writes a new snapshot of the dataset's export if its data has changed since the last
+    # one, or if force is True. returns whether a snapshot was written
+    fingerprint = export_fingerprint(ds)
+    manifest = read_manifest(ds)
+    if not force and manifest is not None and manifest['fingerprint'] == fingerprint:
+        log_callback('{}: unchanged since snapshot {}'.format(ds.name, manifest['version']))
+        return False
+    directory = snapshot_directory(ds)
+    os.makedirs(directory, exist_ok=True)
+    version = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    files = {}
+    for export_format, generate in [('csv', export_metadata_csv), ('parquet', export_metadata_parquet)]:
+        filename = '{}-{}.{}'.format(ds.name, version, export_format)
+        path = os.path.join(directory, filename)
+        log_callback('{}: writing {}'.format(ds.name, path))
+        bins = bin_query(dataset_name=ds.name, filter_skip=False)
+        with open(path + '.part', 'w' if export_format == 'csv' else 'wb') as fout:
+            for chunk in generate(ds, bins):
+                fout.write(chunk)
+        os.replace(path + '.part', path)
+        files[export_format] = filename
+    previous = []
+    if manifest is not None:
+        previous = [{ 'version': manifest['version'], 'files': manifest['files'] }] + manifest['previous']
+    manifest = {
+        'version': version,
+        'fingerprint': fingerprint,
+        'files': files,
+        'previous': previous[:SNAPSHOT_VERSIONS_KEPT],
+    }
+    manifest_path = os.path.join(directory, SNAPSHOT_MANIFEST)
+    with open(manifest_path + '.part', 'w') as fout:
+        json.dump(manifest, fout)
+    os.replace(manifest_path + '.part', manifest_path)
+    remove_old_snapshots(ds, manifest)
+    return True
+
+def remove_old_snapshots(ds, manifest):
+    # deletes snapshot files that are neither current nor kept
+    keep = set([SNAPSHOT_MANIFEST])
+    for m in [manifest] + manifest['previous']:
+        keep.update(m['files'].values())
+    directory = snapshot_directory(ds)
+    for filename in os.listdir(directory):
+        if filename not in keep:
+            os.remove(os.path.join(directory, filename))
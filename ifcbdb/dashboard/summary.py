@@ -0,0 +1,106 @@
+import time
+
+from collections import namedtuple
+
+from ifcb.data.adc import SCHEMA_VERSION_1
+from ifcb.data.files import Fileset, FilesetBin
+from ifcb.data.stitching import InfilledImages
+
+from .qaqc import check_bad, check_no_rois
+
+# everything accession needs from a fileset. fields that could not be read are None
+BIN_SUMMARY_FIELDS = [
+    'pid',
+    'size', # total size of the fileset in bytes
+    'sizes', # sizes of the individual files, keyed by extension
+    'n_targets', # number of ADC rows
+    'n_triggers',
+    'n_images',
+    'ml_analyzed',
+    'look_time',
+    'run_time',
+    'temperature',
+    'humidity',
+    'headers', # parsed .hdr attributes
+    'qc_bad',
+    'qc_no_rois',
+    'error', # why the bin cannot be accessioned, or None
+    'timings', # seconds spent in each stage of summarizing, keyed by stage
+]
+
+BinSummary = namedtuple('BinSummary', BIN_SUMMARY_FIELDS, defaults=(None,) * len(BIN_SUMMARY_FIELDS))
+
+def summarize_bin(bin):
+    # reads each of the bin's files once and returns a BinSummary
+    s = { 'pid': bin.lid, 'qc_bad': False, 'qc_no_rois': False, 'timings': {} }
+    clock = [time.perf_counter()]
+    def lap(stage): # charge the time since the last lap to a stage
+        now = time.perf_counter()
+        s['timings'][stage] = s['timings'].get(stage, 0) + now - clock[0]
+        clock[0] = now
+    error = _summarize(bin, s, lap)
+    return BinSummary(error=error, **s)
+
+def _summarize(bin, s, lap):
+    # fills in the summary fields in s, returning an error message if the bin is bad
+    s['sizes'] = bin.fileset.getsizes() # assumes FilesetBin
+    s['size'] = sum(s['sizes'].values())
+    try:
+        s['n_targets'] = len(bin)
+        s['n_images'] = len(bin.images)
+    except: # bad ADC data
+        pass
+    lap('adc')
+    # qaqc checks
+    if check_bad(BinSummary(**s)):
+        s['qc_bad'] = True
+        lap('qc')
+        return 'malformed raw data'
+    if check_no_rois(BinSummary(**s)):
+        s['qc_bad'] = True
+        s['qc_no_rois'] = True
+        lap('qc')
+        return 'zero ROIs'
+    lap('qc')
+    # more error checking for setting attributes
+    try:
+        ml_analyzed = bin.ml_analyzed
+        s['ml_analyzed'] = ml_analyzed
+        if ml_analyzed <= 0:
+            s['qc_bad'] = True
+            return 'ml_analyzed <= 0'
+    except Exception as e:
+        s['qc_bad'] = True
+        return 'ml_analyzed: {}'.format(str(e))
+    finally:
+        lap('headers') # counted with the headers, which ml_analyzed is mostly computed from
+    # metadata
+    try:
+        s['headers'] = bin.hdr_attributes
+    except Exception as e:
+        s['qc_bad'] = True
+        return 'header: {}'.format(str(e))
+    finally:
+        lap('headers')
+    # metrics
+    try:
+        s['temperature'] = bin.temperature
+    except KeyError: # older data
+        s['temperature'] = 0
+    try:
+        s['humidity'] = bin.humidity
+    except KeyError: # older data
+        s['humidity'] = 0
+    s['look_time'] = bin.look_time
+    s['run_time'] = bin.run_time
+    s['n_triggers'] = bin.n_triggers
+    if bin.pid.schema_version == SCHEMA_VERSION_1:
+        # count stitched images instead of raw ROIs
+        s['n_images'] = len(InfilledImages(bin))
+    lap('metrics')
+    if s['n_images'] / ml_analyzed < 0: # metadata is bogus!
+        return 'rois/ml is < 0'
+
+def summarize_fileset(basepath):
+    # runs in accession worker processes, which are handed paths rather than bins
+    return summarize_bin(FilesetBin(Fileset(basepath)))
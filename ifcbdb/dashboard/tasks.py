@@ -1,3 +1,4 @@
+import os
 import time
 
 from celery import shared_task
@@ -6,6 +7,7 @@ from celery import signals
 import numpy as np
 import pandas as pd
 
+from django.conf import settings
 from django.core.cache import cache
 
 from .mosaic import Mosaic
@@ -39,12 +41,16 @@ def mosaic_coordinates_task(bin_id, shape=(600,800), scale=0.33, cache_key=None)
     return result
 
 @shared_task(bind=True)
-def sync_dataset(self, dataset_id, lock_key, cancel_key, newest_only=True):
+def sync_dataset(self, dataset_id, lock_key, cancel_key, newest_only=True, n_workers=None, distributed=None,
+        timing=True):
     from dashboard.models import Dataset
     from dashboard.accession import Accession
+    if n_workers is None:
+        n_workers = settings.ACCESSION_WORKERS
+    if distributed is None:
+        distributed = settings.ACCESSION_DISTRIBUTED
     ds = Dataset.objects.get(id=dataset_id)
     print('syncing dataset {}'.format(ds.name))
-    acc = Accession(ds, newest_only=newest_only)
     def progress_callback(p):
         self.update_state(state='PROGRESS', meta=p)
         cancel = cache.get(cancel_key)
@@ -53,16 +59,139 @@ def sync_dataset(self, dataset_id, lock_key, cancel_key, newest_only=True):
         return True
     result = None
     try:
-        result = acc.sync(progress_callback=progress_callback)
+        if distributed:
+            acc = Accession(ds, newest_only=newest_only, n_workers=n_workers, timing=timing)
+            result = distributed_sync(self.request.id, acc, cancel_key, progress_callback)
+        else:
+            acc = Accession(ds, newest_only=newest_only, n_workers=n_workers, timing=timing)
+            result = acc.sync(progress_callback=progress_callback)
     finally:
         cache.delete(cancel_key) # warning: slow
         cache.delete(lock_key) # warning: slow
     return result
 
+# distributed sync. the task that scans the dataset partitions the new filesets into chunks
+# and queues a subtask for each, then merges the chunks' progress, which they report via
+# the cache. a chunk is processed by whoever claims it first, and the scanning task claims
+# and processes chunks too, so the sync finishes even if no other worker is free. a claim
+# expires if its chunk stops reporting progress, so the chunks of a worker that dies are
+# picked up again
+
+# seconds a chunk can go without reporting progress before its claim expires
+SYNC_CHUNK_TIMEOUT = 600
+# seconds chunk progress is kept after the sync, so subtasks still queued know to do nothing
+SYNC_CHUNK_RESULT_TIMEOUT = 86400
+
+def sync_chunk_key(task_id, i):
+    return 'sync_chunk_{}_{}'.format(task_id, i)
+
+def claim_sync_chunk(key):
+    return cache.add(key + '_claim', True, timeout=SYNC_CHUNK_TIMEOUT) # this is atomic
+
+def run_sync_chunk(dataset_id, key, basepaths, manifest_entries, cancel_key, n_workers=1, timing=False,
+        on_progress=None):
+    from dashboard.models import Dataset
+    from dashboard.accession import Accession, progress
+    def progress_callback(p):
+        cache.set(key, p, timeout=None)
+        cache.touch(key + '_claim', SYNC_CHUNK_TIMEOUT)
+        if on_progress is not None:
+            on_progress()
+        return cache.get(cancel_key) is None
+    if cache.get(cancel_key) is not None:
+        p = progress('', 0, 0, 0)
+    else:
+        try:
+            acc = Accession(Dataset.objects.get(id=dataset_id), n_workers=n_workers, timing=timing)
+            p = acc.sync_filesets(basepaths, manifest_entries, progress_callback=progress_callback)
+        except Exception as e:
+            # report the failure rather than leave the scanning task waiting for the chunk
+            p = progress('', 0, 0, 0, { os.path.dirname(basepaths[0]): 'chunk failed: {}'.format(e) })
+            p['failed'] = True
+    p['done'] = True
+    cache.set(key, p, timeout=None)
+    if on_progress is not None:
+        on_progress()
+
+@shared_task
+def sync_dataset_chunk(dataset_id, key, basepaths, manifest_entries, cancel_key, n_workers=1, timing=False):
+    p = cache.get(key)
+    if p is not None and p.get('done'):
+        return
+    if claim_sync_chunk(key):
+        run_sync_chunk(dataset_id, key, basepaths, manifest_entries, cancel_key, n_workers, timing)
+
+def merge_sync_progress(chunk_progress, skipped, scan_timings=None):
+    from dashboard.accession import progress
+    from dashboard.timing import merge_timing_reports
+    added, total, bad = 0, skipped, 0
+    errors = {}
+    bin_id = ''
+    for p in chunk_progress:
+        if p is None:
+            continue
+        added += p['added']
+        total += p['total']
+        bad += p['bad']
+        errors.update((e['bin'], e['message']) for e in p['errors'])
+        bin_id = p['bin_id'] or bin_id
+    timings = merge_timing_reports([scan_timings] + [p.get('timings') for p in chunk_progress if p is not None])
+    return progress(bin_id, added, total, bad, errors, timings)
+
+def distributed_sync(task_id, acc, cancel_key, progress_callback):
+    dataset_id = acc.dataset.id
+    chunks = []
+    skipped = 0
+    scan_timings = None
+    def report():
+        return progress_callback(merge_sync_progress([cache.get(key) for key, _, _ in chunks], skipped, scan_timings))
+    report()
+    with acc.timer.stage('scan'):
+        for n_skipped, basepaths, entries in acc.chunks(settings.ACCESSION_CHUNK_SIZE):
+            skipped += n_skipped
+            if basepaths:
+                key = sync_chunk_key(task_id, len(chunks))
+                chunks.append((key, basepaths, entries))
+                sync_dataset_chunk.delay(dataset_id, key, basepaths, entries, cancel_key, acc.n_workers,
+                    acc.timer.enabled)
+            # scanning a large archive for the first time takes a while, so report the
+            # chunks queued so far as it goes, and stop if the sync is cancelled. chunks
+            # that have been queued see the cancellation and do nothing
+            if not report():
+                print('cancelled scan of dataset {}'.format(acc.dataset.name))
+                break
+    print('syncing {} chunks of dataset {}'.format(len(chunks), acc.dataset.name))
+    scan_timings = acc.timer.report()
+    while True:
+        chunk_progress = [cache.get(key) for key, _, _ in chunks]
+        if all(p is not None and p.get('done') for p in chunk_progress):
+            break
+        for (key, basepaths, entries), p in zip(chunks, chunk_progress):
+            if (p is None or not p.get('done')) and claim_sync_chunk(key):
+                run_sync_chunk(dataset_id, key, basepaths, entries, cancel_key, acc.n_workers, acc.timer.enabled,
+                    on_progress=report)
+        report()
+        time.sleep(1)
+    result = merge_sync_progress(chunk_progress, skipped, scan_timings)
+    failed = any(p.get('failed') for p in chunk_progress)
+    if not failed and cache.get(cancel_key) is None:
+        # every chunk was accessioned and recorded its good filesets, so record the
+        # directories, listing those with bad filesets again next time
+        bad_basepaths = []
+        for (key, basepaths, entries), p in zip(chunks, chunk_progress):
+            bad = set(e['bin'] for e in p['errors'])
+            bad_basepaths.extend(bp for bp in basepaths if os.path.basename(bp) in bad)
+        acc.exclude_from_manifests(bad_basepaths)
+        acc.commit_manifests()
+    for key, _, _ in chunks:
+        cache.touch(key, SYNC_CHUNK_RESULT_TIMEOUT)
+    progress_callback(result)
+    return result
+
 @shared_task(bind=True)
-def import_metadata(self, json_dataframe, lock_key, cancel_key):
-    from dashboard.accession import import_metadata
-    df = pd.read_json(json_dataframe)
+def import_metadata(self, csv_path, lock_key, cancel_key):
+    # csv_path is an uploaded file in the METADATA_UPLOAD_DIR spool, which is deleted when done
+    from dashboard.accession import import_metadata_csv
     def progress_callback(p):
         self.update_state(state='PROGRESS', meta=p)
         cancel = cache.get(cancel_key)
@@ -71,10 +200,14 @@ def import_metadata(self, json_dataframe, lock_key, cancel_key):
         return True
     result = None
     try:
-        result = import_metadata(df, progress_callback=progress_callback)
+        result = import_metadata_csv(csv_path, progress_callback=progress_callback)
     except:
         self.update_state(state='ERROR', meta={})
     finally:
         cache.delete(cancel_key)
         cache.delete(lock_key)
+        try:
+            os.remove(csv_path)
+        except FileNotFoundError:
+            pass
     return result
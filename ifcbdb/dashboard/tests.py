@@ -1,3 +1,575 @@
-from django.test import TestCase
+import os
+import json
+import shutil
+import tempfile
+import time
 
-# Create your tests here.
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+import pandas as pd
+
+from ifcb.data.adc import SCHEMA_VERSION_2
+
+from .models import Bin, BinRollup, BinSummary, Comment, DataDirectory, Dataset, Instrument, Tag, TagEvent, \
+    Timeline, bin_query, m4_downsample
+from .rollups import ROLLUP_METRICS, update_rollups, rebuild_rollups, rebuild_summaries, delete_bins
+from .accession import Accession, add_tags, export_metadata_rows, import_metadata, import_metadata_csv
+from .benchmark import generate_filesets, write_fileset
+from .manifest import Manifest
+
+START = datetime(2021, 3, 1, tzinfo=timezone.utc) # a Monday
+
+def make_bins(instrument, datasets, n, start=START, step=timedelta(hours=13)):
+    # n bins with distinct metric values, step apart, in the given datasets
+    bins = []
+    for i in range(n):
+        t = start + step * i
+        b = Bin.objects.create(pid='D{}_IFCB{:03d}'.format(t.strftime('%Y%m%dT%H%M%S'), instrument.number),
+            timestamp=t, sample_time=t, instrument=instrument,
+            size=1000 + i * 7, n_triggers=100 + i, n_images=50 + (i * 3) % 11,
+            temperature=10 + (i % 5) * 0.5, humidity=40 + (i % 7), run_time=1200 - i,
+            look_time=1100 - i, ml_analyzed=4.5 + (i % 3) * 0.1, concentration=(50 + i) / 4.5)
+        b.datasets.add(*datasets)
+        bins.append(b)
+    return bins
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.i1 = Instrument.objects.create(number=101)
+        self.i2 = Instrument.objects.create(number=102)
+        self.ds = Dataset.objects.create(name='rollups', title='rollups')
+        self.other = Dataset.objects.create(name='other', title='other')
+        self.bins = make_bins(self.i1, [self.ds], 60) + make_bins(self.i2, [self.ds, self.other], 40,
+            step=timedelta(hours=7))
+        update_rollups([b.id for b in self.bins])
+
+    def scopes(self):
+        return [(self.ds, None), (self.ds, self.i1), (self.ds, self.i2), (self.other, None),
+            (None, self.i1), (None, self.i2), (None, None)]
+
+    def bin_qs(self, dataset, instrument):
+        qs = Bin.objects.all()
+        if dataset is not None:
+            qs = qs.filter(datasets=dataset)
+        if instrument is not None:
+            qs = qs.filter(instrument=instrument)
+        return qs
+
+    def assertMatchesBins(self, metric, resolution, dataset, instrument, start=None, end=None):
+        # the rollups give the same series as averaging the bins themselves
+        expected, _ = Timeline(self.bin_qs(dataset, instrument)).metrics(metric, start, end,
+            resolution=resolution, apply_offset=False)
+        actual = BinRollup.time_series(metric, resolution, dataset, instrument, start, end)
+        expected = list(expected)
+        self.assertEqual([r['dt'] for r in actual], [r['dt'] for r in expected],
+            '{} {} {} {}'.format(metric, resolution, dataset, instrument))
+        for a, e in zip(actual, expected):
+            self.assertAlmostEqual(a['metric'], e['metric'], places=6)
+
+    def assertAllMatch(self, resolutions=('hour', 'day', 'week', 'month'), **kwargs):
+        for dataset, instrument in self.scopes():
+            for resolution in resolutions:
+                for metric in ROLLUP_METRICS:
+                    self.assertMatchesBins(metric, resolution, dataset, instrument, **kwargs)
+
+    def test_time_series_matches_bins(self):
+        self.assertAllMatch()
+
+    def test_time_series_matches_bins_between_period_boundaries(self):
+        # months are left out, as the window starts partway through one
+        self.assertAllMatch(('hour', 'day', 'week'), start=START + timedelta(days=7),
+            end=START + timedelta(days=14) - timedelta(microseconds=1))
+
+    def test_partial_start_period_is_included_whole(self):
+        start = START + timedelta(hours=12)
+        series = BinRollup.time_series('size', 'day', self.ds, self.i1, start)
+        self.assertEqual(series[0]['dt'], START)
+        first_day = Bin.objects.filter(datasets=self.ds, instrument=self.i1, sample_time__lt=START + timedelta(days=1))
+        self.assertAlmostEqual(series[0]['metric'], sum(b.size for b in first_day) / first_day.count())
+
+    def test_skip_and_unskip(self):
+        b = self.bins[10]
+        b.skip = True
+        b.save()
+        update_rollups([b.id])
+        self.assertAllMatch()
+        b.skip = False
+        b.save()
+        update_rollups([b.id])
+        self.assertAllMatch()
+
+    def test_skipping_every_bin_in_a_period(self):
+        day = Bin.objects.filter(instrument=self.i1, sample_time__lt=START + timedelta(days=1))
+        ids = list(day.values_list('id', flat=True))
+        day.update(skip=True)
+        update_rollups(ids)
+        self.assertAllMatch()
+        self.assertFalse(any(r['dt'] == START for r in BinRollup.time_series('size', 'day', None, self.i1)))
+
+    def test_sample_time_change(self):
+        b = self.bins[5]
+        old = b.sample_time
+        b.sample_time = START + timedelta(days=60)
+        b.save()
+        update_rollups([b.id], [old])
+        self.assertAllMatch()
+
+    def test_metric_change(self):
+        b = self.bins[20]
+        b.temperature = 99
+        b.save()
+        update_rollups([b.id])
+        self.assertAllMatch()
+
+    def test_rebuild_is_idempotent(self):
+        n = BinRollup.objects.count()
+        rebuild_rollups()
+        rebuild_rollups(dataset_ids=[self.ds.id], instrument_ids=[self.i1.id])
+        self.assertEqual(BinRollup.objects.count(), n)
+        self.assertAllMatch()
+
+    def test_summaries_match_bins(self):
+        self.bins[3].skip = True
+        self.bins[3].save()
+        update_rollups([self.bins[3].id])
+        rebuild_summaries()
+        for dataset, instrument in self.scopes():
+            qs = self.bin_qs(dataset, instrument)
+            live = qs.filter(skip=False)
+            totals = BinSummary.totals(dataset, instrument)
+            self.assertEqual(totals['n_bins'], live.count())
+            self.assertEqual(totals['n_skipped'], qs.filter(skip=True).count())
+            self.assertEqual(totals['size'], sum(b.size for b in live))
+            self.assertEqual(totals['n_images'], sum(b.n_images for b in live))
+            self.assertEqual(totals['first_sample_time'], min(b.sample_time for b in live))
+            self.assertEqual(totals['last_sample_time'], max(b.sample_time for b in live))
+
+    def assertDatasetCountsMatchBins(self):
+        for ds in [self.ds, self.other]:
+            bins = Bin.objects.filter(datasets=ds)
+            self.assertEqual(len(ds), bins.count(), ds.name)
+            self.assertEqual(ds.data_volume(), sum(b.size for b in bins.filter(skip=False)), ds.name)
+
+    def test_dataset_counts_match_bins(self):
+        self.assertDatasetCountsMatchBins()
+        # add
+        added = make_bins(self.i1, [self.other], 5, start=START + timedelta(days=90))
+        update_rollups([b.id for b in added])
+        self.assertDatasetCountsMatchBins()
+        # skip
+        skipped = [self.bins[0].id, self.bins[70].id]
+        Bin.objects.filter(id__in=skipped).update(skip=True)
+        update_rollups(skipped)
+        self.assertDatasetCountsMatchBins()
+        # delete bins selected from one dataset, which are in the other too
+        deleted = [b.id for b in self.bins[65:75]]
+        dataset_ids = delete_bins(self.other.bins.filter(id__in=deleted))
+        self.assertEqual(dataset_ids, {self.ds.id, self.other.id})
+        self.assertDatasetCountsMatchBins()
+        call_command('deleteallbins', dataset='other')
+        self.assertEqual(len(self.other), 0)
+        self.assertEqual(self.other.data_volume(), 0)
+        self.assertDatasetCountsMatchBins()
+
+class DownsampleTests(SimpleTestCase):
+    def records(self, n, start=START, step=timedelta(minutes=7)):
+        # a series whose values jump about, so each bucket's extremes are not at its ends
+        return [{ 'dt': start + step * i, 'metric': (i * 37) % 101 } for i in range(n)]
+
+    def assertKeepsBucketExtremes(self, records, result, start, end, n_buckets):
+        width = (end - start) / n_buckets
+        for b in range(n_buckets):
+            bucket = [r for r in records if start + width * b <= r['dt'] < start + width * (b + 1)
+                or (b == n_buckets - 1 and r['dt'] == end)]
+            if not bucket:
+                continue
+            kept = [r for r in result if r in bucket]
+            self.assertIn(bucket[0], kept)
+            self.assertIn(bucket[-1], kept)
+            self.assertEqual(min(r['metric'] for r in kept), min(r['metric'] for r in bucket))
+            self.assertEqual(max(r['metric'] for r in kept), max(r['metric'] for r in bucket))
+
+    def test_downsample(self):
+        records = self.records(1000)
+        start, end = records[0]['dt'], records[-1]['dt']
+        for max_points in [4, 40, 41, 400]:
+            n_buckets = max_points // 4
+            result = m4_downsample(iter(records), start, end, n_buckets)
+            self.assertLessEqual(len(result), max_points)
+            self.assertEqual(sorted(result, key=lambda r: r['dt']), result)
+            self.assertTrue(all(r in records for r in result))
+            self.assertKeepsBucketExtremes(records, result, start, end, n_buckets)
+
+    def test_short_series_is_unchanged(self):
+        # no more than two records in each bucket, so all of them are its first or last
+        records = self.records(20)
+        self.assertEqual(m4_downsample(records, records[0]['dt'], records[-1]['dt'], 10), records)
+
+    def test_records_outside_the_range_go_in_the_end_buckets(self):
+        records = self.records(100)
+        result = m4_downsample(records, records[10]['dt'], records[89]['dt'], 5)
+        self.assertLessEqual(len(result), 20)
+        self.assertEqual(result[0], records[0])
+        self.assertEqual(result[-1], records[-1])
+
+    def test_no_time_range(self):
+        self.assertEqual(m4_downsample(self.records(10), None, None, 10), [])
+
+class BinMetricsTests(TestCase):
+    def test_max_points(self):
+        instrument = Instrument.objects.create(number=104)
+        make_bins(instrument, [], 200, step=timedelta(minutes=20))
+        timeline = Timeline(Bin.objects.all())
+        everything, _ = timeline.metrics('temperature', resolution='bin')
+        everything = list(everything)
+        for max_points in [8, 100]:
+            result, _ = timeline.metrics('temperature', resolution='bin', max_points=max_points)
+            self.assertLessEqual(len(result), max_points)
+            self.assertEqual(result[0], everything[0])
+            self.assertEqual(result[-1], everything[-1])
+            self.assertEqual(min(r['metric'] for r in result), min(r['metric'] for r in everything))
+            self.assertEqual(max(r['metric'] for r in result), max(r['metric'] for r in everything))
+
+class AdjacentBinsTests(TestCase):
+    def setUp(self):
+        self.instrument = Instrument.objects.create(number=105)
+        self.ds = Dataset.objects.create(name='adjacent', title='adjacent')
+        self.bins = make_bins(self.instrument, [self.ds], 5)
+        # bins sharing a sample time are ordered by pid
+        t = self.bins[2].sample_time
+        self.ties = [Bin.objects.create(pid='{}_IFCB{:03d}'.format(self.bins[2].pid.split('_')[0], n),
+            timestamp=t, sample_time=t, instrument=self.instrument) for n in [106, 107]]
+        for b in self.ties:
+            b.datasets.add(self.ds)
+
+    def ordered(self, qs):
+        return list(qs.order_by('sample_time', 'pid'))
+
+    def assertAdjacent(self, timeline, ordered):
+        for i, b in enumerate(ordered):
+            prev_bin, next_bin = timeline.adjacent_bins(b)
+            self.assertEqual(prev_bin, ordered[i - 1] if i > 0 else None, b.pid)
+            self.assertEqual(next_bin, ordered[i + 1] if i < len(ordered) - 1 else None, b.pid)
+
+    def test_adjacent_bins(self):
+        ordered = self.ordered(Bin.objects.all())
+        self.assertEqual(ordered[2:5], [self.bins[2]] + self.ties)
+        self.assertAdjacent(Timeline(Bin.objects.all()), ordered)
+
+    def test_filtered_queryset(self):
+        self.ties[0].skip = True
+        self.ties[0].save()
+        other = make_bins(self.instrument, [], 3, start=START + timedelta(hours=1))
+        timeline = Timeline(Bin.objects.filter(datasets=self.ds))
+        self.assertAdjacent(timeline, self.ordered(Bin.objects.filter(datasets=self.ds, skip=False)))
+        # bins the timeline leaves out still have neighbours in it
+        self.assertEqual(timeline.adjacent_bins(self.ties[0]), (self.bins[2], self.ties[1]))
+        self.assertEqual(timeline.adjacent_bins(other[0]), (self.bins[0], self.bins[1]))
+
+    def test_empty_queryset(self):
+        for qs in [Bin.objects.none(), Bin.objects.filter(datasets__name='no such dataset')]:
+            self.assertEqual(Timeline(qs).adjacent_bins(self.bins[2]), (None, None))
+
+class TagTests(TestCase):
+    def setUp(self):
+        self.instrument = Instrument.objects.create(number=103)
+        self.ds = Dataset.objects.create(name='tags', title='tags')
+        self.b1, self.b2, self.b3 = make_bins(self.instrument, [self.ds], 3)
+
+    def tag_ids(self, b):
+        return sorted(Bin.objects.get(id=b.id).tag_ids)
+
+    def tag_id(self, name):
+        return Tag.objects.get(name=name).id
+
+    def pids(self, *tags):
+        return set(bin_query(tags=list(tags)).values_list('pid', flat=True))
+
+    def test_add_and_delete_tag(self):
+        self.b1.add_tag('Bloom')
+        self.b1.add_tag('bloom') # already added
+        self.b1.add_tag('ciliate')
+        self.assertEqual(self.tag_ids(self.b1), sorted([self.tag_id('bloom'), self.tag_id('ciliate')]))
+        self.assertEqual(self.tag_ids(self.b2), [])
+        self.b1.delete_tag('Bloom')
+        self.assertEqual(self.tag_ids(self.b1), [self.tag_id('ciliate')])
+
+    def test_add_tags(self):
+        self.b1.add_tag('bloom')
+        add_tags([(self.b1, 'bloom'), (self.b1, 'ciliate'), (self.b2, 'ciliate'), (self.b2, 'ciliate')])
+        self.assertEqual(TagEvent.objects.count(), 3)
+        self.assertEqual(self.tag_ids(self.b1), sorted([self.tag_id('bloom'), self.tag_id('ciliate')]))
+        self.assertEqual(self.tag_ids(self.b2), [self.tag_id('ciliate')])
+        self.assertEqual(self.tag_ids(self.b3), [])
+
+    def test_cascade_deletes(self):
+        add_tags([(self.b1, 'bloom'), (self.b1, 'ciliate'), (self.b2, 'bloom')])
+        Tag.objects.get(name='bloom').delete()
+        self.assertEqual(self.tag_ids(self.b1), [self.tag_id('ciliate')])
+        self.assertEqual(self.tag_ids(self.b2), [])
+        TagEvent.objects.all().delete()
+        self.assertEqual(self.tag_ids(self.b1), [])
+
+    def test_save_keeps_tag_ids(self):
+        stale = Bin.objects.get(id=self.b1.id)
+        self.b1.add_tag('bloom')
+        stale.cruise = 'EN123'
+        stale.save()
+        self.assertEqual(self.tag_ids(self.b1), [self.tag_id('bloom')])
+        self.assertEqual(Bin.objects.get(id=self.b1.id).cruise, 'EN123')
+
+    def test_bin_query_tags(self):
+        add_tags([(self.b1, 'bloom'), (self.b1, 'ciliate'), (self.b2, 'bloom'), (self.b3, 'ciliate')])
+        self.assertEqual(self.pids('bloom'), {self.b1.pid, self.b2.pid})
+        self.assertEqual(self.pids('bloom', 'ciliate'), {self.b1.pid})
+        self.assertEqual(self.pids('BLOOM', 'Ciliate'), {self.b1.pid})
+        self.assertEqual(self.pids('bloom', 'nonesuch'), set())
+
+    def test_export_tag_columns(self):
+        add_tags([(self.b1, 'bloom'), (self.b1, 'ciliate'), (self.b2, 'bloom')])
+        columns, rows = export_metadata_rows(self.ds, bin_query(dataset_name='tags', tags=['bloom']))
+        self.assertEqual([c for c in columns if c.startswith('tag')], ['tag1', 'tag2'])
+        rows = list(rows)
+        self.assertEqual([r[1] for r in rows], [self.b1.pid, self.b2.pid])
+        tag1 = columns.index('tag1')
+        self.assertEqual([r[tag1:tag1 + 2] for r in rows], [['bloom', 'ciliate'], ['bloom', '']])
+
+    def test_bin_query_tags_differing_in_case(self):
+        # names from before tag names were normalized can differ only in case
+        foo_upper = Tag.objects.create(name='Foo')
+        foo_lower = Tag.objects.create(name='foo')
+        bar = Tag.objects.create(name='bar')
+        TagEvent.objects.bulk_create([TagEvent(bin=self.b1, tag=foo_upper), TagEvent(bin=self.b1, tag=bar),
+            TagEvent(bin=self.b2, tag=foo_lower), TagEvent(bin=self.b2, tag=bar), TagEvent(bin=self.b3, tag=foo_lower)])
+        self.assertEqual(self.pids('foo'), {self.b1.pid, self.b2.pid, self.b3.pid})
+        self.assertEqual(self.pids('FOO', 'bar'), {self.b1.pid, self.b2.pid})
+        self.b2.skip = True
+        self.b2.save()
+        self.assertEqual(self.pids('foo', 'bar'), {self.b1.pid})
+
+def age_files(root, seconds=3600):
+    # make filesets look like they are no longer being written, see manifest.SETTLE_TIME
+    then = time.time() - seconds
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            os.utime(os.path.join(dirpath, name), (then, then))
+
+class ManifestTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        # 80 bins 20 minutes apart, in two day directories
+        self.basepaths, _ = generate_filesets(self.root, 80, schema_versions=(SCHEMA_VERSION_2,), n_rois=10,
+            bad_fraction=0)
+        age_files(self.root)
+        self.ds = Dataset.objects.create(name='manifest', title='manifest')
+        self.dd = DataDirectory.objects.create(dataset=self.ds, path=self.root, kind=DataDirectory.RAW)
+
+    def sync(self, newest_only=False, progress_callback=lambda p: True):
+        return Accession(self.ds, batch_size=10, newest_only=newest_only).sync(progress_callback=progress_callback)
+
+    def pids(self, basepaths):
+        return set(os.path.basename(bp) for bp in basepaths)
+
+    def test_unchanged_directories_are_not_listed(self):
+        self.assertEqual(self.sync()['added'], 80)
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            self.assertEqual(list(Manifest(self.dd).scan()), [])
+        self.assertEqual(scandir.call_count, 0)
+        # a new fileset changes only its own directory
+        new_basepath = os.path.join(os.path.dirname(self.basepaths[0]), 'D20000101T235000_IFCB999')
+        write_fileset(new_basepath, SCHEMA_VERSION_2, 10)
+        age_files(self.root)
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            self.assertEqual(list(Manifest(self.dd).scan()), [new_basepath])
+        self.assertEqual([c.args[0] for c in scandir.call_args_list], [os.path.dirname(new_basepath)])
+        self.assertEqual(self.sync()['added'], 1)
+        self.assertEqual(self.sync()['total'], 0)
+
+    def test_skipped_directories_are_not_scanned(self):
+        for name in ['beads', 'bad']:
+            dirpath = os.path.join(self.root, name)
+            os.makedirs(dirpath)
+            write_fileset(os.path.join(dirpath, 'D20010101T000000_IFCB999'), SCHEMA_VERSION_2, 10)
+        age_files(self.root)
+        self.assertEqual(self.pids(Manifest(self.dd).scan()), self.pids(self.basepaths))
+
+    def test_resume_after_interruption(self):
+        prog = self.sync(progress_callback=lambda p: False) # cancels after the first batch
+        self.assertEqual(prog['added'], 10)
+        self.assertIsNotNone(DataDirectory.objects.get(id=self.dd.id).sync_checkpoint)
+        prog = self.sync()
+        self.assertEqual(prog['total'], 70)
+        self.assertEqual(prog['added'], 70)
+        self.assertEqual(self.ds.bins.count(), 80)
+        self.assertIsNone(DataDirectory.objects.get(id=self.dd.id).sync_checkpoint)
+        self.assertEqual(self.sync()['total'], 0)
+
+    def test_newest_only_then_full_sync(self):
+        newest = os.path.basename(self.basepaths[-1])
+        Accession(self.ds).sync_bins([newest])
+        prog = self.sync(newest_only=True)
+        self.assertEqual(prog['added'], 0)
+        self.assertEqual(self.ds.bins.count(), 1)
+        # the filesets newest_only left out are not recorded as scanned
+        prog = self.sync()
+        self.assertEqual(prog['added'], 79)
+        self.assertEqual(self.ds.bins.count(), 80)
+
+    def test_bad_bin_is_retried(self):
+        bad_basepath = self.basepaths[30]
+        write_fileset(bad_basepath, SCHEMA_VERSION_2, 10, bad='malformed_adc')
+        age_files(self.root)
+        prog = self.sync()
+        self.assertEqual((prog['added'], prog['bad']), (79, 1))
+        prog = self.sync()
+        self.assertEqual((prog['total'], prog['bad']), (1, 1))
+        # once the fileset is fixed it is accessioned
+        write_fileset(bad_basepath, SCHEMA_VERSION_2, 10)
+        age_files(self.root)
+        self.assertEqual(self.sync()['added'], 1)
+        self.assertEqual(self.sync()['total'], 0)
+
+@override_settings(SYNC_API_KEY='secret')
+class SyncBinsTests(TestCase):
+    def setUp(self):
+        Dataset.objects.create(name='sync', title='sync')
+
+    def post(self, **headers):
+        body = json.dumps({ 'dataset': 'sync', 'bins': ['D20210301T000000_IFCB101'] })
+        return self.client.post(reverse('sync_bins'), body, content_type='application/json', headers=headers)
+
+    def test_requires_api_key(self):
+        self.assertEqual(self.post().status_code, 403)
+        self.assertEqual(self.post(x_api_key='wrong').status_code, 403)
+        response = self.post(x_api_key='secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['result'], { 'D20210301T000000_IFCB101': 'not found' })
+
+    @override_settings(SYNC_API_KEY='')
+    def test_empty_key_is_not_accepted(self):
+        self.assertEqual(self.post(x_api_key='').status_code, 403)
+
+class ImportMetadataTests(TestCase):
+    def setUp(self):
+        self.instrument = Instrument.objects.create(number=104)
+        self.ds = Dataset.objects.create(name='import', title='import')
+        self.bins = make_bins(self.instrument, [self.ds], 4)
+        self.pids = [b.pid for b in self.bins]
+        update_rollups([b.id for b in self.bins])
+
+    def get(self, i):
+        return Bin.objects.get(pid=self.pids[i])
+
+    def test_row_errors(self):
+        df = pd.DataFrame({
+            'pid': [self.pids[0], None, 'D20000101T000000_IFCB104', self.pids[1], self.pids[2], self.pids[3]],
+            'latitude': [41.5, 41.5, 41.5, 'north', 41.5, 41.5],
+            'longitude': [-70.5, -70.5, -70.5, -70.5, -70.5, -70.5],
+            'niskin': [1, 2, 3, 4, 'five', 6],
+            'ml_analyzed': [4, 4, 4, 4, 4, 0],
+        })
+        prog = import_metadata(df)
+        self.assertEqual(prog['errors'], [
+            { 'row': 3, 'message': 'bin id must be specified' },
+            { 'row': 4, 'message': 'Bin D20000101T000000_IFCB104 not found' },
+            { 'row': 5, 'message': "Field 'latitude' expected a number but got 'north'." },
+            { 'row': 6, 'message': "invalid literal for int() with base 10: 'five'" },
+            { 'row': 7, 'message': 'float division by zero' },
+        ])
+        self.assertEqual(prog['n_modded'], 1)
+        self.assertTrue(prog['done'])
+        self.assertEqual(self.get(0).niskin, 1)
+        self.assertEqual(self.get(0).concentration, self.get(0).n_images / 4)
+        # bins with errors are left alone
+        self.assertIsNone(self.get(1).niskin)
+        self.assertIsNone(self.get(1).location)
+
+    def test_row_numbers_across_chunks(self):
+        path = os.path.join(tempfile.mkdtemp(), 'metadata.csv')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        pd.DataFrame({
+            'bin': self.pids + ['D20000101T000000_IFCB104'],
+            'cruise': ['EN{}'.format(i) for i in range(5)],
+        }).to_csv(path, index=False)
+        prog = import_metadata_csv(path, chunksize=2)
+        self.assertEqual(prog['errors'], [{ 'row': 6, 'message': 'Bin D20000101T000000_IFCB104 not found' }])
+        self.assertEqual(prog['n_modded'], 4)
+        self.assertEqual([self.get(i).cruise for i in range(4)], ['EN0', 'EN1', 'EN2', 'EN3'])
+
+    def test_skip(self):
+        df = pd.DataFrame({
+            'pid': self.pids,
+            'skip': ['Yes', 't', 'maybe', 2],
+        })
+        self.bins[2].skip = True
+        self.bins[2].save()
+        prog = import_metadata(df)
+        self.assertEqual(prog['errors'], [{ 'row': 5, 'message': 'skip value "2" had unsupported type "int"' }])
+        self.assertEqual([self.get(i).skip for i in range(4)], [True, True, True, False])
+        prog = import_metadata(pd.DataFrame({ 'pid': self.pids[:2], 'bad': [0, 1] }))
+        self.assertEqual(prog['errors'], [])
+        self.assertEqual([self.get(i).skip for i in range(2)], [False, True])
+        prog = import_metadata(pd.DataFrame({ 'pid': self.pids[:2], 'skip': [False, True] }))
+        self.assertEqual([self.get(i).skip for i in range(2)], [False, True])
+
+    def test_location(self):
+        df = pd.DataFrame({
+            'pid': self.pids[:3],
+            'lat': [41.5, None, 42],
+            'lon': [-70.5, -70, None],
+            'depth': [3.5, 4, None],
+        })
+        self.assertEqual(import_metadata(df)['errors'], [])
+        b = self.get(0)
+        self.assertEqual((b.latitude, b.longitude, b.depth), (41.5, -70.5, 3.5))
+        # a location needs both coordinates
+        self.assertIsNone(self.get(1).location)
+        self.assertEqual(self.get(1).depth, 4)
+        self.assertIsNone(self.get(2).location)
+        with self.assertRaises(KeyError):
+            import_metadata(pd.DataFrame({ 'pid': self.pids, 'latitude': [1, 2, 3, 4] }))
+
+    def test_tags_and_comments_are_not_duplicated(self):
+        self.bins[0].add_tag('bloom')
+        self.bins[0].add_comment('seen before')
+        df = pd.DataFrame({
+            'pid': [self.pids[0], self.pids[0], self.pids[1]],
+            'tag1': ['Bloom', 'ciliate', ' '],
+            'tag2': ['bloom', None, 'ciliate'],
+            'comment': ['seen before', 'new', 'new'],
+        })
+        prog = import_metadata(df)
+        self.assertEqual(prog['errors'], [])
+        self.assertEqual(sorted(self.get(0).tag_names), ['bloom', 'ciliate'])
+        self.assertEqual(self.get(1).tag_names, ['ciliate'])
+        self.assertEqual(sorted(Comment.objects.filter(bin=self.bins[0]).values_list('content', flat=True)),
+            ['new', 'seen before'])
+        self.assertEqual(Comment.objects.filter(bin=self.bins[1]).count(), 1)
+        prog = import_metadata(pd.DataFrame({ 'pid': self.pids[:1], 'tag': ['123'] }))
+        self.assertEqual(prog['errors'], [{ 'row': 2, 'message': 'tag "123" consists of digits' }])
+
+    def test_rollups_are_updated_with_old_sample_times(self):
+        old = [b.sample_time for b in self.bins[:2]]
+        df = pd.DataFrame({
+            'pid': self.pids[:2],
+            'date': ['2021-05-01T10:00:00Z', '2021-05-02 12:00'],
+        })
+        with mock.patch('dashboard.accession.update_rollups', wraps=update_rollups) as update:
+            self.assertEqual(import_metadata(df)['errors'], [])
+        update.assert_called_once_with([self.bins[0].id, self.bins[1].id], old)
+        self.assertEqual(self.get(0).sample_time, datetime(2021, 5, 1, 10, tzinfo=timezone.utc))
+        self.assertEqual(self.get(1).sample_time, datetime(2021, 5, 2, 12, tzinfo=timezone.utc))
+        series = BinRollup.time_series('size', 'day', self.ds, self.instrument)
+        expected, _ = Timeline(Bin.objects.filter(datasets=self.ds)).metrics('size', resolution='day',
+            apply_offset=False)
+        self.assertEqual([r['dt'] for r in series], [r['dt'] for r in expected])
+        # changes to fields rollups don't cover leave them alone
+        with mock.patch('dashboard.accession.update_rollups') as update:
+            import_metadata(pd.DataFrame({ 'pid': self.pids[:1], 'cruise': ['EN1'] }))
+        update.assert_not_called()
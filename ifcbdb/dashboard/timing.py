@@ -0,0 +1,84 @@
+import heapq
+import time
+
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+class StageTimer(object):
+    """
+    Accumulates the time spent in, and the number of items passed through, each stage
+    of a process such as accession, along with per-batch throughput and the slowest
+    items. If enabled is False, nothing is recorded and report() returns None.
+    """
+    def __init__(self, enabled=True, n_slowest=10, n_batches=20):
+        self.enabled = enabled
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.n_slowest = n_slowest
+        self.slowest = [] # min-heap of (seconds, item)
+        self.batches = deque(maxlen=n_batches) # most recent batches only
+        self.started = time.time()
+    @contextmanager
+    def stage(self, name, count=1):
+        if not self.enabled:
+            yield
+            return
+        then = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - then, count)
+    def add(self, name, seconds, count=1):
+        if not self.enabled:
+            return
+        self.seconds[name] += seconds
+        self.counts[name] += count
+    def add_item(self, item, seconds):
+        # record an item's total time, keeping only the slowest
+        if not self.enabled:
+            return
+        if len(self.slowest) < self.n_slowest:
+            heapq.heappush(self.slowest, (seconds, item))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, item))
+    def add_batch(self, n_items, seconds):
+        if not self.enabled:
+            return
+        self.batches.append({
+            'items': n_items,
+            'seconds': round(seconds, 3),
+            'per_second': round(n_items / seconds, 2) if seconds > 0 else None,
+        })
+    def report(self):
+        # JSON-serializable summary, suitable for progress meta and task results
+        if not self.enabled:
+            return None
+        return {
+            'elapsed': round(time.time() - self.started, 3),
+            'stages': dict((name, {
+                'seconds': round(self.seconds[name], 3),
+                'count': self.counts[name],
+            }) for name in self.seconds),
+            'batches': list(self.batches),
+            'slowest': [{ 'item': item, 'seconds': round(seconds, 3) }
+                for seconds, item in sorted(self.slowest, reverse=True)],
+        }
+
+def merge_timing_reports(reports, n_slowest=10, n_batches=20):
+    # combine reports from timers that ran concurrently, e.g. in separate tasks
+    reports = [r for r in reports if r is not None]
+    if not reports:
+        return None
+    stages = {}
+    for r in reports:
+        for name, stage in r['stages'].items():
+            merged = stages.setdefault(name, { 'seconds': 0, 'count': 0 })
+            merged['seconds'] = round(merged['seconds'] + stage['seconds'], 3)
+            merged['count'] += stage['count']
+    slowest = sorted((s for r in reports for s in r['slowest']), key=lambda s: s['seconds'], reverse=True)
+    return {
+        'elapsed': max(r['elapsed'] for r in reports),
+        'stages': stages,
+        'batches': [b for r in reports for b in r['batches']][-n_batches:],
+        'slowest': slowest[:n_slowest],
+    }
@@ -1,18 +1,22 @@
+import hmac
 import json
 import re
 from io import BytesIO
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 from datetime import timedelta
 
 from django.conf import settings
+from django.db import transaction
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, get_object_or_404, reverse
 from django.http import \
     HttpResponse, FileResponse, Http404, HttpResponseBadRequest, JsonResponse, \
-    HttpResponseRedirect, HttpResponseNotFound, StreamingHttpResponse
+    HttpResponseRedirect, HttpResponseNotFound, HttpResponseForbidden, StreamingHttpResponse
 from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
 from django.core.cache import cache
@@ -24,8 +28,11 @@ from ifcb.data.adc import schema_names
 from .models import Dataset, Bin, Instrument, Timeline, bin_query, Tag, Comment, normalize_tag_name
 from .forms import DatasetSearchForm
 from common.utilities import *
+from common.parquet import stream_parquet, PARQUET_CONTENT_TYPE
 
-from dashboard.accession import Accession, export_metadata
+from dashboard.accession import Accession, export_metadata_csv, export_metadata_parquet
+from dashboard.snapshots import snapshot_path, SNAPSHOT_FORMATS
+from dashboard.rollups import update_rollups
 
 def index(request):
     if settings.DEFAULT_DATASET:
@@ -196,6 +203,25 @@ def filter_parameters_bin_query(method):
 
     return bin_qs
 
+def filter_parameters_rollup_scope(method):
+    # the dataset and instrument whose rollups total the bins filter_parameters_bin_query
+    # selects, or None if it selects them on anything else
+    if request_get_tags(method.get('tags')) or request_get_cruise(method.get('cruise')) \
+            or request_get_sample_type(method.get('sample_type')):
+        return None
+    dataset_name = method.get('dataset')
+    instrument_number = request_get_instrument(method.get('instrument'))
+    dataset, instrument = None, None
+    if dataset_name:
+        dataset = Dataset.objects.filter(name=dataset_name).first()
+        if dataset is None:
+            return None
+    if instrument_number:
+        instrument = Instrument.objects.filter(number=instrument_number).first()
+        if instrument is None:
+            return None
+    return dataset, instrument
+
 def timeline_page(request):
     bin_id = request.GET.get("bin")
     dataset_name = request.GET.get("dataset")
@@ -777,8 +803,7 @@ def _bin_details(bin, dataset=None, view_size=None, scale_factor=None, preload_a
             dataset_name = None
         bin_qs = bin_query(dataset_name=dataset_name, instrument_number=instrument_number,
             tags=tags, cruise=cruise, sample_type=sample_type)
-        previous_bin = Timeline(bin_qs).previous_bin(bin)
-        next_bin = Timeline(bin_qs).next_bin(bin)
+        previous_bin, next_bin = Timeline(bin_qs).adjacent_bins(bin)
 
     if preload_adjacent_bins:
         if previous_bin is not None:
@@ -847,8 +872,19 @@ def _mosaic_page_image(request, bin_id):
 #   are needed to let the UI know that certain levels are "off limits" and avoid re-running data when we know it's
 #   just going to force us down to a finer resolution anyway
 # TODO: Handle tag/instrument grouping
+# most points a bin-resolution time series is reduced to, whatever width is asked for
+TIME_SERIES_MAX_POINTS = 20000
+
 def generate_time_series(request, metric,):
     resolution = request.GET.get("resolution", "auto")
+    # the number of points to reduce bin-resolution series to, typically the plot's width
+    # in pixels times four. if not given, every bin is returned
+    max_points = request.GET.get("points")
+    if max_points is not None:
+        try:
+            max_points = min(max(int(max_points), 4), TIME_SERIES_MAX_POINTS)
+        except ValueError:
+            return HttpResponseBadRequest('points must be an integer')
     start = request.GET.get("start",None)
     end = request.GET.get("end",None)
     if start is not None:
@@ -860,9 +896,11 @@ def generate_time_series(request, metric,):
     metric = metric.replace("-", "_")
 
     bin_qs = filter_parameters_bin_query(request.GET)
+    rollup_scope = filter_parameters_rollup_scope(request.GET)
 
     def query_timeline(metric, start, end, resolution):
-        time_series, resolution = Timeline(bin_qs).metrics(metric, start, end, resolution=resolution)
+        time_series, resolution = Timeline(bin_qs, rollup_scope=rollup_scope).metrics(metric, start, end,
+            resolution=resolution, max_points=max_points)
 
         time_data = [item["dt"] for item in time_series]
         metric_data = []
@@ -896,6 +934,16 @@ def generate_time_series(request, metric,):
         time_start = min(time_data)
         time_end = max(time_data)
 
+    if request.GET.get('format') == 'parquet':
+        schema = pa.schema([('dt', pa.timestamp('us', tz='UTC')), ('metric', pa.float64())], metadata={
+            'y-axis': Timeline.metric_label(metric),
+            'resolution': resolution,
+        })
+        response = StreamingHttpResponse(stream_parquet(schema, [{ 'dt': time_data, 'metric': metric_data }]),
+            content_type=PARQUET_CONTENT_TYPE)
+        response['Content-Disposition'] = f'attachment; filename={metric}.parquet'
+        return response
+
     return JsonResponse({
         "x": time_data,
         "x-range": {
@@ -1183,8 +1231,9 @@ def tags(request):
 
 def timeline_info(request):
     bin_qs = filter_parameters_bin_query(request.GET)
+    rollup_scope = filter_parameters_rollup_scope(request.GET)
 
-    timeline = Timeline(bin_qs)
+    timeline = Timeline(bin_qs, rollup_scope=rollup_scope)
 
     return JsonResponse({
         'n_bins': len(timeline),
@@ -1251,9 +1300,13 @@ def update_skip(request):
     skip = request.POST.get("skip") == "true"
     bin_ids = request.POST.getlist("bins[]")
 
-    for bin in Bin.objects.filter(pid__in=bin_ids):
-        bin.skip = skip
-        bin.save()
+    with transaction.atomic():
+        ids = []
+        for bin in Bin.objects.filter(pid__in=bin_ids):
+            bin.skip = skip
+            bin.save()
+            ids.append(bin.id)
+        update_rollups(ids)
 
     return JsonResponse({
         "skip": skip,
@@ -1268,9 +1321,23 @@ def export_metadata_view(request, dataset_name=None):
     start_date = request.GET.get("start_date")
     end_date = request.GET.get("end_date")
     include_skip = request.GET.get('include_skip', 'true')
+    export_format = request.GET.get('format', 'csv').lower()
+
+    if export_format not in SNAPSHOT_FORMATS:
+        return HttpResponseBadRequest('format must be csv or parquet')
 
     filter_skip = not include_skip.lower() == 'true'
 
+    # a whole dataset's metadata is served from its latest snapshot, if there is one
+    unfiltered = not (tags or instrument_number or cruise or sample_type or start_date or end_date or filter_skip)
+    if dataset_name and unfiltered:
+        ds = Dataset.objects.filter(name=dataset_name).first()
+        path = snapshot_path(ds, export_format) if ds is not None else None
+        if path is not None:
+            return FileResponse(open(path, 'rb'), as_attachment=True,
+                filename='{}.{}'.format(dataset_name, export_format),
+                content_type=PARQUET_CONTENT_TYPE if export_format == 'parquet' else 'text/csv')
+
     bin_qs = bin_query(dataset_name=dataset_name,
                        tags=tags,
                        instrument_number=instrument_number,
@@ -1290,10 +1357,13 @@ def export_metadata_view(request, dataset_name=None):
         raise Http404('no bins match the given query')
 
     ds = Dataset.objects.get(name=dataset_name) if dataset_name else None
-    df = export_metadata(ds, bin_qs)
 
-    filename = (dataset_name or 'ifcb-metadata') + '.csv'
-    response = dataframe_csv_response(df, index=None)
+    filename = (dataset_name or 'ifcb-metadata') + '.' + export_format
+
+    if export_format == 'parquet':
+        response = StreamingHttpResponse(export_metadata_parquet(ds, bin_qs), content_type=PARQUET_CONTENT_TYPE)
+    else:
+        response = StreamingHttpResponse(export_metadata_csv(ds, bin_qs), content_type='text/csv')
     response['Content-Disposition'] = f'attachment; filename={filename}'
 
     return response
@@ -1311,5 +1381,38 @@ def sync_bin(request):
     acc.sync_one(bin_id)
     return JsonResponse({'result':'synced'})
 
+# maximum number of bins per sync_bins request
+SYNC_BINS_MAX = 5000
+
+def has_sync_api_key(request):
+    key = request.headers.get('X-API-Key', '')
+    return bool(settings.SYNC_API_KEY) and hmac.compare_digest(key.encode(), settings.SYNC_API_KEY.encode())
+
+@csrf_exempt
+@require_POST
+def sync_bins(request):
+    # batch version of sync_bin for transfer clients. expects a JSON body of the form
+    # {"dataset": "name", "bins": ["D20190101T000000_IFCB010", ...]}, and either the
+    # SYNC_API_KEY in an X-API-Key header or a logged-in user
+    if not (has_sync_api_key(request) or request.user.is_authenticated):
+        return HttpResponseForbidden('an API key or login is required')
+    try:
+        body = json.loads(request.body)
+        dataset_name = body['dataset']
+        bin_ids = body['bins']
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest('expected JSON with "dataset" and "bins"')
+    if not isinstance(bin_ids, list) or not all(isinstance(pid, str) for pid in bin_ids):
+        return HttpResponseBadRequest('"bins" must be a list of bin ids')
+    if len(bin_ids) > SYNC_BINS_MAX:
+        return HttpResponseBadRequest(f'at most {SYNC_BINS_MAX} bins per request')
+    dataset = get_object_or_404(Dataset, name=dataset_name)
+    acc = Accession(dataset)
+    status, errors = acc.sync_bins(bin_ids)
+    return JsonResponse({
+        'result': status,
+        'errors': errors,
+    })
+
 def about_page(request):
     return render(request, 'dashboard/about.html')
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -134,6 +135,26 @@ CELERY_RESULT_SERIALIZER = 'json'
 
 CELERY_TASK_TRACK_STARTED = True
 
+# number of processes each dataset sync uses to read raw data
+ACCESSION_WORKERS = int(os.getenv('ACCESSION_WORKERS', '1'))
+
+# whether dataset syncs are split into chunks that run as separate celery tasks,
+# and the maximum number of filesets per chunk
+ACCESSION_DISTRIBUTED = os.getenv('ACCESSION_DISTRIBUTED', 'false').lower() == 'true'
+ACCESSION_CHUNK_SIZE = int(os.getenv('ACCESSION_CHUNK_SIZE', '500'))
+
+# key that transfer clients send in an X-API-Key header to use the sync_bins API.
+# if it is empty, only logged-in users can use it
+SYNC_API_KEY = os.getenv('SYNC_API_KEY', '')
+
+# where uploaded metadata files are kept until they are imported. it must be
+# shared by the web server and the celery workers
+METADATA_UPLOAD_DIR = os.getenv('METADATA_UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'ifcbdb-metadata-uploads'))
+
+# where the snapshotexports command writes per-dataset metadata exports, which are
+# served in place of running the export query for a whole dataset
+EXPORT_SNAPSHOT_DIR = os.getenv('EXPORT_SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'ifcbdb-export-snapshots'))
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 
@@ -1,3 +1,8 @@
+import os
+import uuid
+
+from django.conf import settings
+from django.db import transaction
 from django.contrib.auth.decorators import login_required
 from django import forms
 from django.views.decorators.http import require_POST, require_GET
@@ -7,6 +12,8 @@ from django.shortcuts import render, get_object_or_404, redirect, reverse
 import pandas as pd
 
 from dashboard.models import Dataset, Instrument, DataDirectory, Tag, TagEvent, Bin, Comment
+from dashboard.manifest import Manifest
+from dashboard.rollups import update_rollups
 from .forms import DatasetForm, InstrumentForm, DirectoryForm, MetadataUploadForm
 
 from django.core.cache import cache
@@ -102,6 +109,8 @@ def edit_directory(request, dataset_id, id):
             if instance.kind == "raw":
                 instance.version = None
             instance.save()
+            # what was scanned before may not apply to the edited directory
+            Manifest.clear([instance])
 
             return redirect(reverse("secure:directory-management", kwargs={"dataset_id": dataset_id}))
     else:
@@ -312,6 +321,17 @@ METADATA_UPLOAD_LOCK_KEY = 'metadata_upload_lock'
 METADATA_UPLOAD_CANCEL_KEY = 'metadata_upload_cancel'
 METADATA_UPLOAD_TASKID_KEY = 'metadata_upload_task_id'
 
+METADATA_UPLOAD_CHECK_ROWS = 100
+
+def spool_metadata_upload(file):
+    # copies an uploaded file into METADATA_UPLOAD_DIR, returning its path
+    os.makedirs(settings.METADATA_UPLOAD_DIR, exist_ok=True)
+    csv_path = os.path.join(settings.METADATA_UPLOAD_DIR, '{}.csv'.format(uuid.uuid4().hex))
+    with open(csv_path, 'wb') as fout:
+        for chunk in file.chunks():
+            fout.write(chunk)
+    return csv_path
+
 @login_required
 def upload_metadata(request):
     from dashboard.tasks import import_metadata
@@ -324,20 +344,27 @@ def upload_metadata(request):
         if form.is_valid():
             file = request.FILES['file']
 
-            try:
-                df = pd.read_csv(file)
-                json_df = df.to_json()
-            except:
-                form.add_error(None, "CSV syntax error")
-                return render(request, 'secure/upload-metadata.html', {
-                    'form': form,
-                    'confirm': '',
-                    'in_progress': '',
-                    })
-
             added = cache.add(METADATA_UPLOAD_LOCK_KEY, True, timeout=None) # this is atomic
             if added:
-                r = import_metadata.delay(json_df, METADATA_UPLOAD_LOCK_KEY, METADATA_UPLOAD_CANCEL_KEY)
+                # spool the upload to disk, where the import task reads it a chunk at a time
+                try:
+                    csv_path = spool_metadata_upload(file)
+                except:
+                    cache.delete(METADATA_UPLOAD_LOCK_KEY)
+                    raise
+                try:
+                    # check the first rows so that most syntax errors are reported here
+                    pd.read_csv(csv_path, nrows=METADATA_UPLOAD_CHECK_ROWS)
+                except:
+                    os.remove(csv_path)
+                    cache.delete(METADATA_UPLOAD_LOCK_KEY)
+                    form.add_error(None, "CSV syntax error")
+                    return render(request, 'secure/upload-metadata.html', {
+                        'form': form,
+                        'confirm': '',
+                        'in_progress': '',
+                        })
+                r = import_metadata.delay(csv_path, METADATA_UPLOAD_LOCK_KEY, METADATA_UPLOAD_CANCEL_KEY)
                 cache.set(METADATA_UPLOAD_TASKID_KEY, r.task_id, timeout=None)
                 return redirect(reverse("secure:upload-metadata") + "?confirm=true")
             else:
@@ -384,8 +411,10 @@ def toggle_skip(request):
     skipped = request.POST.get("skipped") == "true"
 
     bin = get_object_or_404(Bin, pid=bin_id)
-    bin.skip = not skipped
-    bin.save()
+    with transaction.atomic():
+        bin.skip = not skipped
+        bin.save()
+        update_rollups([bin.id])
 
     return JsonResponse({
         "bin_id": bin_id,
@@ -1,14 +1,24 @@
+import argparse
 import os
+import queue
+import threading
 import time
 import logging
 import traceback
 
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from urllib3.util.retry import Retry
 import yaml
 
-from ifcb.data.transfer.remote import RemoteIfcb
 from ifcb.data.transfer.deposit import fileset_destination_dir
 
+try: # copied next to this file in the image, see the Dockerfile
+    from smbtransfer import SmbTransfer, TransferState, DEFAULT_CONNECTIONS
+except ImportError: # run from the repository with ifcbdb on PYTHONPATH
+    from common.smbtransfer import SmbTransfer, TransferState, DEFAULT_CONNECTIONS
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
 def load_config(config_file):
@@ -19,19 +29,138 @@ def load_config(config_file):
 
     return config
 
-def sync_ifcb(name, dashboard_url, ifcb_config):
+def dashboard_session(api_key=None):
+    # one keep-alive connection pool for all requests to the dashboard
+    session = requests.Session()
+    if api_key:
+        session.headers['X-API-Key'] = api_key
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4,
+        max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[502, 503, 504], allowed_methods=None))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+class TransferStats(object):
+    # filesets and bytes copied by one transfer, for throughput logging
+    def __init__(self):
+        self.filesets = 0
+        self.bytes = 0
+        self.started = time.time()
+
+    def add_fileset(self, path):
+        self.filesets += 1
+        for ext in ['adc', 'hdr', 'roi']:
+            try:
+                self.bytes += os.path.getsize(f'{path}.{ext}')
+            except OSError:
+                pass
+
+    def log(self, name, what):
+        elapsed = time.time() - self.started
+        if elapsed > 0 and self.filesets:
+            logging.info(f'{name}: {what} copied {self.filesets} fileset(s), {self.bytes} bytes in {elapsed:.1f}s '
+                f'({self.bytes / elapsed:.0f} bytes/s, {self.filesets / elapsed:.2f} filesets/s)')
+        else:
+            logging.info(f'{name}: {what} found nothing new in {elapsed:.1f}s')
+
+def remote_ifcb(ifcb_config, directory):
     address = ifcb_config['address']
     username = ifcb_config.get('username','ifcb')
     password = ifcb_config.get('password','ifcb')
     share = ifcb_config.get('share','Data')
+    netbios_name = ifcb_config.get('netbios_name')
+    timeout = int(ifcb_config.get('timeout',30))
+    connections = int(ifcb_config.get('connections',DEFAULT_CONNECTIONS))
+    return SmbTransfer(address, username, password, share=share, directory=directory,
+        netbios_name=netbios_name, timeout=timeout, n_connections=connections)
+
+def post_sync(name, session, url, dataset, lids, timeout):
+    # ask the dashboard to accession transferred bins. returns True if the request succeeded
+    if not lids:
+        return True
+    try:
+        logging.info(f'{name}: syncing {len(lids)} bin(s) via {url} ...')
+        r = session.post(url, json={'dataset': dataset, 'bins': lids}, timeout=timeout)
+        r.raise_for_status()
+    except:
+        logging.error(f'{name}: unable to reach {url}, {len(lids)} bin(s) not synced!')
+        return False
+    try:
+        result = r.json()
+        statuses = result.get('result') or {}
+        errors = result.get('errors') or {}
+        for lid, status in statuses.items():
+            if status not in ['synced', 'exists']:
+                message = errors.get(lid, status)
+                logging.error(f'{name}: {lid} not synced: {message}')
+    except:
+        logging.error(f'{name}: unexpected response from {url}, {len(lids)} bin(s) may not be synced!')
+        return False
+    return True
+
+class SyncConsumer(threading.Thread):
+    """
+    Accessions transferred filesets in batches, in its own thread, while the transfer
+    copies more. A batch is sent as soon as the previous one is done, so during a
+    catch-up each request carries whatever arrived while the last one was running.
+    put() blocks once max_queued lids are waiting, which pauses the transfer until
+    accession catches up.
+    """
+    def __init__(self, name, post, stats, batch_size, max_queued):
+        super().__init__(name=f'{name} sync', daemon=True)
+        self.post = post # sends a list of lids to the dashboard
+        self.stats = stats
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.accessioned = 0
+
+    def put(self, lid):
+        self.queue.put(lid)
+
+    def finish(self):
+        # wait until everything queued has been sent
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        done = False
+        while not done:
+            lids = [self.queue.get()] # wait for at least one
+            while len(lids) < self.batch_size:
+                try:
+                    lids.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in lids:
+                lids.remove(None)
+                done = True
+            # keep draining the queue whatever happens, or put() and finish() would block forever
+            try:
+                if self.post(lids):
+                    self.accessioned += len(lids)
+                self.log_progress()
+            except:
+                logging.error(f'{self.name}: error syncing {len(lids)} bin(s)')
+                traceback.print_exc()
+
+    def log_progress(self):
+        elapsed = max(time.time() - self.stats.started, 1e-6)
+        transferred = self.stats.filesets
+        logging.info(f'{self.name}: transferred {transferred} ({transferred / elapsed:.2f}/s), '
+            f'accessioned {self.accessioned} ({self.accessioned / elapsed:.2f}/s), {self.queue.qsize()} waiting')
+
+def transfer_data(name, dashboard_url, ifcb_config, session, state_path, reconcile=False):
+    # copy new data from the IFCB and sync it to the dashboard. returns True if successful
     directory = ifcb_config.get('directory','')
     destination_directory = ifcb_config.get('destination')
-    beads_destination_directory = ifcb_config.get('beads_destination')
     dataset = ifcb_config.get('dataset')
-    timeout = int(ifcb_config.get('timeout',30))
     if dataset is None:
         raise ValueError('dataset must be specified')
     day_dirs = ifcb_config.get('day_dirs',False)
+    sync_batch_size = int(ifcb_config.get('sync_batch_size',100))
+    sync_timeout = int(ifcb_config.get('sync_timeout',300))
+    pipelined = ifcb_config.get('pipelined',False)
+    stats = TransferStats()
 
     def destination(lid):
         if day_dirs:
@@ -41,56 +170,188 @@ def sync_ifcb(name, dashboard_url, ifcb_config):
 
         return dest
 
-    def hit_sync_endpoint(lid):
-        url = f'{dashboard_url}/api/sync_bin?dataset={dataset}&bin={lid}'
-        try:
-            logging.info(f'hitting {url} ...')
-            requests.get(url)
-        except:
-            logging.error(f'unable to reach {url}, {lid} not synced!')
+    url = f'{dashboard_url}/api/sync_bins'
+    post = lambda lids: post_sync(name, session, url, dataset, lids, sync_timeout)
+
+    if pipelined:
+        # accession in another thread while the transfer continues
+        consumer = SyncConsumer(name, post, stats, sync_batch_size, int(ifcb_config.get('max_queued',1000)))
+        consumer.start()
+        queue_lid = consumer.put
+        def flush():
+            consumer.finish()
+    else:
+        pending = [] # lids transferred but not yet synced
+        def flush():
+            lids = pending[:]
+            del pending[:]
+            post(lids)
+        def queue_lid(lid):
+            pending.append(lid)
+            if len(pending) >= sync_batch_size:
+                flush()
+
+    def fileset_callback(lid):
+        stats.add_fileset(os.path.join(destination(lid), lid))
+        queue_lid(lid)
 
     logging.info(f'connecting to {name} ...')
 
     try:
-        ifcb = RemoteIfcb(address, username, password,
-            share=share, directory=directory, timeout=timeout)
+        ifcb = remote_ifcb(ifcb_config, directory)
 
         with ifcb:
-            ifcb.sync(destination, fileset_callback=hit_sync_endpoint)
-            logging.info(f'completed transferring from {name}')
+            result = sync_with_state(ifcb, destination, fileset_callback, ifcb_config, state_path, reconcile)
+        for lid, error in result['errors'].items():
+            logging.error(f'{name}: unable to copy {lid}: {error}')
+        logging.info(f'completed transferring from {name}')
+        return not result['errors']
     except:
         logging.error(f'unable to transfer from {name}')
         traceback.print_exc()
+        return False
+    finally:
+        # sync whatever was transferred, even if the transfer was interrupted
+        flush()
+        stats.log(name, 'data transfer')
 
-    if beads_destination_directory is not None:
-        logging.info(f'transferring beads ...')
+def transfer_beads(name, ifcb_config, state_path, reconcile=False):
+    # copy new beads data from the IFCB. returns True if successful
+    beads_destination_directory = ifcb_config.get('beads_destination')
+    stats = TransferStats()
 
-        try:
-            ifcb = RemoteIfcb(address, username, password,
-                share=share, directory='beads', timeout=timeout)
+    def fileset_callback(lid):
+        stats.add_fileset(os.path.join(beads_destination_directory, lid))
+
+    logging.info(f'transferring beads from {name} ...')
+
+    try:
+        ifcb = remote_ifcb(ifcb_config, 'beads')
+
+        with ifcb:
+            result = sync_with_state(ifcb, beads_destination_directory, fileset_callback, ifcb_config, state_path, reconcile)
+        for lid, error in result['errors'].items():
+            logging.error(f'{name}: unable to copy beads {lid}: {error}')
+        logging.info(f'completed transferring beads from {name}')
+        return not result['errors']
+    except:
+        logging.error(f'unable to transfer beads from {name}')
+        traceback.print_exc()
+        return False
+    finally:
+        stats.log(name, 'beads transfer')
+
+def sync_with_state(ifcb, destination, fileset_callback, ifcb_config, state_path, reconcile):
+    # the state store remembers what has been copied, so that only recent directories
+    # on the IFCB need to be listed. a reconcile lists and checks everything
+    recent_days = int(ifcb_config.get('recent_days',2))
+    state = TransferState(state_path)
+    try:
+        if reconcile:
+            logging.info(f'reconciling {state_path} with the IFCB, listing all directories')
+        return ifcb.sync(destination, fileset_callback=fileset_callback,
+            state=state, reconcile=reconcile, recent_days=recent_days)
+    finally:
+        state.close()
+
+class Job(object):
+    """
+    A transfer that runs repeatedly on its own schedule. After a failure the next run
+    is delayed by an exponentially increasing backoff, so an unreachable IFCB is
+    retried less and less often, up to max_backoff seconds apart. Every
+    reconcile_interval seconds, if set, a run does a full reconcile.
+    """
+    def __init__(self, name, fn, interval, max_backoff, reconcile=False, reconcile_interval=None):
+        self.name = name
+        self.fn = fn # takes a reconcile flag and returns True if successful
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.next_run = time.time()
+        self.future = None
+        self.reconcile_pending = reconcile # reconcile on the next run
+        self.reconcile_interval = reconcile_interval
+        self.last_reconcile = time.time()
+
+    def is_due(self, now):
+        return self.future is None and now >= self.next_run
+
+    def start(self, executor):
+        now = time.time()
+        if self.reconcile_interval is not None and now - self.last_reconcile >= self.reconcile_interval:
+            self.reconcile_pending = True
+        reconcile = self.reconcile_pending
+        if reconcile:
+            self.reconcile_pending = False
+            self.last_reconcile = now
+        self.future = executor.submit(self.fn, reconcile)
 
-            with ifcb:
-                ifcb.sync(beads_destination_directory)
-                logging.info(f'completed transferring beads from {name}')
+    def finished(self):
+        try:
+            success = self.future.result()
         except:
-            logging.error(f'unable to transfer beads from {name}')
+            logging.error(f'{self.name} failed')
             traceback.print_exc()
+            success = False
+        self.future = None
+        if success:
+            self.failures = 0
+            delay = self.interval
+        else:
+            self.failures += 1
+            delay = min(self.interval * 2 ** self.failures, self.max_backoff)
+            logging.info(f'{self.name} has failed {self.failures} time(s) in a row, retrying in {delay}s')
+        self.next_run = time.time() + delay
 
-def sync_ifcbs(config):
+def transfer_jobs(config, reconcile=False):
     dashboard_url = config['dashboard']['url']
+    api_key = config['dashboard'].get('api_key')
     logging.info(f'dashboard URL = {dashboard_url}')
+    sleep = config.get('sleep',60)
+    max_backoff = config.get('max_backoff',3600)
+    reconcile_interval = config.get('reconcile_interval')
+    state_directory = config.get('state_directory','transfer_state')
+    os.makedirs(state_directory, exist_ok=True)
+    jobs = []
 
     for name, ifcb_config in config['ifcbs'].items():
-        logging.info(f'transferring from {name}...')
-        sync_ifcb(name, dashboard_url, ifcb_config)
+        interval = ifcb_config.get('sleep', sleep)
+        # each IFCB gets its own dashboard session, so jobs don't share connections across threads
+        session = dashboard_session(api_key)
+        state_path = os.path.join(state_directory, f'{name}.sqlite')
+        data = lambda reconcile, name=name, ifcb_config=ifcb_config, session=session, state_path=state_path: \
+            transfer_data(name, dashboard_url, ifcb_config, session, state_path, reconcile)
+        jobs.append(Job(f'{name} data', data, interval, max_backoff, reconcile, reconcile_interval))
+        if ifcb_config.get('beads_destination') is not None:
+            state_path = os.path.join(state_directory, f'{name}_beads.sqlite')
+            beads = lambda reconcile, name=name, ifcb_config=ifcb_config, state_path=state_path: \
+                transfer_beads(name, ifcb_config, state_path, reconcile)
+            jobs.append(Job(f'{name} beads', beads, ifcb_config.get('beads_sleep', interval), max_backoff,
+                reconcile, reconcile_interval))
 
-def main(config_file='transfer_config.yml'):
+    return jobs
+
+def main(config_file='transfer_config.yml', reconcile=False):
     config = load_config(config_file)
-    sleep = config.get('sleep',60)
-    while True:
-        sync_ifcbs(config)
-        logging.info(f'pausing for {sleep}s ...')
-        time.sleep(sleep)
+    jobs = transfer_jobs(config, reconcile)
+    # at most this many transfers run at once
+    workers = int(config.get('workers', 4))
+    logging.info(f'running {len(jobs)} transfer job(s) with {workers} worker(s)')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            now = time.time()
+            for job in jobs:
+                if job.future is not None and job.future.done():
+                    job.finished()
+                if job.is_due(now):
+                    logging.info(f'starting {job.name} ...')
+                    job.start(executor)
+            time.sleep(1)
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='transfer data from IFCBs and sync it to the dashboard')
+    parser.add_argument('config_file', nargs='?', default='transfer_config.yml')
+    parser.add_argument('--reconcile', action='store_true',
+        help='list everything on each IFCB and check it against the copied data before resuming incremental transfers')
+    args = parser.parse_args()
+    main(args.config_file, args.reconcile)